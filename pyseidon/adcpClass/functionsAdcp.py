@@ -9,6 +9,8 @@ from datetime import datetime
 from datetime import timedelta
 from miscellaneous import *
 from BP_tools import *
+from statistics_utils import exceedance_curve
+from harmonic_utils import harmonic_reconstruction
 from utide import ut_solv, ut_reconstr
 import time
 from miscellaneous import mattime_to_datetime 
@@ -86,7 +88,8 @@ class FunctionsAdcp:
 
         return dirFlow, norm
 
-    def ebb_flood_split(self, t_start=[], t_end=[], time_ind=[], debug=False):
+    def ebb_flood_split(self, t_start=[], t_end=[], time_ind=[], bins=False,
+                        debug=False):
         """
         Compute time indices for ebb and flood but also the 
         principal flow directions and associated variances for (lon, lat) point
@@ -95,8 +98,14 @@ class FunctionsAdcp:
         -------
           - floodIndex = flood time index, 1D array of integers
           - ebbIndex = ebb time index, 1D array of integers
-          - pr_axis = principal flow ax1s, float number in degrees
-          - pr_ax_var = associated variance, float number
+          - pr_axis = principal flow axis, heading in degrees from North
+          - pr_ax_var = fraction of the variance along the principal axis
+
+        For bins=True:
+          - flood = flood time steps, 2D array of booleans (ntime, nbin)
+          - ebb = ebb time steps, 2D array of booleans (ntime, nbin)
+          - pr_axis = principal flow axes, 1D array (nbin)
+          - pr_ax_var = fractions of the variance, 1D array (nbin)
 
         Keywords:
         --------
@@ -105,14 +114,16 @@ class FunctionsAdcp:
           - t_end = end time, as a string ('yyyy-mm-ddThh:mm:ss'),
                     or time index as an integer
           - time_ind = time indices to work in, 1D array of integers 
+          - bins = True, split every bin of east_vel and north_vel
+                   instead of the depth averaged velocity
         
         Notes:
         -----
-          - may take time to compute if time period too long
           - directions between -180 and 180 deg., i.e. 0=East, 90=North,
             +/-180=West, -90=South
           - use time_ind or t_start and t_end, not both
           - assume that flood is aligned with principal direction
+          - all the bins are split at once, see BP_tools.flood_ebb_split
         """
         debug = debug or self._debug
         if debug:
@@ -132,62 +143,30 @@ class FunctionsAdcp:
                 argtime = arange(t_start, t_end)
 
         #Choose the right pair of velocity components
+        if bins:
+            U = self._var.east_vel
+            V = self._var.north_vel
+        else:
+            U = self._var.ua
+            V = self._var.va
         if not argtime==[]:
-            U = self._var.ua[argtime]
-            V = self._var.va[argtime]
+            U = U[argtime]
+            V = V[argtime]
         else:
-            U = self._var.ua[:]
-            V = self._var.va[:]
+            U = U[:]
+            V = V[:]
 
-        #WB version of BP's principal axis
+        #Principal axes, signed speeds and ebb/flood in one pass
         if debug:
-            print 'Computin principal axis at point...'
-        pr_axis, pr_ax_var = principal_axis(U, V)
+            print 'Splitting ebb and flood...'
+        pr_axis, pr_ax_var, s_signed, flood = flood_ebb_split(U, V)
 
-        #ebb/flood split
-        if debug:
-            print 'Splitting ebb and flood at point...'
-        # reverse 0-360 deg convention
-        ra = (-pr_axis - 90.0) * np.pi /180.0
-        if ra>np.pi:
-            ra = ra - (2.0*np.pi)
-        elif ra<-np.pi:
-            ra = ra + (2.0*np.pi)    
-        dirFlow = np.arctan2(V,U)
-        #Define bins of angles
-        if ra == 0.0:
-            binP = [0.0, np.pi/2.0]
-            binP = [0.0, -np.pi/2.0]
-        elif ra > 0.0:
-            if ra == np.pi:
-                binP = [np.pi/2.0 , np.pi]
-                binM = [-np.pi, -np.pi/2.0 ]        
-            elif ra < (np.pi/2.0):
-                binP = [0.0, ra + (np.pi/2.0)]
-                binM = [-((np.pi/2.0)-ra), 0.0]
-            else:
-                binP = [ra - (np.pi/2.0), np.pi]
-                binM = [-np.pi, -np.pi + (ra-(np.pi/2.0))]
+        if bins:
+            floodIndex = flood
+            ebbIndex = ~np.isnan(s_signed) * ~flood
         else:
-            if ra == -np.pi:
-                binP = [np.pi/2.0 , np.pi]
-                binM = [-np.pi, -np.pi/2.0]
-            elif ra > -(np.pi/2.0):
-                binP = [0.0, ra + (np.pi/2.0)]
-                binM = [ ((-np.pi/2.0)+ra), 0.0]
-            else:
-                binP = [np.pi - (ra+(np.pi/2.0)) , np.pi]
-                binM = [-np.pi, ra + (np.pi/2.0)]
-                                
-        test = (((dirFlow > binP[0]) * (dirFlow < binP[1])) +
-                ((dirFlow > binM[0]) * (dirFlow < binM[1])))
-        floodIndex = np.where(test == True)[0]
-        ebbIndex = np.where(test == False)[0]
-
-        #TR fit with Rose diagram angle convention
-        #pr_axis = pr_axis - 90.0
-        #if pr_axis<0.0:
-        #    pr_axis[ind] = pr_axis[ind] + 360   
+            floodIndex = np.where(flood)[0]
+            ebbIndex = np.where(~flood)[0]
 
         if debug:
             end = time.time()
@@ -195,21 +174,25 @@ class FunctionsAdcp:
 
         return floodIndex, ebbIndex, pr_axis, pr_ax_var
 
-    def exceedance(self, var, debug=False):
+    def exceedance(self, var, ranges=None, graph=True, debug=False):
         """
         This function calculate the excedence curve of a var(time).
 
         Inputs:
         ------
-          - var = given quantity, 1 array of n elements
+          - var = given quantity, 1 array of n elements,
+                  or 2D array (time, bins) for the curves of every bin
 
         Keywords:
         --------
+          - ranges = amplitude thresholds, float or list of floats.
+                     Default is 31 bins from 0 to the signal maximum
           - graph: True->plots curve; False->does not
 
         Outputs:
         -------
-          - Exceedance = list of % of occurences, 1D array
+          - Exceedance = list of % of occurences, 1D array,
+                         or 2D array (nrange, bins)
           - Ranges = list of signal amplitude bins, 1D array
 
         Notes:
@@ -221,32 +204,21 @@ class FunctionsAdcp:
             print 'Computing exceedance...'
 
         signal=var
-        
-        Max = max(signal)	
-        dy = (Max/30.0)
-        Ranges = np.arange(0,(Max + dy), dy)
-        Exceedance = np.zeros(Ranges.shape[0])
-        dt = self._var.matlabTime[1] - self._var.matlabTime[0]
-        Period = var.shape[0] * dt
-        time = np.arange(0.0, Period, dt)
 
-        N = len(signal)
-        M = len(Ranges)
-
-        for i in range(M):
-            r = Ranges[i]
-            for j in range(N-1):
-                if signal[j] > r:
-                    Exceedance[i] = Exceedance[i] + (time[j+1] - time[j])
-
-        Exceedance = (Exceedance * 100) / Period
+        #Irregular time steps are accounted for
+        time = self._var.matlabTime[:]
+        if not time.shape[0]==signal.shape[0]:
+            time = time[1] - time[0]
+        Exceedance, Ranges = exceedance_curve(signal, time, ranges=ranges,
+                                              debug=debug)
 
         if debug:
             print '...Passed'
        
         #Plot
-        self._plot.plot_xy(Exceedance, Ranges, yLabel='Amplitudes',
-                           xLabel='Exceedance probability in %')
+        if graph and len(signal.shape)==1:
+            self._plot.plot_xy(Exceedance, Ranges, yLabel='Amplitudes',
+                               xLabel='Exceedance probability in %')
 
         return Exceedance, Ranges
 
@@ -375,7 +347,8 @@ class FunctionsAdcp:
             return harmo
 
     def Harmonic_reconstruction(self, harmo, elevation=True, velocity=False,
-                                time_ind=slice(None), debug=False, **kwarg):
+                                time_ind=slice(None), mattime=[],
+                                filename=None, debug=False, **kwarg):
         '''
         Description:
         ----------
@@ -386,14 +359,21 @@ class FunctionsAdcp:
 
         Inputs:
         ------
-          - Harmo = harmonic coefficient from harmo_analysis
+          - Harmo = harmonic coefficient from harmo_analysis, or
+                    coefficients of many locations, i.e. list of them
+                    or output of Harmonic_analysis
           - elevation =True means that ut_reconstr will be done for elevation.
           - velocity =True means that ut_reconst will be done for velocity.
           - time_ind = time indices to process, list of integers
+          - mattime = matlab times to reconstruct at, 1D array.
+                      Overrides time_ind, i.e. for predictions
+          - filename = path of the *.npy file the reconstruction of many
+                       locations is written to, None to keep it in memory
         
         Output:
         ------         
-          - Reconstruct = reconstructed signal, dictionary
+          - Reconstruct = reconstructed signal, dictionary. For many
+                          locations, arrays (ntime, nlocation)
 
         Options:
         -------
@@ -405,18 +385,35 @@ class FunctionsAdcp:
         -----
         For more detailed information about ut_reconstr, please see
         https://github.com/wesleybowman/UTide
+        Many locations are reconstructed at once by matrix products over
+        time blocks, see harmonic_utils.harmonic_reconstruction. In that
+        case, only the cnstit option applies and velocity=True takes
+        precedence over elevation.
 
         '''
         debug = (debug or self._debug)
-        time = self._var.matlabTime[time_ind]
+        if not len(mattime)==0:
+            time = np.asarray(mattime)
+        else:
+            time = self._var.matlabTime[time_ind]
         #TR_comments: Add debug flag in Utide: debug=self._debug
         Reconstruct = {}
+        if type(harmo)==list or np.ndim(harmo['g'])>1:
+            #Many locations at once
+            recon = harmonic_reconstruction(time, harmo,
+                                            cnstit=kwarg.get('cnstit', []),
+                                            filename=filename, debug=debug)
+            if velocity:
+                Reconstruct['U'], Reconstruct['V'] = recon
+            elif elevation:
+                Reconstruct['el'] = recon
+            return Reconstruct
         if velocity:
-            U_recon, V_recon = ut_reconstr(time,harmo)
+            U_recon, V_recon = ut_reconstr(time,harmo,**kwarg)
             Reconstruct['U'] = U_recon
             Reconstruct['V'] = V_recon
         if elevation:
-            elev_recon, _ = ut_reconstr(time,harmo)
+            elev_recon, _ = ut_reconstr(time,harmo,**kwarg)
             Reconstruct['el'] = elev_recon
         return Reconstruct  
 
@@ -6,12 +6,20 @@ import numpy as np
 from scipy import linalg as LA
 from scipy.interpolate import interp1d
 import sys
+import os
 import numexpr as ne
 from datetime import datetime
 from datetime import timedelta
 from interpolation_utils import *
 from miscellaneous import *
 from BP_tools import *
+from loading_utils import chunked_apply, out_file, load_slab, MEM_BUDGET
+from grid_operators import neighbour_index, vorticity_field
+from grid_operators import node_to_element
+from power_utils import power_assessment
+from statistics_utils import exceedance_curve
+from harmonic_utils import harmonic_analysis, harmonic_pool
+from harmonic_utils import harmonic_reconstruction
 from utide import ut_solv, ut_reconstr
 import time
 
@@ -48,14 +56,8 @@ class FunctionsFvcom:
             print 'Computing central bathy...'
 
         #Interpolation at centers
-        size = self._grid.nele
-        size1 = self._grid.ntime
-        elc = np.zeros((size1, size))
-        hc = np.zeros((size))
-        #TR comment: I am dubeous about the interpolation method here
-        for ind, value in enumerate(self._grid.trinodes):
-            elc[:, ind] = np.mean(self._var.el[:, value-1], axis=1)
-            hc[ind] = np.mean(self._grid.h[value-1])
+        elc = node_to_element(self._var.el, self._grid.trinodes)
+        hc = node_to_element(self._grid.h, self._grid.trinodes)
 
         #Custom return    
         self._grid.hc = hc
@@ -77,19 +79,22 @@ class FunctionsFvcom:
         Notes:
         -----
           - Can take time over the full domain
+          - computed by time blocks, written to FVCOM.Variables._out_dir
+            if defined
         """
         debug = debug or self._debug
         if debug:
             print 'Computing horizontal velocity norm...'
 
         try:
-            u = self._var.ua
-            v = self._var.va
-            vel = ne.evaluate('sqrt(u**2 + v**2)')  
+            vel = chunked_apply(lambda u, v: ne.evaluate('sqrt(u**2 + v**2)'),
+                                [self._var.ua, self._var.va],
+                                filename=out_file(self._var, 'hori_velo_norm'),
+                                debug=debug)
         except MemoryError:
             print '---Data too large for machine memory---'
             print 'Tip: use ax or tx during class initialisation'
-            print '---  to use partial data'
+            print '---  to use partial data, or out_dir to work out-of-core'
             raise
 
         #Custom return    
@@ -112,19 +117,23 @@ class FunctionsFvcom:
           - directions between -180 and 180 deg., i.e. 0=East, 90=North,
             +/-180=West, -90=South
           - Can take time over the full domain
+          - computed by time blocks, written to FVCOM.Variables._out_dir
+            if defined
         """
         if debug or self._debug:
             print 'Computing flow directions...'
 
         try:
-            u = self._var.ua
-            v = self._var.va
-            dirFlow = np.rad2deg(np.arctan2(v,u))
+            dirFlow = chunked_apply(lambda u, v: np.rad2deg(np.arctan2(v,u)),
+                                    [self._var.ua, self._var.va],
+                                    filename=out_file(self._var,
+                                                      'depth_av_flow_dir'),
+                                    debug=debug)
 
         except MemoryError:
             print '---Data too large for machine memory---'
             print 'Tip: use ax or tx during class initialisation'
-            print '---  to use partial data'
+            print '---  to use partial data, or out_dir to work out-of-core'
             raise
 
         #Custom return    
@@ -137,6 +146,74 @@ class FunctionsFvcom:
         if debug or self._debug:
             print '...Passed'
 
+    def principal_axes(self, t_start=[], t_end=[], time_ind=[],
+                       mem_budget=MEM_BUDGET, debug=False):
+        """
+        This method create new variables 'principal flow axes' (deg.)
+        and 'associated variances' of every element
+        -> FVCOM.Variables.pr_axis and FVCOM.Variables.pr_ax_var
+
+        Keywords:
+        --------
+          - t_start = start time, as a string ('yyyy-mm-ddThh:mm:ss'),
+                      or time index as an integer
+          - t_end = end time, as a string ('yyyy-mm-ddThh:mm:ss'),
+                    or time index as an integer
+          - time_ind = time indices to work in, 1D array of integers
+          - mem_budget = maximum size in bytes of the element blocks, integer
+
+        Notes:
+        -----
+          - principal axes as headings in degrees from North, in [0, 180[,
+            and fractions of the variance along them
+          - computed by element blocks, the axes of a block being solved
+            at once, see BP_tools.principal_axes
+          - use time_ind or t_start and t_end, not both
+        """
+        debug = debug or self._debug
+        if debug:
+            start = time.time()
+            print 'Computing principal flow axes...'
+
+        # Find time interval to work in
+        argtime = slice(None)
+        if not time_ind==[]:
+            argtime = time_ind
+        elif not t_start==[]:
+            if type(t_start)==str:
+                argtime = time_to_index(t_start, t_end,
+                                        self._var.matlabTime,
+                                        debug=debug)
+            else:
+                argtime = np.arange(t_start, t_end)
+
+        ntime = len(np.arange(self._var.ua.shape[0])[argtime])
+        nele = self._var.ua.shape[1]
+        pr_axis = np.empty(nele)
+        pr_ax_var = np.empty(nele)
+        #u, v and their deviations, 8 bytes each
+        cols = max(1, int(mem_budget // (4 * 8 * ntime)))
+        for c0 in range(0, nele, cols):
+            c1 = min(c0 + cols, nele)
+            U = load_slab(self._var.ua, argtime, slice(c0, c1),
+                          mem_budget=mem_budget)
+            V = load_slab(self._var.va, argtime, slice(c0, c1),
+                          mem_budget=mem_budget)
+            pr_axis[c0:c1], pr_ax_var[c0:c1] = principal_axes(U, V)
+            if debug: print 'Elements: ' + str(c0) + '-' + str(c1)
+
+        #Custom return
+        self._var.pr_axis = pr_axis
+        self._var.pr_ax_var = pr_ax_var
+
+        # Add metadata entry
+        self._History.append('principal flow axes computed')
+        print '-Principal flow axes added to FVCOM.Variables.-'
+
+        if debug:
+            end = time.time()
+            print "...processing time: ", (end - start)
+
     def flow_dir_at_point(self, pt_lon, pt_lat, t_start=[], t_end=[], time_ind=[],
                           exceedance=False, debug=False):
         """
@@ -187,9 +264,8 @@ class FunctionsFvcom:
 
         #Extraction at point
         # Finding closest point
-        index = closest_point([pt_lon], [pt_lat],
-                              self._grid.lonc,
-                              self._grid.latc, debug=debug)[0]
+        index = containing_element(self._grid, [pt_lon], [pt_lat],
+                                   debug=debug)[0]
         if debug:
             print 'Extraction of u and v at point...'
         U = self.interpolation_at_point(u, pt_lon, pt_lat, index=index,
@@ -370,8 +446,8 @@ class FunctionsFvcom:
         -------
           - floodIndex = flood time index, 1D array of integers
           - ebbIndex = ebb time index, 1D array of integers
-          - pr_axis = principal flow ax1s, float number in degrees
-          - pr_ax_var = associated variance, float number
+          - pr_axis = principal flow axis, heading in degrees from North
+          - pr_ax_var = fraction of the variance along the principal axis
 
         Keywords:
         --------
@@ -412,9 +488,8 @@ class FunctionsFvcom:
 
         #Extraction at point
         # Finding closest point
-        index = closest_point([pt_lon], [pt_lat],
-                              self._grid.lonc,
-                              self._grid.latc, debug=debug)[0]
+        index = containing_element(self._grid, [pt_lon], [pt_lat],
+                                   debug=debug)[0]
         if debug:
             print 'Extraction of u and v at point...'
         U = self.interpolation_at_point(u, pt_lon, pt_lat, index=index,
@@ -427,36 +502,11 @@ class FunctionsFvcom:
             U = U[argtime[:]]
             V = V[argtime[:]] 
 
-        #WB version of BP's principal axis
-        #Assuming principal axis = flood heading
-        #determine principal axes - potentially a problem if axes are very kinked
-        #   since this would misclassify part of ebb and flood
-        if debug: print 'Computing principal axis at point...'
-        pr_axis, pr_ax_var = principal_axis(U, V)
-
+        #Principal axis, signed speed and ebb/flood in one pass
         if debug: print 'Computing ebb/flood intervals...'
-        #Defines interval
-        flood_heading = np.array([-90, 90]) + pr_axis
-        #initialise matrix
-        s_signed_all = np.empty(U.shape)
-        s_signed_all.fill(np.nan)
-        PA_all = np.zeros(U.shape)
-        dir_all = np.arctan2(U,U) * 180 / np.pi
-        ind = np.where(dir_all<0)
-        dir_all[ind] = dir_all[ind] + 360     
-
-        # sign speed - eliminating wrap-around
-        dir_PA = dir_all - pr_axis
-        dir_PA[dir_PA < -90] += 360
-        dir_PA[dir_PA > 270] -= 360
-
-        #dir_PA[dir_PA<-90] = dir_PA(dir_PA<-90) + 360;
-        #dir_PA(dir_PA>270) = dir_PA(dir_PA>270) - 360;
-
-        #general direction of flood passed as input argument
-        floodIndex = np.where((dir_PA >= -90) & (dir_PA<90))
-        ebbIndex = np.arange(dir_PA.shape[0])
-        ebbIndex = np.delete(ebbIndex,floodIndex[:]) 
+        pr_axis, pr_ax_var, s_signed, flood = flood_ebb_split(U, V)
+        floodIndex = np.where(flood)[0]
+        ebbIndex = np.where(~flood)[0]
 
         if debug:
             end = time.time()
@@ -551,7 +601,8 @@ class FunctionsFvcom:
 
         if index==[]:
             # Find indices of the closest element
-            index = closest_point([pt_lon], [pt_lat], lonc, latc, debug=debug)[0]
+            index = containing_element(self._grid, [pt_lon], [pt_lat],
+                                       debug=debug)[0]
         # Conversion (lon, lat) to (x, y)
         pt_x = interp_at_point(self._grid.x, pt_lon, pt_lat, lon, lat,
                                index=index, trinodes=trinodes, debug=debug)
@@ -580,10 +631,111 @@ class FunctionsFvcom:
 
         return varInterp
 
-    def exceedance(self, var, pt_lon=[], pt_lat=[], debug=False):
+    def interpolation_at_points(self, var, lons, lats, index=[], debug=False):
+        """
+        This function interpolates any given variables at many locations
+        in one pass.
+
+        Inputs:
+        ------
+          - var = any FVCOM grid data or variable, numpy array
+          - lons = longitudes in decimal degrees East to find, list or 1D array
+          - lats = latitudes in decimal degrees North to find, list or 1D array
+
+        Outputs:
+        -------
+           - varInterp = var interpolated at (lons, lats), array of dim.
+                         (npoints), (ntime, npoints) or (ntime, nlevel, npoints)
+
+        Keywords:
+        --------
+          - index = element indexes, 1D array of integers. Use only if
+                    containing element indexes are already known
+
+        Notes:
+        -----
+          - element indexes and (x, y) offsets are computed once for all points
+        """
+        debug = (debug or self._debug)
+        if debug:
+            print 'Interpolaling at points...'
+            start = time.time()
+        lons = np.atleast_1d(np.asarray(lons, dtype=np.float64))
+        lats = np.atleast_1d(np.asarray(lats, dtype=np.float64))
+        trinodes = self._grid.trinodes[:]
+
+        if type(index)==list and index==[]:
+            # Find indices of the containing elements
+            index = containing_element(self._grid, lons, lats, debug=debug)
+        index = np.asarray(index, dtype=int)
+        # Conversion (lon, lat) to (x, y)
+        pt_x, pt_y = points_to_xy(self._grid, lons, lats, index)
+        #change in function of the data you dealing with
+        if any(i == self._grid.nnode for i in var.shape):
+            varInterp = interpN_at_pts(var, pt_x, pt_y,
+                                       self._grid.xc[:], self._grid.yc[:],
+                                       index, trinodes, self._grid.aw0,
+                                       self._grid.awx, self._grid.awy,
+                                       debug=debug)
+        else:
+            varInterp = interpE_at_pts(var, pt_x, pt_y,
+                                       self._grid.xc[:], self._grid.yc[:],
+                                       index, self._grid.triele[:], trinodes,
+                                       self._grid.a1u, self._grid.a2u,
+                                       debug=debug)
+        if debug:
+            print "Processing time: ", (time.time() - start)
+
+        return varInterp
+
+    def point_interpolator(self, lons, lats, filename=None, debug=False):
+        """
+        This function returns a reusable interpolator from the grid
+        onto a fixed set of locations.
+
+        Inputs:
+        ------
+          - lons = longitudes in decimal degrees East, list or 1D array
+          - lats = latitudes in decimal degrees North, list or 1D array
+
+        Outputs:
+        -------
+           - interp = PointInterpolator object, interp(var) returns var
+                      interpolated at (lons, lats)
+
+        Keywords:
+        --------
+          - filename = pickle file from which the interpolator is loaded
+                       if it matches the grid and locations, and to which
+                       it is saved otherwise
+
+        Notes:
+        -----
+          - the interpolator holds sparse weight matrices, so any variable
+            of shape (ntime, [nlevel,] nele or nnode) is interpolated
+            with a single sparse product
+        """
+        debug = (debug or self._debug)
+        lons = np.atleast_1d(np.asarray(lons, dtype=np.float64))
+        lats = np.atleast_1d(np.asarray(lats, dtype=np.float64))
+        if not filename is None and os.path.exists(filename):
+            interp = PointInterpolator.load(filename)
+            if interp.check(self._grid) and np.array_equal(interp.lon, lons)\
+               and np.array_equal(interp.lat, lats):
+                if debug: print 'Interpolator loaded from ' + filename
+                return interp
+        interp = PointInterpolator(self._grid, lons, lats, debug=debug)
+        if not filename is None:
+            interp.save(filename)
+            if debug: print 'Interpolator saved as ' + filename
+
+        return interp
+
+    def exceedance(self, var, pt_lon=[], pt_lat=[], ranges=None,
+                   graph=True, debug=False):
         """
         This function calculates the excedence curve of a var(time)
-        at any given point.
+        at any given point or over the whole domain.
 
         Inputs:
         ------
@@ -592,115 +744,85 @@ class FunctionsFvcom:
         Keywords:
         --------
           - pt_lon, pt_lat = coordinates, float numbers.
-                             Necessary if var = 2D (i.e. [time, nnode or nele]
+                             If var = 2D (i.e. [time, nnode or nele]) and
+                             no coordinates are given, the curves of every
+                             node or element are computed at once
+          - ranges = amplitude thresholds, float or list of floats.
+                     Default is 31 bins from 0 to the signal maximum
           - graph: True->plots curve; False->does not
 
         Outputs:
         -------
-          - Exceedance = list of % of occurences, 1D array
+          - Exceedance = list of % of occurences, 1D array,
+                         or 2D array (nrange, nnode or nele) over the whole domain
           - Ranges = list of signal amplitude bins, 1D array
 
         Notes:
         -----
           - This method is not suitable for SSE
+          - Exceedance map, i.e. % of time above 2 m/s for every element:
+            Exceedance, Ranges = exceedance(speed, ranges=2.0)
         """
         debug = (debug or self._debug)
         if debug:
             print 'Computing exceedance...'
 
         #Distinguish between 1D and 2D var
-        if len(var.shape)>1:
-            if pt_lon==[] or pt_lat==[]:
-                print 'Lon, lat coordinates are needed'
-                sys.exit()
+        if len(var.shape)>1 and not (pt_lon==[] or pt_lat==[]):
             signal = self.interpolation_at_point(var, pt_lon, pt_lat, debug=debug)
         else:
             signal=var
-        
-        Max = max(signal)	
-        dy = (Max/30.0)
-        Ranges = np.arange(0,(Max + dy), dy)
-        Exceedance = np.zeros(Ranges.shape[0])
-        dt = self._var.julianTime[1] - self._var.julianTime[0]
-        Period = var.shape[0] * dt
-        time = np.arange(0.0, Period, dt)
 
-        N = len(signal)
-        M = len(Ranges)
-
-        for i in range(M):
-            r = Ranges[i]
-            for j in range(N-1):
-                if signal[j] > r:
-                    Exceedance[i] = Exceedance[i] + (time[j+1] - time[j])
-
-        Exceedance = (Exceedance * 100) / Period
+        #Irregular time steps are accounted for
+        time = self._var.julianTime[:]
+        if not time.shape[0]==signal.shape[0]:
+            time = time[1] - time[0]
+        Exceedance, Ranges = exceedance_curve(signal, time, ranges=ranges,
+                                              debug=debug)
 
         if debug:
             print '...Passed'
-       
+
         #Plot
-        #error=np.ones(Exceedance.shape) * np.std(Exceedance)
-        #if debug: print "Error: ", str(np.std(Exceedance))
-        self._plot.plot_xy(Exceedance, Ranges, #yerror=error,
-                           yLabel='Amplitudes',
-                           xLabel='Exceedance probability in %')
+        if graph and len(signal.shape)==1:
+            #error=np.ones(Exceedance.shape) * np.std(Exceedance)
+            #if debug: print "Error: ", str(np.std(Exceedance))
+            self._plot.plot_xy(Exceedance, Ranges, #yerror=error,
+                               yLabel='Amplitudes',
+                               xLabel='Exceedance probability in %')
 
         return Exceedance, Ranges
 
-    def vorticity(self, debug=False):
+    def vorticity(self, chunk=None, processes=1, debug=False):
         """
         This method creates a new variable: 'depth averaged vorticity (1/s)'
         -> FVCOM.Variables.depth_av_vorticity
      
+        Keywords:
+        --------
+          - chunk = number of time steps computed at once, integer.
+                    Default fits loading_utils.MEM_BUDGET
+          - processes = number of processes the time chunks are spread on
+
         Notes:
         -----
           - Can take time over the full domain
+          - written to FVCOM.Variables._out_dir if defined
         """
         debug = (debug or self._debug)
         if debug:
             print 'Computing vorticity...'
             start = time.time()
 
-        t = arange(self._grid.ntime)  
-
         #Surrounding elements
-        n1 = self._grid.triele[:,0]
-        n2 = self._grid.triele[:,1]
-        n3 = self._grid.triele[:,2]
-        #TR comment: not quiet sure what this step does
-        n1[np.where(n1==0)[0]] = self._grid.trinodes.shape[1]
-        n2[np.where(n2==0)[0]] = self._grid.trinodes.shape[1]
-        n3[np.where(n3==0)[0]] = self._grid.trinodes.shape[1]
-        #TR quick fix: due to error with pydap.proxy.ArrayProxy
-        #              not able to cop with numpy.int
-        n1 = int(n1)
-        n2 = int(n2)
-        n3 = int(n3)
-
-        if debug:
-            end = time.time()
-            print "Check element=0, computation time in (s): ", (end - start)
-            print "start np.multiply" 
-        
-        dvdx = np.zeros((self._grid.ntime,self._grid.nele))
-        dudy = np.zeros((self._grid.ntime,self._grid.nele))
-
-        j=0
-        for i in t:
-            dvdx[j,:] = np.multiply(self._grid.a1u[0,:], self._var.va[i,:]) \
-                      + np.multiply(self._grid.a1u[1,:], self._var.va[i,n1]) \
-                      + np.multiply(self._grid.a1u[2,:], self._var.va[i,n2]) \
-                      + np.multiply(self._grid.a1u[3,:], self._var.va[i,n3])
-            dudy[j,:] = np.multiply(self._grid.a2u[0,:], self._var.ua[i,:]) \
-                      + np.multiply(self._grid.a2u[1,:], self._var.ua[i,n1]) \
-                      + np.multiply(self._grid.a2u[2,:], self._var.ua[i,n2]) \
-                      + np.multiply(self._grid.a2u[3,:], self._var.ua[i,n3])
-            j+=1
-        if debug:
-            print "loop number ", i
+        index = neighbour_index(self._grid.triele)
 
-        vort = dvdx - dudy
+        vort = vorticity_field(self._var.ua, self._var.va, index,
+                               self._grid.a1u, self._grid.a2u,
+                               chunk=chunk, processes=processes,
+                               filename=out_file(self._var,
+                                                 'depth_av_vorticity'),
+                               debug=debug)
 
         # Add metadata entry
         self._var.depth_av_vorticity = vort
@@ -711,7 +833,8 @@ class FunctionsFvcom:
             end = time.time()
             print "Computation time in (s): ", (end - start) 
 
-    def vorticity_over_period(self, time_ind=[], t_start=[], t_end=[], debug=False):
+    def vorticity_over_period(self, time_ind=[], t_start=[], t_end=[],
+                              chunk=None, processes=1, debug=False):
         """
         This function computes the depth averaged vorticity for a time period.
      
@@ -726,6 +849,8 @@ class FunctionsFvcom:
                      or time index as an integer
           - t_end = end time, as a string ('yyyy-mm-ddThh:mm:ss'),
                     or time index as an integer
+          - chunk = number of time steps computed at once, integer
+          - processes = number of processes the time chunks are spread on
         Notes:
         -----
           - Can take time over the full domain
@@ -743,50 +868,20 @@ class FunctionsFvcom:
             if type(t_start)==str:
                 t = time_to_index(t_start, t_end, self._var.matlabTime, debug=debug)
             else:
-                t = arange(t_start, t_end)
+                t = np.arange(t_start, t_end)
         else:
-            t = arange(self._grid.ntime)
-            self.vorticity() 
+            t = np.arange(self._grid.ntime)
+            self.vorticity(chunk=chunk, processes=processes, debug=debug)
+        t = np.asarray(t, dtype=int)
 
         #Checking if vorticity already computed
         if not hasattr(self._var, 'depth_av_vorticity'): 
             #Surrounding elements
-            n1 = self._grid.triele[:,0]
-            n2 = self._grid.triele[:,1]
-            n3 = self._grid.triele[:,2]
-            #TR comment: not quiet sure what this step does
-            n1[np.where(n1==0)[0]] = self._grid.trinodes.shape[1]
-            n2[np.where(n2==0)[0]] = self._grid.trinodes.shape[1]
-            n3[np.where(n3==0)[0]] = self._grid.trinodes.shape[1]
-            #TR quick fix: due to error with pydap.proxy.ArrayProxy
-            #              not able to cop with numpy.int
-            n1 = int(n1)
-            n2 = int(n2)
-            n3 = int(n3)
-
-            if debug:
-                end = time.time()
-                print "Check element=0, computation time in (s): ", (end - start)
-                print "start np.multiply" 
-        
-            dvdx = np.zeros((t.shape[0],self._grid.nele))
-            dudy = np.zeros((t.shape[0],self._grid.nele))
-
-            j=0
-            for i in t:
-                dvdx[j,:] = np.multiply(self._grid.a1u[0,:], self._var.va[i,:]) \
-                          + np.multiply(self._grid.a1u[1,:], self._var.va[i,n1]) \
-                          + np.multiply(self._grid.a1u[2,:], self._var.va[i,n2]) \
-                          + np.multiply(self._grid.a1u[3,:], self._var.va[i,n3])
-                dudy[j,:] = np.multiply(self._grid.a2u[0,:], self._var.ua[i,:]) \
-                          + np.multiply(self._grid.a2u[1,:], self._var.ua[i,n1]) \
-                          + np.multiply(self._grid.a2u[2,:], self._var.ua[i,n2]) \
-                          + np.multiply(self._grid.a2u[3,:], self._var.ua[i,n3])
-                j+=1
-            if debug:
-                print "loop number ", i
-
-            vort = dvdx - dudy
+            index = neighbour_index(self._grid.triele)
+            vort = vorticity_field(self._var.ua, self._var.va, index,
+                                   self._grid.a1u, self._grid.a2u,
+                                   time_index=t, chunk=chunk,
+                                   processes=processes, debug=debug)
         else:
             vort = self._var.depth_av_vorticity[t[:], :]
 
@@ -811,18 +906,11 @@ class FunctionsFvcom:
 
         print "Computing depth..."
         #Compute depth      
-        size = self._grid.nele
-        size1 = self._grid.ntime
-        size2 = self._grid.nlevel
-        elc = np.zeros((size1, size))
-        hc = np.zeros((size))
-
         try:
-            for ind, value in enumerate(self._grid.trinodes):
-                elc[:, ind] = np.mean(self._var.el[:, value], axis=1)
-                hc[ind] = np.mean(self._grid.h[value])
+            elc = node_to_element(self._var.el, self._grid.trinodes)
+            hc = node_to_element(self._grid.h, self._grid.trinodes)
 
-            dep = self._var.el[:,:] + h[None,:]
+            dep = elc[:,:] + hc[None,:]
         except MemoryError:
             print '---Data too large for machine memory---'
             print 'Tip: use ax or tx during class initialisation'
@@ -868,9 +956,8 @@ class FunctionsFvcom:
 
         #Finding index
         if index==[]:      
-            index = closest_point([pt_lon], [pt_lat],
-                                  self._grid.lonc,
-                                  self._grid.latc, debug=debug)[0]
+            index = containing_element(self._grid, [pt_lon], [pt_lat],
+                                       debug=debug)[0]
 
         if not hasattr(self._grid, 'depth2D'):
             #Compute depth
@@ -903,6 +990,8 @@ class FunctionsFvcom:
         -----
           - This may take some time to compute depending on the size
             of the data set
+          - computed by time blocks, written to FVCOM.Variables._out_dir
+            if defined
         """
         debug = (debug or self._debug)
         if debug: print "Computing depth averaged power density..."
@@ -912,7 +1001,10 @@ class FunctionsFvcom:
         if debug: print "Computing powers of hori velo norm..."
         #u = self._var.hori_velo_norm
         #pd = ne.evaluate('0.5*1025.0*(u**3)')
-        pd = 0.5*1025.0*np.power(self._var.hori_velo_norm,3.0)
+        pd = chunked_apply(lambda u: 0.5*1025.0*np.power(u,3.0),
+                           [self._var.hori_velo_norm],
+                           filename=out_file(self._var, 'depth_av_power_density'),
+                           debug=debug)
     
         # Add metadata entry
         self._var.depth_av_power_density = pd
@@ -938,55 +1030,37 @@ class FunctionsFvcom:
         Inputs:
         ------
           - power_mat = power matrix (u,Ct(u)), 2D array (2,n),
-                        u being power_mat[0,:] and Ct(u) being power_mat[1,:]
+                        u being power_mat[0,:] and Ct(u) being power_mat[1,:],
+                        or list of power matrices to assess several turbines
+                        in one pass
 
         Keywords:
         --------
-          - cut_in = cut-in speed in m/s, float number
-          - cut_out = cut-out speed in m/s, float number
+          - cut_in = cut-in speed in m/s, float number or list
+          - cut_out = cut-out speed in m/s, float number or list
 
         Notes:
         -----
           - This may take some time to compute depending on the size
             of the data set
+          - for a list of power matrices, the result is a 3D array
+            (ntime, npower_mat, nele)
+          - written to FVCOM.Variables._out_dir if defined
         """
         debug = (debug or self._debug)
-        if debug: print "Computing depth averaged power density..."
+        if debug: print "Computing depth averaged power assessment..."
+
+        if not hasattr(self._var, 'hori_velo_norm'):
+            self.hori_velo_norm(debug=debug)
 
-        if not hasattr(self._var, 'depth_av_power_density'):
-            if debug: print "Computing power density..."
-            self.depth_averaged_power_density(debug=debug)
-
-        if debug: print "Initialising power curve..."
-        Cp = interp1d(power_mat[0,:],power_mat[1,:])
-
-        u = self._var.hori_velo_norm
-        pd = self._var.depth_av_power_density
-
-        pa = Cp(u)*pd
-
-        if debug: print "finding cut-in and out..."
-        #TR comment huge bottleneck here
-        #ind = np.where(pd<pdin)[0]
-        #if not ind.shape[0]==0:
-        #    pd[ind] = 0.0
-        for i in range(pa.shape[0]):
-            for j in range(pa.shape[1]):
-                if u[i,j] < cut_in:
-                   pa[i,j] = 0.0 
-
-        paout = Cp(cut_out)*0.5*1025.0*(cut_out**3.0)
-        #TR comment huge bottleneck here
-        #ind = np.where(pd>pdout)[0]
-        #if not ind.shape[0]==0:
-        #    pd[ind] = pdout
-        for i in range(pa.shape[0]):
-            for j in range(pa.shape[1]):
-                if u[i,j] > cut_out:
-                   pa[i,j] = paout     
+        pa = power_assessment(self._var.hori_velo_norm, power_mat,
+                              cut_in=cut_in, cut_out=cut_out,
+                              filename=out_file(self._var,
+                                                'depth_av_power_assessment'),
+                              debug=debug)
 
         # Add metadata entry
-        self._var.depth_av_power_assessment = pd
+        self._var.depth_av_power_assessment = pa
         self._History.append('depth averaged power assessment computed')
         print '-Depth averaged power assessment to FVCOM.Variables.-'   
 
@@ -1037,9 +1111,8 @@ class FunctionsFvcom:
         '''
         debug = (debug or self._debug)
         #TR_comments: Add debug flag in Utide: debug=self._debug
-        index = closest_point([pt_lon], [pt_lat],
-                              self._grid.lonc,
-                              self._grid.latc, debug=debug)[0]
+        index = containing_element(self._grid, [pt_lon], [pt_lat],
+                                   debug=debug)[0]
         argtime = []
         if not time_ind==[]:
             argtime = time_ind
@@ -1080,8 +1153,172 @@ class FunctionsFvcom:
 
             return harmo
 
+    def Harmonic_analysis(self, index=[], time_ind=[], t_start=[], t_end=[],
+                          elevation=True, velocity=False, debug=False, **kwarg):
+        '''
+        Description:
+        ----------
+        This function performs a harmonic analysis on the sea surface elevation
+        or the velocity components of many locations at once, i.e. co-tidal
+        maps over the whole domain.
+
+        Outputs:
+        -------
+          - harmo = harmonic coefficients, dictionary. Per constituent
+                    quantities are arrays (nconstit, nnode or nele),
+                    i.e. harmo['A'][0,:] = amplitude map of harmo['name'][0]
+
+        Keywords:
+        --------
+          - index = node (elevation) or element (velocity) indices,
+                    list of integers. Default is the whole domain
+          - time_ind = time indices to work in, list of integers
+          - t_start = start time, as a string ('yyyy-mm-ddThh:mm:ss'),
+                     or time index as an integer
+          - t_end = end time, as a string ('yyyy-mm-ddThh:mm:ss'),
+                    or time index as an integer
+          - elevation=True means that the analysis will be done for elevation.
+          - velocity=True means that the analysis will be done for velocity.
+
+        Options:
+        -------
+        Options are the same as for ut_solv (see Harmonic_analysis_at_point)
+
+        Notes:
+        -----
+          - the design matrix is built and factorized once for the shared
+            time vector, see harmonic_utils.harmonic_analysis
+          - least squares only, i.e. same as ut_solv with method='ols'.
+            For robust fits, see Harmonic_analysis_at_point
+        '''
+        debug = (debug or self._debug)
+        argtime = slice(None)
+        if not time_ind==[]:
+            argtime = time_ind
+        elif not t_start==[]:
+            if type(t_start)==str:
+                argtime = time_to_index(t_start, t_end,
+                                        self._var.matlabTime,
+                                        debug=debug)
+            else:
+                argtime = np.arange(t_start, t_end)
+        if type(index)==list and index==[]:
+            index = slice(None)
+
+        if velocity:
+            lat = self._grid.latc[:][index]
+            harmo = harmonic_analysis(self._var.matlabTime, lat,
+                                      self._var.ua, v=self._var.va,
+                                      time_index=argtime, space_index=index,
+                                      debug=debug, **kwarg)
+
+        if elevation:
+            lat = self._grid.lat[:][index]
+            harmo = harmonic_analysis(self._var.matlabTime, lat,
+                                      self._var.el,
+                                      time_index=argtime, space_index=index,
+                                      debug=debug, **kwarg)
+
+        return harmo
+
+    def Harmonic_analysis_at_points(self, pt_lons, pt_lats,
+                                    time_ind=[], t_start=[], t_end=[],
+                                    elevation=True, velocity=False,
+                                    processes=2, checkpoint=None,
+                                    debug=False, **kwarg):
+        '''
+        Description:
+        ----------
+        This function performs a harmonic analysis on the sea surface elevation
+        time series or the velocity components timeseries of many locations,
+        ut_solv being run on a pool of processes.
+
+        Inputs:
+        ------
+          - pt_lons = longitudes in decimal degrees East, list or 1D array
+          - pt_lats = latitudes in decimal degrees North, list or 1D array
+
+        Outputs:
+        -------
+          - harmos = harmonic coefficients, list of dictionaries
+
+        Keywords:
+        --------
+          - time_ind = time indices to work in, list of integers
+          - t_start = start time, as a string ('yyyy-mm-ddThh:mm:ss'),
+                     or time index as an integer
+          - t_end = end time, as a string ('yyyy-mm-ddThh:mm:ss'),
+                    or time index as an integer
+          - elevation=True means that ut_solv will be done for elevation.
+          - velocity=True means that ut_solv will be done for velocity
+            instead of elevation.
+          - processes = number of worker processes, integer
+          - checkpoint = path of a checkpoint file. Completed locations are
+                         saved in it, so that an interrupted run can be
+                         resumed by calling this function again with the
+                         same time range and options
+
+        Options:
+        -------
+        Options are the same as for ut_solv (see Harmonic_analysis_at_point)
+
+        Notes:
+        -----
+          - the time series are interpolated at all the locations in one pass
+            and only them are sent to the workers
+          - for least squares fits over the whole domain,
+            see Harmonic_analysis
+        '''
+        debug = (debug or self._debug)
+        pt_lons = np.atleast_1d(np.asarray(pt_lons, dtype=float))
+        pt_lats = np.atleast_1d(np.asarray(pt_lats, dtype=float))
+        index = containing_element(self._grid, pt_lons, pt_lats, debug=debug)
+        argtime = slice(None)
+        if not time_ind==[]:
+            argtime = time_ind
+        elif not t_start==[]:
+            if type(t_start)==str:
+                argtime = time_to_index(t_start, t_end,
+                                        self._var.matlabTime,
+                                        debug=debug)
+            else:
+                argtime = np.arange(t_start, t_end)
+        time = self._var.matlabTime[:][argtime]
+
+        #Only the time window is read and interpolated
+        full = type(argtime)==slice and argtime==slice(None)
+        window = lambda var: var if full else var[argtime]
+        if velocity:
+            u = self.interpolation_at_points(window(self._var.ua),
+                                             pt_lons, pt_lats,
+                                             index=index, debug=debug)
+            v = self.interpolation_at_points(window(self._var.va),
+                                             pt_lons, pt_lats,
+                                             index=index, debug=debug)
+            series = [((pt_lons[i], pt_lats[i], 'uv'),
+                       u[:,i], v[:,i], pt_lats[i])
+                      for i in range(pt_lons.shape[0])]
+
+        elif elevation:
+            el = self.interpolation_at_points(window(self._var.el),
+                                              pt_lons, pt_lats,
+                                              index=index, debug=debug)
+            series = [((pt_lons[i], pt_lats[i], 'el'),
+                       el[:,i], [], pt_lats[i])
+                      for i in range(pt_lons.shape[0])]
+
+        else:
+            print "---elevation or velocity has to be True---"
+            sys.exit()
+
+        harmos = harmonic_pool(time, series, processes=processes,
+                               checkpoint=checkpoint, debug=debug, **kwarg)
+
+        return harmos
+
     def Harmonic_reconstruction(self, harmo, elevation=True, velocity=False,
-                                time_ind=slice(None), debug=False, **kwarg):
+                                time_ind=slice(None), mattime=[],
+                                filename=None, debug=False, **kwarg):
         '''
         Description:
         ----------
@@ -1092,14 +1329,21 @@ class FunctionsFvcom:
 
         Inputs:
         ------
-          - Harmo = harmonic coefficient from harmo_analysis
+          - Harmo = harmonic coefficient from harmo_analysis, or
+                    coefficients of many locations, i.e. list of them
+                    or output of Harmonic_analysis
           - elevation =True means that ut_reconstr will be done for elevation.
           - velocity =True means that ut_reconst will be done for velocity.
           - time_ind = time indices to process, list of integers
+          - mattime = matlab times to reconstruct at, 1D array.
+                      Overrides time_ind, i.e. for predictions
+          - filename = path of the *.npy file the reconstruction of many
+                       locations is written to, None to keep it in memory
         
         Output:
         ------         
-          - Reconstruct = reconstructed signal, dictionary
+          - Reconstruct = reconstructed signal, dictionary. For many
+                          locations, arrays (ntime, nlocation)
 
         Options:
         -------
@@ -1111,17 +1355,34 @@ class FunctionsFvcom:
         -----
         For more detailed information about ut_reconstr, please see
         https://github.com/wesleybowman/UTide
+        Many locations are reconstructed at once by matrix products over
+        time blocks, see harmonic_utils.harmonic_reconstruction. In that
+        case, only the cnstit option applies and velocity=True takes
+        precedence over elevation.
 
         '''
         debug = (debug or self._debug)
-        time = self._var.matlabTime[time_ind]
+        if not len(mattime)==0:
+            time = np.asarray(mattime)
+        else:
+            time = self._var.matlabTime[time_ind]
         #TR_comments: Add debug flag in Utide: debug=self._debug
         Reconstruct = {}
+        if type(harmo)==list or np.ndim(harmo['g'])>1:
+            #Many locations at once
+            recon = harmonic_reconstruction(time, harmo,
+                                            cnstit=kwarg.get('cnstit', []),
+                                            filename=filename, debug=debug)
+            if velocity:
+                Reconstruct['U'], Reconstruct['V'] = recon
+            elif elevation:
+                Reconstruct['el'] = recon
+            return Reconstruct
         if velocity:
-            U_recon, V_recon = ut_reconstr(time,harmo)
+            U_recon, V_recon = ut_reconstr(time,harmo,**kwarg)
             Reconstruct['U'] = U_recon
             Reconstruct['V'] = V_recon
         if elevation:
-            elev_recon, _ = ut_reconstr(time,harmo)
+            elev_recon, _ = ut_reconstr(time,harmo,**kwarg)
             Reconstruct['el'] = elev_recon
         return Reconstruct  
@@ -11,6 +11,12 @@ from scipy.interpolate import interp1d
 from interpolation_utils import *
 from miscellaneous import *
 from BP_tools import *
+from loading_utils import chunked_apply, out_file
+from grid_operators import neighbour_index, vorticity_field
+from grid_operators import depth_interpolation
+from grid_operators import node_to_element, DepthField
+import loading_utils
+from power_utils import power_assessment
 from shortest_element_path import *
 import time
 import seaborn
@@ -32,6 +38,7 @@ class FunctionsFvcomThreeD:
         self._History = History
         self._util = util
         self.interpolation_at_point = self._util.interpolation_at_point
+        self.interpolation_at_points = self._util.interpolation_at_points
         self.hori_velo_norm = self._util.hori_velo_norm
 
         #Create pointer to FVCOM class
@@ -39,11 +46,17 @@ class FunctionsFvcomThreeD:
         grid = self._grid
         History = self._History
 
-    def depth(self, debug=False):
+    def depth(self, lazy=False, debug=False):
         """
         This method computes new grid variable: 'depth' (m)
         -> FVCOM.Grid.depth
 
+        Keywords:
+        --------
+          - lazy = if True, FVCOM.Grid.depth is a DepthField computing
+                   the depth of the requested time steps on access,
+                   i.e. FVCOM.Grid.depth[t0:t1], instead of a stored array
+
         Notes:
         -----
           - depth convention: 0 = free surface
@@ -55,22 +68,11 @@ class FunctionsFvcomThreeD:
 
         print "Computing depth..."
         #Compute depth      
-        size = self._grid.nele
-        size1 = self._grid.ntime
-        size2 = self._grid.nlevel
-        elc = np.zeros((size1, size))
-        hc = np.zeros((size))
-        siglay = np.zeros((size2, size))
-
         try:
-            for ind, value in enumerate(self._grid.trinodes):
-                elc[:, ind] = np.mean(self._var.el[:, value], axis=1)
-                hc[ind] = np.mean(self._grid.h[value])
-                siglay[:,ind] = np.mean(self._grid.siglay[:,value],1)
-
-            #zeta = self._var.el[:,:] + self._grid.h[None,:]
-            zeta = elc[:,:] + hc[None,:]
-            dep = zeta[:,None,:]*siglay[None,:,:]
+            dep = DepthField(self._var.el, self._grid.h, self._grid.siglay,
+                             self._grid.trinodes)
+            if not lazy:
+                dep = dep[:]
         except MemoryError:
             print '---Data too large for machine memory---'
             print 'Tip: use ax or tx during class initialisation'
@@ -117,9 +119,8 @@ class FunctionsFvcomThreeD:
 
         #Finding index
         if index==[]:      
-            index = closest_point([pt_lon], [pt_lat],
-                                  self._grid.lonc,
-                                  self._grid.latc, debug=debug)[0]
+            index = containing_element(self._grid, [pt_lon], [pt_lat],
+                                       debug=debug)[0]
 
         if not hasattr(self._grid, 'depth'):
             #Compute depth
@@ -150,7 +151,7 @@ class FunctionsFvcomThreeD:
         ------
           - var = 3 dimensional (time, sigma level, element) variable, array
           - depth = interpolation depth (float in meters), negative from
-                    water column top downwards
+                    water column top downwards, or list of depths
         Keywords:
         --------
           - ind = array of closest indexes to depth, 2D array (ntime, nele)
@@ -159,6 +160,11 @@ class FunctionsFvcomThreeD:
         ------
           - interpVar = 2 dimensional (time, element) variable, masked array
           - ind = array of closest indexes to depth, 2D array (ntime, nele)
+
+        Notes:
+        -----
+          - for a list of depths, interpVar and ind are 3D arrays
+            (ntime, ndepth, nele), all depths being computed in one pass
         """
         debug = debug or self._debug
         if debug: print 'Interpolating at '+str(depth)+' meter depth...'
@@ -166,43 +172,38 @@ class FunctionsFvcomThreeD:
         #checking if depth field already calculated
         if not hasattr(self._grid, 'depth'):
             self.depth()
-        dep = self._grid.depth - depth
-        #Finding closest values to specified depth
-        if ind==[]:
-            if debug: print 'Finding closest indexes to depth...'
-            ind = np.zeros((dep.shape[0],dep.shape[2]))
-            for i in range(dep.shape[0]):
-                for k in range(dep.shape[2]):
-                    test = dep[i,:,k]
-                    if not test[test>0.0].shape==test.shape:
-                        ind[i,k] = test[test>0.0].argmin()
-                    else:
-                        ind[i,k] = np.nan
-                    
-        inddown = ind + 1
-
-        if debug: print 'Computing weights...'
-        #weight matrix & interp
-        interpVar = np.ones((var.shape[0], var.shape[2]))*np.nan
-        for i in range(ind.shape[0]):
-            for j in range(ind.shape[1]):
-                iU = ind[i,j]
-                iD = inddown[i,j]
-                if not np.isnan(iU):       
-                    length = np.abs(self._grid.depth[i,iU,j]\
-                                  - self._grid.depth[i,iD,j])
-                    wU = np.abs(depth - self._grid.depth[i,iU,j])/length
-                    wD = np.abs(depth - self._grid.depth[i,iD,j])/length
-                    interpVar[i,j] = (wU * var[i,iU,j]) + (wD * var[i,iD,j])
-                else:
-                    interpVar[i,j] = np.nan
+        single = np.ndim(depth)==0
+        depths = np.atleast_1d(np.asarray(depth, dtype=float))
+        ntime = var.shape[0]
+        indIn = None
+        if not (type(ind)==list and ind==[]):
+            indIn = np.asarray(ind, dtype=float).reshape((ntime, depths.shape[0],
+                                                          var.shape[2]))
+
+        #Time blocks
+        stepBytes = 8 * var.shape[1] * var.shape[2] * (4 + depths.shape[0])
+        chunk = max(1, int(loading_utils.MEM_BUDGET // stepBytes))
+        interpVar = np.empty((ntime, depths.shape[0], var.shape[2]))
+        indOut = np.empty((ntime, depths.shape[0], var.shape[2]))
+        for t0 in range(0, ntime, chunk):
+            t1 = min(t0 + chunk, ntime)
+            if debug: print 'Time steps: ' + str(t0) + '-' + str(t1)
+            indBlock = None
+            if not indIn is None:
+                indBlock = indIn[t0:t1]
+            interpVar[t0:t1], indOut[t0:t1] = depth_interpolation(
+                var[t0:t1], self._grid.depth[t0:t1], depths, ind=indBlock)
+
+        if single:
+            interpVar = interpVar[:,0,:]
+            indOut = indOut[:,0,:]
 
         if debug: print 'Computing nan mask...'
         interpVar = np.ma.masked_array(interpVar,np.isnan(interpVar))
 
         if debug: print '...Passed'
 
-        return interpVar, ind
+        return interpVar, indOut
 
     def verti_shear(self, debug=False):
         """
@@ -297,9 +298,8 @@ class FunctionsFvcomThreeD:
                 argtime = np.arange(t_start, t_end) 
 
         # Finding closest point
-        index = closest_point([pt_lon], [pt_lat],
-                              self._grid.lonc,
-                              self._grid.latc, debug=debug)[0]
+        index = containing_element(self._grid, [pt_lon], [pt_lat],
+                                   debug=debug)[0]
         #Compute depth
         depth = self.depth_at_point(pt_lon, pt_lat, index=index, debug=debug)       
 
@@ -361,33 +361,32 @@ class FunctionsFvcomThreeD:
         Notes:
         -----
           -Can take time over the full domain
+          -computed by time blocks, written to FVCOM.Variables._out_dir
+           if defined
         """
-        if debug or self._debug:
+        debug = debug or self._debug
+        if debug:
             print 'Computing velocity norm...'
-        #Check if w if there
+        filename = out_file(self._var, 'velo_norm')
         try:
-            try:
+            #Check if w if there
+            if hasattr(self._var, 'w'):
                 #Computing velocity norm
-                u = self._var.u[:]
-                v = self._var.v[:]
-                w = self._var.w[:]
-                vel = ne.evaluate('sqrt(u**2 + v**2 + w**2)')
-            except MemoryError:
-                print '---Data too large for machine memory---'
-                print 'Tip: use ax or tx during class initialisation'
-                print '---  to use partial data'
-                raise
-        except AttributeError:
-            try:
+                vel = chunked_apply(
+                      lambda u, v, w: ne.evaluate('sqrt(u**2 + v**2 + w**2)'),
+                      [self._var.u, self._var.v, self._var.w],
+                      filename=filename, debug=debug)
+            else:
                 #Computing velocity norm
-                u = self._var.u[:]
-                v = self._var.v[:]
-                vel = ne.evaluate('sqrt(u**2 + v**2)')
-            except MemoryError:
-                print '---Data too large for machine memory---'
-                print 'Tip: use ax or tx during class initialisation'
-                print '---  to use partial data'
-                raise
+                vel = chunked_apply(
+                      lambda u, v: ne.evaluate('sqrt(u**2 + v**2)'),
+                      [self._var.u, self._var.v],
+                      filename=filename, debug=debug)
+        except MemoryError:
+            print '---Data too large for machine memory---'
+            print 'Tip: use ax or tx during class initialisation'
+            print '---  to use partial data, or out_dir to work out-of-core'
+            raise
 
         #Custom return    
         self._var.velo_norm = vel 
@@ -455,9 +454,8 @@ class FunctionsFvcomThreeD:
 
 
         # Finding closest point
-        index = closest_point([pt_lon], [pt_lat],
-                              self._grid.lonc,
-                              self._grid.latc, debug=debug)[0]
+        index = containing_element(self._grid, [pt_lon], [pt_lat],
+                                   debug=debug)[0]
 
         #Computing horizontal velocity norm
         if debug:
@@ -521,9 +519,8 @@ class FunctionsFvcomThreeD:
             print 'Computing flow directions at point...'
 
         # Finding closest point
-        index = closest_point([pt_lon], [pt_lat],
-                              self._grid.lonc,
-                              self._grid.latc, debug=debug)[0]
+        index = containing_element(self._grid, [pt_lon], [pt_lat],
+                                   debug=debug)[0]
 
         # Find time interval to work in
         argtime = []
@@ -605,56 +602,35 @@ class FunctionsFvcomThreeD:
         if debug or self._debug:
             print '...Passed'
 
-    def vorticity(self, debug=False):
+    def vorticity(self, chunk=None, processes=1, debug=False):
         """
         This method creates a new variable: 'depth averaged vorticity' (1/s)
         -> FVCOM.Variables.vorticity
      
+        Keywords:
+        --------
+          - chunk = number of time steps computed at once, integer.
+                    Default fits loading_utils.MEM_BUDGET
+          - processes = number of processes the time chunks are spread on
+
         Notes:
         -----
           - Can take time over the full domain
+          - written to FVCOM.Variables._out_dir if defined
         """
         debug = (debug or self._debug)
         if debug:
             print 'Computing vorticity...'
             start = time.time()
 
-        t = arange(self._grid.ntime)  
-
         #Surrounding elements
-        n1 = self._grid.triele[:,0]
-        n2 = self._grid.triele[:,1]
-        n3 = self._grid.triele[:,2]
-        #TR comment: not quiet sure what this step does
-        n1[np.where(n1==0)[0]] = self._grid.trinodes.shape[1]
-        n2[np.where(n2==0)[0]] = self._grid.trinodes.shape[1]
-        n3[np.where(n3==0)[0]] = self._grid.trinodes.shape[1]
-        if debug:
-            end = time.time()
-            print "Check element=0, computation time in (s): ", (end - start)
-            print "start np.multiply" 
-
-        x0 = self._grid.xc
-        y0 = self._grid.yc
-        
-        dvdx = np.zeros((self._grid.ntime,self._grid.nlevel,self._grid.nele))
-        dudy = np.zeros((self._grid.ntime,self._grid.nlevel,self._grid.nele))
-
-        j=0
-        for i in t:
-            dvdx[j,:,:] = np.multiply(self._grid.a1u[0,:], self._var.v[i,:,:]) \
-                        + np.multiply(self._grid.a1u[1,:], self._var.v[i,:,n1]) \
-                        + np.multiply(self._grid.a1u[2,:], self._var.v[i,:,n2]) \
-                        + np.multiply(self._grid.a1u[3,:], self._var.v[i,:,n3])
-            dudy[j,:,:] = np.multiply(self._grid.a2u[0,:], self._var.u[i,:,:]) \
-                        + np.multiply(self._grid.a2u[1,:], self._var.u[i,:,n1]) \
-                        + np.multiply(self._grid.a2u[2,:], self._var.u[i,:,n2]) \
-                        + np.multiply(self._grid.a2u[3,:], self._var.u[i,:,n3])
-            j+=1
-        if debug:
-            print "loop number ", i
+        index = neighbour_index(self._grid.triele)
 
-        vort = dvdx - dudy
+        vort = vorticity_field(self._var.u, self._var.v, index,
+                               self._grid.a1u, self._grid.a2u,
+                               chunk=chunk, processes=processes,
+                               filename=out_file(self._var, 'vorticity'),
+                               debug=debug)
 
         # Add metadata entry
         self._var.vorticity = vort
@@ -665,13 +641,14 @@ class FunctionsFvcomThreeD:
             end = time.time()
             print "Computation time in (s): ", (end - start) 
 
-    def vorticity_over_period(self, time_ind=[], t_start=[], t_end=[], debug=False):
+    def vorticity_over_period(self, time_ind=[], t_start=[], t_end=[],
+                              chunk=None, processes=1, debug=False):
         """
         This function computes the vorticity for a time period.
      
         Outputs:
         -------
-          - vort = horizontal vorticity (1/s), 2D array (time, nele)
+          - vort = horizontal vorticity (1/s), 3D array (time, nlevel, nele)
 
         Keywords:
         -------
@@ -680,6 +657,8 @@ class FunctionsFvcomThreeD:
                       or time index as an integer
           - t_end = end time, as a string ('yyyy-mm-ddThh:mm:ss'),
                     or time index as an integer
+          - chunk = number of time steps computed at once, integer
+          - processes = number of processes the time chunks are spread on
         Notes:
         -----
           - Can take time over the full domain
@@ -697,46 +676,19 @@ class FunctionsFvcomThreeD:
             if type(t_start)==str:
                 t = time_to_index(t_start, t_end, self._var.matlabTime, debug=debug)
             else:
-                t = arange(t_start, t_end)
+                t = np.arange(t_start, t_end)
         else:
-            t = arange(self._grid.ntime)  
+            t = np.arange(self._grid.ntime)  
+        t = np.asarray(t, dtype=int)
 
         #Checking if vorticity already computed
         if not hasattr(self._var, 'vorticity'): 
             #Surrounding elements
-            n1 = self._grid.triele[:,0]
-            n2 = self._grid.triele[:,1]
-            n3 = self._grid.triele[:,2]
-            #TR comment: not quiet sure what this step does
-            n1[np.where(n1==0)[0]] = self._grid.trinodes.shape[1]
-            n2[np.where(n2==0)[0]] = self._grid.trinodes.shape[1]
-            n3[np.where(n3==0)[0]] = self._grid.trinodes.shape[1]
-            if debug:
-                end = time.time()
-                print "Check element=0, computation time in (s): ", (end - start)
-                print "start np.multiply" 
-
-            x0 = self._grid.xc
-            y0 = self._grid.yc
-        
-            dvdx = np.zeros((t.shape[0],self._grid.nlevel,self._grid.nele))
-            dudy = np.zeros((t.shape[0],self._grid.nlevel,self._grid.nele))
-
-            j=0
-            for i in t:
-                dvdx[j,:,:] = np.multiply(self._grid.a1u[0,:], self._var.v[i,:,:]) \
-                          + np.multiply(self._grid.a1u[1,:], self._var.v[i,:,n1]) \
-                          + np.multiply(self._grid.a1u[2,:], self._var.v[i,:,n2]) \
-                          + np.multiply(self._grid.a1u[3,:], self._var.v[i,:,n3])
-                dudy[j,:,:] = np.multiply(self._grid.a2u[0,:], self._var.u[i,:,:]) \
-                          + np.multiply(self._grid.a2u[1,:], self._var.u[i,:,n1]) \
-                          + np.multiply(self._grid.a2u[2,:], self._var.u[i,:,n2]) \
-                          + np.multiply(self._grid.a2u[3,:], self._var.u[i,:,n3])
-                j+=1
-            if debug:
-                print "loop number ", i
-
-            vort = dvdx - dudy
+            index = neighbour_index(self._grid.triele)
+            vort = vorticity_field(self._var.u, self._var.v, index,
+                                   self._grid.a1u, self._grid.a2u,
+                                   time_index=t, chunk=chunk,
+                                   processes=processes, debug=debug)
         else:
             vort = self._var.vorticity[t[:],:,:]
 
@@ -757,6 +709,8 @@ class FunctionsFvcomThreeD:
         -----
           - This may take some time to compute depending on the size
             of the data set
+          - computed by time blocks, written to FVCOM.Variables._out_dir
+            if defined
         """
         debug = (debug or self._debug)
         if debug: print "Computing power density..."
@@ -766,7 +720,10 @@ class FunctionsFvcomThreeD:
         if debug: print "Computing power density variable..."
         #u = self._var.velo_norm
         #pd = ne.evaluate('0.5*1025.0*(u**3)')
-        pd = 0.5*1025.0*np.power(self._var.velo_norm,3.0)  
+        pd = chunked_apply(lambda u: 0.5*1025.0*np.power(u,3.0),
+                           [self._var.velo_norm],
+                           filename=out_file(self._var, 'power_density'),
+                           debug=debug)
 
         # Add metadata entry
         self._var.power_density = pd
@@ -791,17 +748,21 @@ class FunctionsFvcomThreeD:
         Inputs:
         ------
           - power_mat = power matrix (u,Ct(u)), 2D array (2,n),
-                        u being power_mat[0,:] and Ct(u) being power_mat[1,:]
+                        u being power_mat[0,:] and Ct(u) being power_mat[1,:],
+                        or list of power matrices to assess several turbines
+                        in one pass
           - depth = given depth from the surface, float
 
         Output:
         ------
-          - pa = power assessment in (W/m2), 2D masked array (ntime, nele)
+          - pa = power assessment in (W/m2), 2D array (ntime, nele) or,
+                 for a list of power matrices, 3D array
+                 (ntime, npower_mat, nele)
 
         Keywords:
         --------
-          - cut_in = cut-in speed in m/s, float number
-          - cut_out = cut-out speed in m/s, float number
+          - cut_in = cut-in speed in m/s, float number or list
+          - cut_out = cut-out speed in m/s, float number or list
 
         Notes:
         -----
@@ -814,35 +775,12 @@ class FunctionsFvcomThreeD:
         if not hasattr(self._var, 'power_density'):
             self.power_density(debug=debug)
 
-        if debug: print "Initialising power curve..."
-        Cp = interp1d(power_mat[0,:],power_mat[1,:])
-
         u, ind = self.interp_at_depth(self._var.velo_norm, depth, debug=debug)
         pd, ind2 = self.interp_at_depth(self._var.power_density, depth,
                                                    ind=ind, debug=debug)
 
-        pa = Cp(u)*pd
-
-        if debug: print "finding cut-in..."
-        #TR comment huge bottleneck here
-        #ind = np.where(pd<pdin)[0]
-        #if not ind.shape[0]==0:
-        #    pd[ind] = 0.0
-        for i in range(pa.shape[0]):
-            for j in range(pa.shape[1]):
-                if u[i,j] < cut_in:
-                   pa[i,j] = 0.0 
-
-        if debug: print "finding cut-out..."
-        paout = Cp(cut_out)*0.5*1025.0*(cut_out**3.0)
-        #TR comment huge bottleneck here
-        #ind = np.where(pd>pdout)[0]
-        #if not ind.shape[0]==0:
-        #    pd[ind] = pdout
-        for i in range(pa.shape[0]):
-            for j in range(pa.shape[1]):
-                if u[i,j] > cut_out:
-                   pa[i,j] = paout     
+        pa = power_assessment(u, power_mat, cut_in=cut_in, cut_out=cut_out,
+                              pd=pd, debug=debug)
 
         return pa 
 
@@ -881,7 +819,7 @@ class FunctionsFvcomThreeD:
             lons = [start_pt[0], end_pt[0]]
             lats = [start_pt[1], end_pt[1]]
             #Finding the closest elements to start and end points
-            ind = closest_point(lons, lats, self._grid.lonc, self._grid.latc, debug)
+            ind = closest_element(self._grid, lons, lats, debug=debug)
 
             #Finding the shortest path between start and end points
             if debug : print "Computing shortest path..."
@@ -21,6 +21,8 @@ sys.path.append('../utilities/')
 #Utility import
 from shortest_element_path import shortest_element_path
 from object_from_dict import ObjectFromDict
+from store_utils import save_store, load_store
+from loading_utils import subdomain_key, check_time_axis, TimeConcat
 
 #Local import
 from variablesFvcom import _load_var, _load_grid
@@ -47,7 +49,8 @@ Inputs:
 ------
   - filename = path to file, string, 
                ex: testFvcom=FVCOM('./path_to_FVOM_output_file/filename').
-               Note that the file can be a pickle file (i.e. *.p)
+               Note that the file can be a pickle file (i.e. *.p),
+               a store saved with Save_as (i.e. *.store, memory-mapped)
                or a netcdf file (i.e. *.nc).
                Additionally, either a file path or a OpenDap url could be used. 
 
@@ -56,17 +59,43 @@ Options:
   - ax = defines for a specific spatial region to work with, as such:
              ax = [minimun longitude, maximun longitude,
                  minimun latitude, maximum latitude]
+         or a polygon as a list of (longitude, latitude) vertices:
+             ax = [(lon1, lat1), (lon2, lat2), (lon3, lat3), ...]
          or use one of the following pre-defined region:
              ax = 'GP', 'PP', 'DG' or 'MP'
          Note that this option permits to extract partial data from the overall file
          and therefore reduce memory and cpu use.
 
+  - inside = if True, only the elements whose three nodes are within ax
+             are kept, otherwise every element touching ax is kept
+
   - tx = defines for a specific temporal period to work with, as such:
              tx = ['2012-11-07T12:00:00','2012.11.09T12:00:00'],
          string of 'yyyy-mm-ddThh:mm:ss'.
          Note that this option permits to extract partial data from the overall file
          and therefore reduce memory and cpu use.
 
+  - mem_budget = maximum size in bytes of a single read when loading local
+                 files, integer. Default is loading_utils.MEM_BUDGET
+
+  - lazy = if True, variables of local files are read on first access
+           and sliced without pulling the full array, i.e. FVCOM.Variables.u
+           is a LazyVariable. Read data are kept in a cache bounded by
+           loading_utils.CACHE_BUDGET bytes (FVCOM.Variables._cache).
+
+  - cache = if True, the re-indexed grid and the variables extracted with
+            ax and/or tx from local files are cached in
+            loading_utils.SUBDOMAIN_CACHE_DIR, so that re-opening the same
+            file with the same ax, inside and tx reads them back from a single
+            compact file. Cache entries are keyed by the file path, size and
+            modification time, ax, inside, tx and the cache format version.
+
+  - out_dir = directory in which derived fields over the whole domain,
+              i.e. FVCOM.Variables.hori_velo_norm, are computed by time blocks
+              and written as memory-mapped *.npy files, so that they do not
+              need to fit in memory. File names are unique, i.e.
+              hori_velo_norm_XXXXXX.npy, so that the directory can be shared.
+
 Notes:
 -----
   Throughout the package, the following conventions apply:
@@ -77,20 +106,32 @@ Notes:
   - Depth = 0m is the free surface and depth is negative
     '''
 
-    def __init__(self, filename, ax=[], tx=[], debug=False):
+    def __init__(self, filename, ax=[], tx=[], inside=False, mem_budget=None,
+                 lazy=False, cache=False, out_dir=None, debug=False):
         ''' Initialize FVCOM class.'''
         self._debug = debug
         if debug:
             print '-Debug mode on-'
 
-        #Loading pickle file
-        if filename.endswith('.p'):
-            f = open(filename, "rb")
-            data = pkl.load(f)
+        #Loading pickle file or npy-store
+        if filename.endswith('.p') or filename.rstrip('/').endswith('.store'):
+            if filename.endswith('.p'):
+                f = open(filename, "rb")
+                data = pkl.load(f)
+            else:
+                if debug: print "Memory-mapping store..."
+                data = load_store(filename.rstrip('/'), debug=debug)
             self._origin_file = data['Origin']
             self.History = data['History']
             if debug: print "Turn keys into attributs"
             self.Grid = ObjectFromDict(data['Grid'])
+            #Files saved before triele became 0-based, i.e. 0 standing for
+            #no neighbour, have no convention marker
+            if hasattr(self.Grid, 'triele') and \
+               not getattr(self.Grid, '_triele_base', 1)==0:
+                if debug: print "Converting triele to 0-based indices..."
+                self.Grid.triele = np.asarray(self.Grid.triele) - 1
+                self.Grid._triele_base = 0
             self.Variables = ObjectFromDict(data['Variables'])
             try:
                 if self._origin_file.startswith('http'):
@@ -136,11 +177,21 @@ Notes:
                 self.Grid = _load_grid(self.Data,
                                        ax,
                                        self.History,
+                                       filename=filename,
+                                       inside=inside,
+                                       cache=cache,
                                        debug=self._debug)
+                cache_key = None
+                if cache and not (ax==[] and tx==[]):
+                    cache_key = subdomain_key(filename, 'var', ax, inside, tx)
                 self.Variables = _load_var(self.Data,
                                            self.Grid,
                                            tx,
                                            self.History,
+                                           mem_budget=mem_budget,
+                                           lazy=lazy,
+                                           cache_key=cache_key,
+                                           out_dir=out_dir,
                                            debug=self._debug)
             except MemoryError:
                 print '---Data too large for machine memory---'
@@ -155,6 +206,10 @@ Notes:
             print "---Wrong file format---"
             sys.exit()
 
+        self._set_utilities()
+
+    def _set_utilities(self):
+        """Creates the Plots, Util2D and Util3D subsets"""
         self.Plots = PlotsFvcom(self.Variables,
                                 self.Grid,
                                 self._debug)
@@ -186,6 +241,8 @@ Notes:
             same spatial domain
           - last time step of fvcom1 must be <= to the 
             first time step of fvcom2 
+          - fvcom1 and fvcom2 are left untouched: the stacked variables
+            are TimeConcat views of their variables, i.e. nothing is copied
         """
         debug = debug or self._debug
         #Define bounding box
@@ -211,14 +268,18 @@ Notes:
             print "---Data dimensions do not match---"
             sys.exit()
         else:
-            if not (self.Variables.julianTime[-1]<=
-                    FvcomClass.Variables.julianTime[0]):
-                print "---Data not consecutive in time---"
+            problem = check_time_axis([self.Variables.julianTime,
+                                       FvcomClass.Variables.julianTime])
+            if not problem is None:
+                print "---Data not consecutive in time: " + problem + "---"
                 sys.exit()
-            #Copy self to newself
+            #Copy self to newself, without sharing the stacked attributs
             newself = copy.copy(self)
-            #TR comment: it still points toward self and modifies it
-            #            so cannot do fvcom3 = fvcom1 + fvcom2
+            newself.Grid = copy.copy(self.Grid)
+            newself.Variables = copy.copy(self.Variables)
+            newself.History = self.History[:]
+            newself.Grid._History = newself.History
+            newself.Variables._History = newself.History
             if debug:
                 print 'Stacking variables...'
             #keyword list for hstack
@@ -229,14 +290,14 @@ Notes:
                 setattr(newself.Variables, key,
                 np.hstack((tmpN[:], tmpO[:])))
 
-            #keyword list for vstack
+            #keyword list for time concatenation
             kwl=['u', 'v', 'w', 'ua', 'va', 'el', 'tke', 'gls']
             for key in kwl:
                 try:
                     tmpN = getattr(newself.Variables, key)
                     tmpO = getattr(FvcomClass.Variables, key)
                     setattr(newself.Variables, key,
-                    np.vstack((tmpN[:], tmpO[:])))          
+                    TimeConcat([tmpN, tmpO]))
                 except AttributeError:
                     continue
             #New time dimension
@@ -245,6 +306,7 @@ Notes:
             text = 'Data from ' + FvcomClass.History[0].split('/')[-1] \
                  + ' has been stacked'
             newself.History.append(text)
+            newself._set_utilities()
 
         return newself  
    
@@ -254,6 +316,7 @@ Notes:
         This method saves the current FVCOM structure as:
            - *.p, i.e. python file
            - *.mat, i.e. Matlab file
+           - *.store, i.e. folder of *.npy files and json manifest
 
         Inputs:
         ------
@@ -261,7 +324,14 @@ Notes:
 
         Keywords:
         --------
-          - fileformat = format of the file to be saved, i.e. 'pickle' or 'matlab'
+          - fileformat = format of the file to be saved, i.e. 'pickle', 'matlab'
+                         or 'npy-store'
+
+        Notes:
+        -----
+          - 'npy-store' writes each array in its own *.npy file, so that
+            re-opening the *.store folder memory-maps them instead of
+            reading everything in memory, see store_utils
         """
         debug = debug or self._debug
         if debug:
@@ -274,6 +344,8 @@ Notes:
             lat = self.Grid.lat[:]
             self.Grid._ax = [lon.min(), lon.max(),
                              lat.min(), lat.max()]
+        #Convention marker of triele, see FVCOM.__init__
+        self.Grid._triele_base = 0
         #Save as different formats
         if fileformat=='pickle':
             filename = filename + ".p"
@@ -286,17 +358,20 @@ Notes:
             #TR: Force caching Variables otherwise error during loading
             #    with 'netcdf4.Variable' type (see above)
             for key in data['Variables']:
-                listkeys=['Variable', 'ArrayProxy', 'BaseType'] 
+                listkeys=['Variable', 'ArrayProxy', 'BaseType', 'LazyVariable',
+                          'DepthField', 'TimeConcat'] 
                 if any([type(data['Variables'][key]).__name__==x for x in listkeys]):
                     if debug:
                         print "Force caching for " + key
                     data['Variables'][key] = data['Variables'][key][:]
             #Unpickleable objects
             data['Grid'].pop("triangle", None)
+            data['Grid'].pop("_spatial_index", None)
             #TR: Force caching Variables otherwise error during loading
             #    with 'netcdf4.Variable' type (see above)
             for key in data['Grid']:
-                listkeys=['Variable', 'ArrayProxy', 'BaseType'] 
+                listkeys=['Variable', 'ArrayProxy', 'BaseType', 'LazyVariable',
+                          'DepthField', 'TimeConcat'] 
                 if any([type(data['Grid'][key]).__name__==x for x in listkeys]):
                     if debug:
                         print "Force caching for " + key
@@ -317,6 +392,16 @@ Notes:
                     sys.exit()
            
             f.close()
+        elif fileformat=='npy-store':
+            filename = filename + ".store"
+            data = {}
+            data['Origin'] = self._origin_file
+            data['History'] = self.History
+            data['Grid'] = self.Grid.__dict__
+            data['Variables'] = self.Variables.__dict__
+            if debug:
+                print 'Writing npy files...'
+            save_store(filename, data, debug=debug)
         elif fileformat=='matlab':
             filename = filename + ".mat"
             #TR comment: based on MitchellO'Flaherty-Sproul's code
@@ -331,7 +416,8 @@ Notes:
             #TR: Force caching Variables otherwise error during loading
             #    with 'netcdf4.Variable' type (see above)
             for key in Var:
-                listkeys=['Variable', 'ArrayProxy', 'BaseType'] 
+                listkeys=['Variable', 'ArrayProxy', 'BaseType', 'LazyVariable',
+                          'DepthField', 'TimeConcat'] 
                 if any([type(Var[key]).__name__==x for x in listkeys]):
                     if debug:
                         print "Force caching for " + key
@@ -341,8 +427,10 @@ Notes:
                 data[key] = Var[key]
             #Unpickleable objects
             Grd.pop("triangle", None)
+            Grd.pop("_spatial_index", None)
             for key in Grd:
-                listkeys=['Variable', 'ArrayProxy', 'BaseType'] 
+                listkeys=['Variable', 'ArrayProxy', 'BaseType', 'LazyVariable',
+                          'DepthField', 'TimeConcat'] 
                 if any([type(Grd[key]).__name__==x for x in listkeys]):
                     if debug:
                         print "Force caching for " + key
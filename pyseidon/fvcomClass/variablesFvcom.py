@@ -5,12 +5,14 @@ from __future__ import division
 #from jdcal import gcal2jd
 import numpy as np
 import matplotlib.tri as Tri
-from itertools import groupby
-from operator import itemgetter
 #Local import
 from regioner import *
 from miscellaneous import time_to_index
 from miscellaneous import mattime_to_datetime
+import loading_utils
+from loading_utils import load_slab, transfer_rate, LazyVariable, LRUCache
+from loading_utils import subdomain_key, load_subdomain, save_subdomain
+from loading_utils import load_ranges
 
 class _load_var:
     """
@@ -41,8 +43,21 @@ Some others shall be generated as methods are being called, ex:
                   |               3D array (ntime, nlevel, nele)
                   |_vorticity...            
     """
-    def __init__(self, data, grid, tx, History, debug=False):
+    def __init__(self, data, grid, tx, History, mem_budget=None, lazy=False,
+                 cache_key=None, out_dir=None, debug=False):
         self._debug = debug
+        #Out-of-core derived fields, see loading_utils.chunked_apply
+        self._out_dir = out_dir
+        #Sub-domain cache entry of the extracted variables
+        self._cache_key = cache_key
+        #Loading statistics
+        self._load_stats = {'bytes': 0, 'seconds': 0.0}
+        self._remote_stats = {'requests': 0, 'bytes': 0, 'overfetch': 0,
+                              'seconds': 0.0}
+        #On-demand loading
+        self._lazy = lazy
+        if lazy:
+            self._cache = LRUCache()
         #Pointer to History
         self._History = History
         History = self._History
@@ -108,56 +123,9 @@ Some others shall be generated as methods are being called, ex:
 
                 #Not OpenDap
                 else:
-                    #loading hori data
-                    keyCount = 0
-                    for key, aliaS in zip(kwl2D, al2D):
-                        try:
-                            if key=='zeta':
-                                setattr(self, aliaS, np.zeros((grid.ntime, grid.nnode)))
-                            else:
-                                setattr(self, aliaS, np.zeros((grid.ntime, grid.nele)))
-                            I = 0
-                            for i in region_t:
-                                #TR comment: looping on time indices is a trick from
-                                #            Mitchell to improve loading time
-                                #TR comment: no idea why I have to transpose here but
-                                #            I do !!
-                                getattr(self, aliaS)[I,:] =\
-                                        np.transpose(data.variables[key].data[i,:])
-                                I += 1
-                            keyCount +=1
-                        except KeyError:
-                            if debug: print key, " is missing !"
-                            continue
-                    if keyCount==0:
-                        print "---Horizontal variables are missing---"
-                    self._3D = False 
-                    
-                    #loading verti data
-                    keyCount = 0
-                    for key, aliaS in zip(kwl3D, al3D):
-                        try:
-                            testKey = data.variables[key]
-                            del testKey
-                            setattr(self, aliaS,
-                                    np.zeros((grid.ntime,grid.nlevel, grid.nele)))
-                            I = 0
-                            for i in region_t:
-                                #TR comment: looping on time indices is a trick from
-                                #            Mitchell to improve loading time
-                                #TR comment: no idea why I have to transpose here but
-                                #            I do !!
-                                getattr(self, aliaS)[I,:,:] =\
-                                        np.transpose(data.variables[key].data[i,:,:])
-                                I += 1
-                            keyCount +=1
-                        except KeyError:
-                            if debug: print key, " is missing !"
-                            continue
-                    if keyCount==0:
-                        print "---Vertical variables are missing---"
-                    else:
-                        self._3D = True 
+                    self._load_slabs(data, region_t, slice(None), slice(None),
+                                     kwl2D, al2D, kwl3D, al3D,
+                                     mem_budget=mem_budget, debug=debug)
 
             #Time period defined and region defined           
             else:
@@ -170,134 +138,14 @@ Some others shall be generated as methods are being called, ex:
                 #Redefine variables in bounding box & time period
                 #Check if OpenDap variables or not
                 if type(data.variables).__name__=='DatasetType':
-                    #Special loading for zeta
-                    H = 0 #local counter
-                    key = kwl2D.pop(2)
-                    aliaS = al2D.pop(2)
-                    for k, g in groupby(enumerate(region_n), lambda (i,x):i-x):
-                        ID = map(itemgetter(1), g)
-                        if debug: print 'Index bound: ' +\
-                            str(ID[0]) + '-' + str(ID[-1]+1)
-                        if H==0:
-                            setattr(self, aliaS,
-                                    data.variables[key].data[ts:te,ID[0]:(ID[-1]+1)])
-                            H=1
-                        else:
-                            setattr(self, aliaS,
-                            np.hstack((getattr(self, aliaS),
-                            data.variables[key].data[ts:te,ID[0]:(ID[-1]+1)])))
-                    #loading hori data
-                    keyCount = 0
-                    for key, aliaS in zip(kwl2D, al2D):
-                        try:
-                            H = 0 #local counter
-                            for k, g in groupby(enumerate(region_e), lambda (i,x):i-x):
-                                ID = map(itemgetter(1), g)
-                                if debug: print 'Index bound: ' +\
-                                          str(ID[0]) + '-' + str(ID[-1]+1)
-                                if H==0:
-                                    setattr(self, aliaS,
-                                    data.variables[key].data[ts:te,ID[0]:(ID[-1]+1)])
-                                    H=1
-                                else:
-                                    setattr(self, aliaS,
-                                    np.hstack((getattr(self, aliaS),
-                                    data.variables[key].data[ts:te,ID[0]:(ID[-1]+1)])))
-                            keyCount +=1
-                        except KeyError:
-                            if debug: print key, " is missing !"
-                            continue
-                    if keyCount==0:
-                        print "---Horizontal variables are missing---"
-                    self._3D = False 
-                    
-                    #loading verti data
-                    keyCount = 0
-                    for key, aliaS in zip(kwl3D, al3D):
-                        try:
-                            H = 0 #local counter
-                            for k, g in groupby(enumerate(region_e), lambda (i,x):i-x):
-                                ID = map(itemgetter(1), g)
-                                if debug: print 'Index bound: ' +\
-                                          str(ID[0]) + '-' + str(ID[-1]+1)
-                                if H==0:
-                                    setattr(self, aliaS, data.variables[key].data\
-                                                       [ts:te,:,ID[0]:(ID[-1]+1)])
-                                    H=1
-                                else:
-                                    setattr(self, aliaS,
-                                    np.dstack((getattr(self, aliaS),
-                                    data.variables[key].data[ts:te,:,ID[0]:(ID[-1]+1)])))
-                            keyCount +=1
-                        except KeyError:
-                            if debug: print key, " is missing !"
-                            continue
-                    if keyCount==0:
-                        print "---Vertical variables are missing---"
-                    else:
-                         self._3D = True
+                    self._load_remote(data, slice(ts, te), region_e, region_n,
+                                      kwl2D, al2D, kwl3D, al3D, debug=debug)
 
                 #Not OpenDap
                 else:
-                    #loading hori data
-                    keyCount = 0
-                    for key, aliaS in zip(kwl2D, al2D):
-                        try:
-                            if key=='zeta':
-                                setattr(self, aliaS, np.zeros((grid.ntime, grid.nnode)))
-                                I = 0
-                                for i in region_t:
-                                    #TR comment: looping on time indices is a trick from
-                                    #            Mitchell to improve loading time
-                                    #TR comment: no idea why I have to transpose here but
-                                    #            I do !!
-                                    getattr(self, aliaS)[I,:] =\
-                                    np.transpose(data.variables[key].data[i,region_n])
-                                    I += 1
-                            else:
-                                setattr(self, aliaS, np.zeros((grid.ntime, grid.nele)))
-                                I = 0
-                                for i in region_t:
-                                    #TR comment: looping on time indices is a trick from
-                                    #            Mitchell to improve loading time
-                                    #TR comment: no idea why I have to transpose here but
-                                    #            I do !!
-                                    getattr(self, aliaS)[I,:] =\
-                                    np.transpose(data.variables[key].data[i,region_e])
-                                    I += 1
-                            keyCount +=1
-                        except KeyError:
-                            if debug: print key, " is missing !"
-                            continue
-                    if keyCount==0:
-                        print "---Horizontal variables are missing---"
-                    self._3D = False 
-                    
-                    #loading verti data
-                    keyCount = 0
-                    for key in zip(kwl3D, al3D):
-                        try:
-                            testKey = data.variables[key]
-                            del testKey
-                            setattr(self, alias,
-                            np.zeros((grid.ntime,grid.nlevel, grid.nele)))
-                            I=0
-                            for i in region_t:
-                                #TR comment: looping on time indices is a trick from
-                                #            Mitchell to improve loading time
-                                #TR comment: no idea why I have to transpose here but
-                                #            I do !!
-                                getattr(self, aliaS)[I,:,:] =\
-                                np.transpose(data.variables[key].data[i,:,region_e])
-                                I += 1
-                            keyCount +=1
-                        except KeyError:
-                            if debug: print key, " is missing !"
-                            continue
-                    if keyCount==0:
-                        print "---Vertical variables are missing---"
-                    else:
-                        self._3D = True 
+                    self._load_slabs(data, region_t, region_e, region_n,
+                                     kwl2D, al2D, kwl3D, al3D,
+                                     mem_budget=mem_budget, debug=debug)
   
         #No time period define    
         else:
@@ -314,7 +162,14 @@ Some others shall be generated as methods are being called, ex:
             grid.ntime = self.julianTime.shape[0]
 
             #Check if bounding box has been defined
-            if grid._ax==[]:
+            if grid._ax==[] and lazy and \
+               not type(data.variables).__name__=='DatasetType':
+                if debug:
+                    print 'Linking lazy variables...'
+                self._load_slabs(data, slice(None), slice(None), slice(None),
+                                 kwl2D, al2D, kwl3D, al3D,
+                                 mem_budget=mem_budget, debug=debug)
+            elif grid._ax==[]:
                 if debug:
                     print 'Linking variables...'
 
@@ -356,131 +211,129 @@ Some others shall be generated as methods are being called, ex:
                 #Redefine variables in bounding box
                 #Check if OpenDap variables or not
                 if type(data.variables).__name__=='DatasetType':
-                    #loading hori data
-                    keyCount = 0
-                    for key, aliaS in zip(kwl2D, al2D):
-                        #Special loading for zeta
-                        H = 0 #local counter
-                        if key == 'zeta':
-                            for k, g in groupby(enumerate(region_n), lambda (i,x):i-x):
-                                ID = map(itemgetter(1), g)
-                                if debug: print 'Index bound: ' +\
-                                    str(ID[0]) + '-' + str(ID[-1]+1)
-                                if H==0:
-                                    setattr(self, aliaS,
-                                    data.variables[key].data[:,ID[0]:(ID[-1]+1)])
-                                    H=1
-                                else:
-                                    setattr(self, aliaS,
-                                    np.hstack((getattr(self, aliaS),
-                                    data.variables[key].data[:,ID[0]:(ID[-1]+1)])))
-                        else:
-                            try:                        
-                                for k, g in groupby(enumerate(region_e), lambda (i,x):i-x):
-                                    ID = map(itemgetter(1), g)
-                                    if debug: print 'Index bound: ' +\
-                                              str(ID[0]) + '-' + str(ID[-1]+1)
-                                    if H==0:
-                                        setattr(self, aliaS,
-                                                data.variables[key].\
-                                                data[:,ID[0]:(ID[-1]+1)])
-                                        H=1
-                                    else:
-                                        setattr(self, aliaS,
-                                        np.hstack((getattr(self, aliaS),
-                                        data.variables[key].data[:,ID[0]:(ID[-1]+1)])))
-                                    keyCount +=1
-                            except KeyError:
-                                if debug: print key, " is missing !"
-                                continue
-                    if keyCount==0:
-                        print "---Horizontal variables are missing---"
-                    self._3D = False 
-                    
-                    #loading verti data
-                    keyCount = 0
-                    for key, aliaS in zip(kwl3D, al3D):
-                        try:
-                            H = 0 #local counter
-                            for k, g in groupby(enumerate(region_e), lambda (i,x):i-x):
-                                ID = map(itemgetter(1), g)
-                                if debug: print 'Index bound: ' +\
-                                          str(ID[0]) + '-' + str(ID[-1]+1)
-                                if H==0:
-                                    setattr(self, aliaS,
-                                    data.variables[key].data[:,:,ID[0]:(ID[-1]+1)])
-                                    H=1
-                                else:
-                                    setattr(self, aliaS,
-                                    np.dstack((getattr(self, aliaS),
-                                    data.variables[key].data[:,:,ID[0]:(ID[-1]+1)])))
-                            keyCount +=1
-                        except KeyError:
-                            if debug: print key, " is missing !"
-                            continue
-                    if keyCount==0:
-                        print "---Vertical variables are missing---"
-                    else:
-                        self._3D = True
+                    self._load_remote(data, slice(None), region_e, region_n,
+                                      kwl2D, al2D, kwl3D, al3D, debug=debug)
 
                 #Not OpenDap
                 else:
-                    #loading hori data
-                    keyCount = 0
-                    for key, aliaS in zip(kwl2D, al2D):
-                        try:
-                            if key=='zeta':
-                                setattr(self, aliaS, np.zeros((grid.ntime, grid.nnode)))
-                                for i in range(grid.ntime):
-                                    #TR comment: looping on time indices is a trick from
-                                    #            Mitchell to improve loading time
-                                    #TR comment: no idea why I have to transpose here but
-                                    #            I do !!
-                                    getattr(self, aliaS)[i,:] =\
-                                    np.transpose(data.variables[key].data[i,region_n])
-                            else:
-                                setattr(self, aliaS, np.zeros((grid.ntime, grid.nele)))
-                                for i in range(grid.ntime):
-                                    #TR comment: looping on time indices is a trick from
-                                    #            Mitchell to improve loading time
-                                    #TR comment: no idea why I have to transpose here but
-                                    #            I do !!
-                                    getattr(self, aliaS)[i,:] =\
-                                    np.transpose(data.variables[key].data[i,region_e])
-                            keyCount +=1
-                        except KeyError:
-                            if debug: print key, " is missing !"
-                            continue
-                    if keyCount==0:
-                        print "---Horizontal variables are missing---"
-                    self._3D = False 
-                    
-                    #loading verti data
-                    keyCount = 0
-                    for key, aliaS in zip(kwl3D, al3D):
-                        try:
-                            testKey = data.variables[key]
-                            del testKey
-                            setattr(self, aliaS,
-                            np.zeros((grid.ntime,grid.nlevel, grid.nele)))
-                            for i in range(grid.ntime):
-                                #TR comment: looping on time indices is a trick from
-                                #            Mitchell to improve loading time
-                                #TR comment: no idea why I have to transpose here but
-                                #            I do !!
-                                getattr(self, aliaS)[i,:,:] =\
-                                np.transpose(data.variables[key].data[i,:,region_e])
-                            keyCount +=1
-                        except KeyError:
-                            if debug: print key, " is missing !"
-                            continue
-                    if keyCount==0:
-                        print "---Vertical variables are missing---"
-                    else:
-                        self._3D = True 
+                    self._load_slabs(data, slice(None), region_e, region_n,
+                                     kwl2D, al2D, kwl3D, al3D,
+                                     mem_budget=mem_budget, debug=debug)
         if debug:
             print '...Passed'
 
+    def _load_slabs(self, data, region_t, region_e, region_n,
+                    kwl2D, al2D, kwl3D, al3D, mem_budget=None, debug=False):
+        '''Load local variables by large time slabs, aka load_slab,
+           or link them as LazyVariable in lazy mode'''
+        debug = debug or self._debug
+        #Sub-domain cache
+        if not self._lazy:
+            cached = load_subdomain(self._cache_key, debug=debug)
+            if not cached is None:
+                for aliaS in al2D + al3D:
+                    if aliaS in cached:
+                        setattr(self, aliaS, cached[aliaS])
+                self._3D = any(aliaS in cached for aliaS in al3D)
+                print "Variables loaded from sub-domain cache"
+                return
+        if mem_budget is None:
+            mem_budget = loading_utils.MEM_BUDGET
+        if self._lazy:
+            load = lambda key, aliaS, region: LazyVariable(
+                       data.variables[key].data, key, region_t, region,
+                       cache=self._cache, mem_budget=mem_budget)
+        else:
+            load = lambda key, aliaS, region: load_slab(
+                       data.variables[key].data, region_t, region,
+                       mem_budget=mem_budget, stats=self._load_stats,
+                       debug=debug)
+        #loading hori data
+        keyCount = 0
+        for key, aliaS in zip(kwl2D, al2D):
+            try:
+                if key=='zeta':
+                    region = region_n
+                else:
+                    region = region_e
+                setattr(self, aliaS, load(key, aliaS, region))
+                keyCount +=1
+            except KeyError:
+                if debug: print key, " is missing !"
+                continue
+        if keyCount==0:
+            print "---Horizontal variables are missing---"
+        self._3D = False
+
+        #loading verti data
+        keyCount = 0
+        for key, aliaS in zip(kwl3D, al3D):
+            try:
+                setattr(self, aliaS, load(key, aliaS, region_e))
+                keyCount +=1
+            except KeyError:
+                if debug: print key, " is missing !"
+                continue
+        if keyCount==0:
+            print "---Vertical variables are missing---"
+        else:
+            self._3D = True
+
+        if not self._lazy:
+            if debug:
+                print "Loaded " + str(round(self._load_stats['bytes'] / 1024.0**2, 1))\
+                      + " MB at " + str(round(transfer_rate(self._load_stats['bytes'],
+                                             self._load_stats['seconds']), 1)) + " MB/s"
+            save_subdomain(self._cache_key,
+                           dict((aliaS, getattr(self, aliaS))
+                                for aliaS in set(al2D + al3D)
+                                if hasattr(self, aliaS)), debug=debug)
+
+    def _load_remote(self, data, region_t, region_e, region_n,
+                     kwl2D, al2D, kwl3D, al3D, debug=False):
+        '''Load OpenDap variables by merged index ranges, aka load_ranges'''
+        debug = debug or self._debug
+        load = lambda key, region: load_ranges(data.variables[key].data, region,
+                                               time_index=region_t,
+                                               stats=self._remote_stats,
+                                               debug=debug)
+        #loading hori data
+        keyCount = 0
+        for key, aliaS in zip(kwl2D, al2D):
+            try:
+                if key=='zeta':
+                    region = region_n
+                else:
+                    region = region_e
+                setattr(self, aliaS, load(key, region))
+                keyCount +=1
+            except KeyError:
+                if debug: print key, " is missing !"
+                continue
+        if keyCount==0:
+            print "---Horizontal variables are missing---"
+        self._3D = False
+
+        #loading verti data
+        keyCount = 0
+        for key, aliaS in zip(kwl3D, al3D):
+            try:
+                setattr(self, aliaS, load(key, region_e))
+                keyCount +=1
+            except KeyError:
+                if debug: print key, " is missing !"
+                continue
+        if keyCount==0:
+            print "---Vertical variables are missing---"
+        else:
+            self._3D = True
+
+        if debug:
+            print "Loaded " + str(round(self._remote_stats['bytes'] / 1024.0**2, 1))\
+                  + " MB in " + str(self._remote_stats['requests']) + " requests, "\
+                  + str(round(self._remote_stats['overfetch'] / 1024.0**2, 1))\
+                  + " MB over-fetched"
+
     def _t_region(self, tx, debug=False):
         '''Return time indices included in time period, aka tx'''
         debug = debug or self._debug      
@@ -516,7 +369,8 @@ Some grid data are directly passed on from FVCOM output:
              |_nlevel = vertical level dimension, integer
              |_ntime = time dimension, integer
              |_trinodes = surrounding node indices, 2D array (3, nele)
-             |_trinodes = surrounding element indices, 2D array (3, nele)
+             |_triele = surrounding element indices, 2D array (3, nele),
+             |          -1 standing for no neighbour
              |_siglay = sigma layers, 2D array (nlevel, nnode)
              |_siglay = sigma levels, 2D array (nlevel+1, nnode)
              |_and a all bunch of grid parameters...
@@ -527,7 +381,8 @@ Some others shall be generated as methods are being called, ex:
              ...
              |_triangle = triangulation object for plotting purposes    
     '''
-    def __init__(self, data, ax, History, debug=False):
+    def __init__(self, data, ax, History, filename=None, inside=False,
+                 cache=False, debug=False):
         self._debug = debug   
         if debug:
             print 'Loading grid...'
@@ -548,7 +403,10 @@ Some others shall be generated as methods are being called, ex:
         self.awx = data.variables['awx'].data
         self.awy = data.variables['awy'].data
         self.trinodes = np.transpose(data.variables['nv'].data) - 1
-        self.triele = np.transpose(data.variables['nbe'].data)
+        #0-based like trinodes, -1 standing for no neighbour
+        self.triele = np.transpose(data.variables['nbe'].data) - 1
+        #Convention marker of triele, saved along with the grid
+        self._triele_base = 0
         if ax==[]:
             #Define bounding box
             self._ax = []
@@ -578,8 +436,20 @@ Some others shall be generated as methods are being called, ex:
             #elif ax=='MP':
             #    ax=[
            
-            print 'Re-indexing may take some time...'   
-            Data = regioner(self, ax, debug=debug)
+            #Sub-domain cache
+            key = None
+            if cache and not filename is None:
+                key = subdomain_key(filename, 'grid', ax, inside)
+            Data = load_subdomain(key, debug=debug)
+            if Data is None:
+                print 'Re-indexing may take some time...'   
+                Data = regioner(self, ax, inside=inside, debug=debug)
+                cached = Data.copy()
+                cached.pop('triangle')
+                save_subdomain(key, cached, debug=debug)
+            else:
+                Data['triangle'] = Tri.Triangulation(Data['lon'], Data['lat'],
+                                                     Data['nv'])
             self.lon = Data['lon'][:]
             self.lat = Data['lat'][:]
             self.lonc = Data['lonc'][:]
@@ -602,26 +472,15 @@ Some others shall be generated as methods are being called, ex:
 
             #different loading technique if using OpenDap server
             if type(data.variables).__name__=='DatasetType':
-                #Split into consecutive integers to optimise loading
+                #Merge nearby runs of indices to optimise loading
                 #TR comment: data.variables['ww'].data[:,:,region_n] doesn't
                 #            work with non consecutive indices
-                H=0
-                for k, g in groupby(enumerate(self._node_index), lambda (i,x):i-x):
-                    ID = map(itemgetter(1), g)
-                    if debug: print 'Index bound: ' +\
-                        str(ID[0]) + '-' + str(ID[-1]+1)
-                    if H==0:
-                        self.h = data.variables['h'].data[ID[0]:(ID[-1]+1)]
-                        self.siglay = data.variables['siglay'].data[:,ID[0]:(ID[-1]+1)]
-                        self.siglev = data.variables['siglev'].data[:,ID[0]:(ID[-1]+1)]
-                    else:
-                        self.h = np.hstack((self.h,
-                        data.variables['h'].data[ID[0]:(ID[-1]+1)]))
-                        self.siglay = np.hstack((self.siglay,
-                        data.variables['siglay'].data[:,ID[0]:(ID[-1]+1)]))
-                        self.siglev = np.hstack((self.siglev,
-                        data.variables['siglev'].data[:,ID[0]:(ID[-1]+1)]))
-                    H=1
+                self.h = load_ranges(data.variables['h'].data,
+                                     self._node_index, debug=debug)
+                self.siglay = load_ranges(data.variables['siglay'].data,
+                                          self._node_index, debug=debug)
+                self.siglev = load_ranges(data.variables['siglev'].data,
+                                          self._node_index, debug=debug)
             else:
                 self.h = data.variables['h'].data[self._node_index]
                 self.siglay = data.variables['siglay'].data[:,self._node_index]
@@ -633,9 +492,15 @@ Some others shall be generated as methods are being called, ex:
 
             del Data
             #Define bounding box
+            if np.asarray(ax).ndim==2:
+                #Bounding box of the polygon
+                text = 'Polygon =' + str(ax)
+                ax = np.asarray(ax, dtype=float)
+                ax = [ax[:,0].min(), ax[:,0].max(), ax[:,1].min(), ax[:,1].max()]
+            else:
+                text = 'Bounding box =' + str(ax)
             self._ax = ax
             # Add metadata entry
-            text = 'Bounding box =' + str(ax)
             self._History.append(text)
             print '-Now working in bounding box-'
     
@@ -6,10 +6,15 @@ import numpy as np
 from scipy import linalg as LA
 import sys
 import numexpr as ne
+import pandas as pd
 from datetime import datetime
 from datetime import timedelta
 from miscellaneous import *
 from BP_tools import *
+from statistics_utils import exceedance_curve, occurrence_histogram
+from harmonic_utils import harmonic_pool, harmonic_reconstruction
+from harmonic_utils import harmonic_analysis
+from station_utils import search_station, name_index
 from utide import ut_solv, ut_reconstr
 import time
 
@@ -32,22 +37,28 @@ class FunctionsStation:
         History = self._History
 
     def search_index(self, station):
-        """Search for the station index"""
-        if type(station)==int:
-            index = station
-        elif type(station).__name__ in ['str', 'ndarray']:
-            station = "".join(station).strip().upper()
-            for i in range(self._grid.nele):
-                if station=="".join(self._grid.name[1,:]).strip().upper():
-                   index=i
-        else:
-            print "---Wrong station input---"
-            sys.exit() 
-        if not 'index' in locals():
-            print "---Wrong station input---"
-            sys.exit()
+        """
+        Search for the station index
 
-        return index
+        Inputs:
+        ------
+          - station = either station index (interger) or name (string),
+                      or list of them, or 'all'
+
+        Outputs:
+        -------
+          - index = station index, integer, or indices, 1D array
+
+        Notes:
+        -----
+          - names are looked up in Grid._name_index, see station_utils
+        """
+        return search_station(self._grid, station)
+
+    def _station_names(self, index):
+        """Names of the stations of index, list of strings"""
+        names = name_index(self._grid).names
+        return [names[i] for i in index]
 
     def flow_dir(self,  station, t_start=[], t_end=[], time_ind=[],
                  exceedance=False, debug=False):
@@ -56,12 +67,15 @@ class FunctionsStation:
 
         Inputs:
         ------
-          - station = either station index (interger) or name (string)
+          - station = either station index (interger) or name (string),
+                      or list of them, or 'all'
 
         Outputs:
         -------
-           - flowDir = flowDir at station, 1D array
-           - norm = velocity norm at station, 1D array
+           - flowDir = flowDir at station, 1D array,
+                       or 2D array (ntime, nstation) for many stations
+           - norm = velocity norm at station, 1D array,
+                    or 2D array (ntime, nstation) for many stations
 
         Keywords:
         --------
@@ -76,6 +90,7 @@ class FunctionsStation:
         -----
           - directions between -180 and 180 deg., i.e. 0=East, 90=North,
             +/-180=West, -90=South
+          - the rose diagram is only plotted for a single station
         """
         debug = debug or self._debug
         if debug:
@@ -96,8 +111,8 @@ class FunctionsStation:
 
         #Choose the right pair of velocity components
         if not argtime==[]:
-            U = self._var.ua[argtime,index]
-            V = self._var.va[argtime,index]
+            U = self._var.ua[:,index][argtime]
+            V = self._var.va[:,index][argtime]
         else:
             U = self._var.ua[:,index]
             V = self._var.va[:,index]
@@ -112,7 +127,8 @@ class FunctionsStation:
         if debug:
             print '...Passed'
         #Rose diagram
-        self._plot.rose_diagram(dirFlow, norm)
+        if np.ndim(index)==0:
+            self._plot.rose_diagram(dirFlow, norm)
         if exceedance:
             self.exceedance(norm)
 
@@ -126,14 +142,22 @@ class FunctionsStation:
 
         Inputs:
         ------
-          - station = either station index (interger) or name (string)
+          - station = either station index (interger) or name (string),
+                      or list of them, or 'all'
 
         Outputs:
         -------
           - floodIndex = flood time index, 1D array of integers
           - ebbIndex = ebb time index, 1D array of integers
-          - pr_axis = principal flow ax1s, float number in degrees
-          - pr_ax_var = associated variance, float number
+          - pr_axis = principal flow axis, heading in degrees from North
+          - pr_ax_var = fraction of the variance along the principal axis
+
+        For a list of stations or 'all':
+          - flood = flood time steps, 2D array of booleans (ntime, nstation)
+          - table = one row per station, pandas DataFrame with
+                    'pr_axis' (degrees from North), 'pr_ax_var',
+                    'flood' and 'ebb' (% of time) and
+                    'flood_speed' and 'ebb_speed' (mean speeds)
 
         Keywords:
         --------
@@ -150,6 +174,8 @@ class FunctionsStation:
             +/-180=West, -90=South
           - use time_ind or t_start and t_end, not both
           - assume that flood is aligned with principal direction
+          - the principal axes of all the stations are computed at once,
+            see BP_tools.flood_ebb_split
         """
         debug = debug or self._debug
         if debug:
@@ -173,61 +199,42 @@ class FunctionsStation:
 
         #Choose the right pair of velocity components
         if not argtime==[]:
-            U = self._var.ua[argtime,index]
-            V = self._var.va[argtime,index]
+            U = self._var.ua[:,index][argtime]
+            V = self._var.va[:,index][argtime]
         else:
             U = self._var.ua[:,index]
             V = self._var.va[:,index]
 
-        #WB version of BP's principal axis
+        #Principal axes, signed speeds and ebb/flood in one pass
         if debug:
-            print 'Computin principal axis at point...'
-        pr_axis, pr_ax_var = principal_axis(U, V)
-
-        #ebb/flood split
-        if debug:
-            print 'Splitting ebb and flood at point...'
-        # reverse 0-360 deg convention
-        ra = (-pr_axis - 90.0) * np.pi /180.0
-        if ra>np.pi:
-            ra = ra - (2.0*np.pi)
-        elif ra<-np.pi:
-            ra = ra + (2.0*np.pi)    
-        dirFlow = np.arctan2(V,U)
-        #Define bins of angles
-        if ra == 0.0:
-            binP = [0.0, np.pi/2.0]
-            binP = [0.0, -np.pi/2.0]
-        elif ra > 0.0:
-            if ra == np.pi:
-                binP = [np.pi/2.0 , np.pi]
-                binM = [-np.pi, -np.pi/2.0 ]        
-            elif ra < (np.pi/2.0):
-                binP = [0.0, ra + (np.pi/2.0)]
-                binM = [-((np.pi/2.0)-ra), 0.0]
-            else:
-                binP = [ra - (np.pi/2.0), np.pi]
-                binM = [-np.pi, -np.pi + (ra-(np.pi/2.0))]
-        else:
-            if ra == -np.pi:
-                binP = [np.pi/2.0 , np.pi]
-                binM = [-np.pi, -np.pi/2.0]
-            elif ra > -(np.pi/2.0):
-                binP = [0.0, ra + (np.pi/2.0)]
-                binM = [ ((-np.pi/2.0)+ra), 0.0]
-            else:
-                binP = [np.pi - (ra+(np.pi/2.0)) , np.pi]
-                binM = [-np.pi, ra + (np.pi/2.0)]
-                                
-        test = (((dirFlow > binP[0]) * (dirFlow < binP[1])) +
-                ((dirFlow > binM[0]) * (dirFlow < binM[1])))
-        floodIndex = np.where(test == True)[0]
-        ebbIndex = np.where(test == False)[0]
-
-        #TR fit with Rose diagram angle convention
-        #pr_axis = pr_axis - 90.0
-        #if pr_axis<0.0:
-        #    pr_axis[ind] = pr_axis[ind] + 360   
+            print 'Splitting ebb and flood...'
+        pr_axis, pr_ax_var, s_signed, flood = flood_ebb_split(U, V)
+
+        #Many stations: one row per station
+        if np.ndim(index)>0:
+            norm = np.abs(s_signed)
+            valid = ~np.isnan(s_signed)
+            ebb = valid * ~flood
+            nFlood = flood.sum(axis=0)
+            nEbb = ebb.sum(axis=0)
+            data = {'pr_axis': pr_axis, 'pr_ax_var': pr_ax_var,
+                    'flood': (nFlood * 100) / valid.sum(axis=0),
+                    'ebb': (nEbb * 100) / valid.sum(axis=0),
+                    'flood_speed': np.where(flood, norm, 0.0).sum(axis=0)
+                                   / np.maximum(nFlood, 1),
+                    'ebb_speed': np.where(ebb, norm, 0.0).sum(axis=0)
+                                 / np.maximum(nEbb, 1)}
+            table = pd.DataFrame(data=data, index=self._station_names(index),
+                                 columns=['pr_axis', 'pr_ax_var', 'flood',
+                                          'ebb', 'flood_speed', 'ebb_speed'])
+            if debug:
+                end = time.time()
+                print "...processing time: ", (end - start)
+
+            return flood, table
+
+        floodIndex = np.where(flood)[0]
+        ebbIndex = np.where(~flood)[0]
 
         if debug:
             end = time.time()
@@ -235,7 +242,8 @@ class FunctionsStation:
 
         return floodIndex, ebbIndex, pr_axis, pr_ax_var
 
-    def exceedance(self, var, station=[], debug=False):
+    def exceedance(self, var, station=[], ranges=None, graph=True,
+                   debug=False):
         """
         This function calculate the excedence curve of a var(time).
 
@@ -245,13 +253,21 @@ class FunctionsStation:
 
         Keywords:
         --------
-          - station = either station index (interger) or name (string)
-                      Necessary if var = 2D (i.e. [time, nnode or nele]
+          - station = either station index (interger) or name (string),
+                      or list of them, or 'all'.
+                      If var = 2D (i.e. [time, nnode or nele]) and no
+                      station is given, the curves of every station
+                      are computed at once
+          - ranges = amplitude thresholds, float or list of floats.
+                     Default is 31 bins from 0 to the signal maximum
           - graph: True->plots curve; False->does not
 
         Outputs:
         -------
-          - Exceedance = list of % of occurences, 1D array
+          - Exceedance = list of % of occurences, 1D array,
+                         or 2D array (nrange, nstation) for every station,
+                         or pandas DataFrame with one row per station and
+                         one column per range for a list of stations or 'all'
           - Ranges = list of signal amplitude bins, 1D array
 
         Notes:
@@ -263,43 +279,35 @@ class FunctionsStation:
             print 'Computing exceedance...'
 
         #Distinguish between 1D and 2D var
-        if len(var.shape)>1:
-            if station==[]:
-                print 'Lon, lat coordinates are needed'
-                sys.exit()
+        index = None
+        if len(var.shape)>1 and not (type(station)==list and station==[]):
             #Search for the station
             index = self.search_index(station)
             signal = var[:,index] 
         else:
             signal=var
-        
-        Max = max(signal)	
-        dy = (Max/30.0)
-        Ranges = np.arange(0,(Max + dy), dy)
-        Exceedance = np.zeros(Ranges.shape[0])
-        dt = self._var.julianTime[1] - self._var.julianTime[0]
-        if dt==0:
-            dt = self._var.secondTime[1] - self._var.secondTime[0]
-        Period = var.shape[0] * dt
-        time = np.arange(0.0, Period, dt)
-
-        N = len(signal)
-        M = len(Ranges)
-
-        for i in range(M):
-            r = Ranges[i]
-            for j in range(N-1):
-                if signal[j] > r:
-                    Exceedance[i] = Exceedance[i] + (time[j+1] - time[j])
-
-        Exceedance = (Exceedance * 100) / Period
+
+        #Irregular time steps are accounted for
+        time = self._var.julianTime[:]
+        if (time[1] - time[0])==0:
+            time = self._var.secondTime[:]
+        if not time.shape[0]==signal.shape[0]:
+            time = time[1] - time[0]
+        Exceedance, Ranges = exceedance_curve(signal, time, ranges=ranges,
+                                              debug=debug)
 
         if debug:
             print '...Passed'
        
         #Plot
-        self._plot.plot_xy(Exceedance, Ranges, yLabel='Amplitudes',
-                           xLabel='Exceedance probability in %')
+        if graph and len(signal.shape)==1:
+            self._plot.plot_xy(Exceedance, Ranges, yLabel='Amplitudes',
+                               xLabel='Exceedance probability in %')
+
+        #One row per station
+        if np.ndim(index)>0:
+            Exceedance = pd.DataFrame(data=Exceedance.T, columns=Ranges,
+                                      index=self._station_names(index))
 
         return Exceedance, Ranges
 
@@ -338,14 +346,22 @@ class FunctionsStation:
 
         return dep
 
-    def speed_histogram(self, station, t_start=[], t_end=[], time_ind=[], debug=False):
+    def speed_histogram(self, station, t_start=[], t_end=[], time_ind=[],
+                        bins=50, debug=False):
         """
         This function plots the histogram of occurrences for the signed
         flow speed at any given point.
 
         Inputs:
         ------
-          - station = either station index (interger) or name (string)
+          - station = either station index (interger) or name (string),
+                      or list of them, or 'all'
+
+        Outputs:
+        -------
+        For a list of stations or 'all':
+          - table = % of occurrences, pandas DataFrame with one row per
+                    station and one column per bin centre
 
         Keywords:
         --------
@@ -354,16 +370,41 @@ class FunctionsStation:
           - t_end = end time, as a string ('yyyy-mm-ddThh:mm:ss'),
                     or time index as an integer
           - time_ind = time indices to work in, 1D array of integers 
+          - bins = number of bins, integer, or bin edges, list of floats,
+                   for a list of stations or 'all'
         
         Notes:
         -----
           - use time_ind or t_start and t_end, not both
+          - for many stations, the histograms share the same bins
+            and nothing is plotted
         """
         debug = debug or self._debug
         if debug:
             start = time.time()
             print 'Computing speed histogram...'
 
+        #Many stations: histograms of all of them at once
+        index = self.search_index(station)
+        if np.ndim(index)>0:
+            flood, table = self.ebb_flood_split(index,
+                           t_start=t_start, t_end=t_end, time_ind=time_ind,
+                           debug=debug)
+            dirFlow, norm = self.flow_dir(index,
+                            t_start=t_start, t_end=t_end, time_ind=time_ind,
+                            exceedance=False, debug=debug)
+            norm = np.where(flood, norm, -1.0 * norm)
+            Occurrences, Edges = occurrence_histogram(norm, bins=bins,
+                                                      debug=debug)
+            table = pd.DataFrame(data=Occurrences.T,
+                                 columns=0.5 * (Edges[1:] + Edges[:-1]),
+                                 index=self._station_names(index))
+            if debug:
+                end = time.time()
+                print "...processing time: ", (end - start)
+
+            return table
+
         pI, nI, pa, pav = self.ebb_flood_split(station,
                           t_start=t_start, t_end=t_end, time_ind=time_ind,
                           debug=debug)
@@ -400,12 +441,21 @@ class FunctionsStation:
 
         Inputs:
         ------
-          - station = either station index (interger) or name (string)
+          - station = either station index (interger) or name (string),
+                      or list of them, or 'all'
 
         Outputs:
         -------
           - harmo = harmonic coefficients, dictionary
 
+        For a list of stations or 'all':
+          - harmo = harmonic coefficients, dictionary where per constituent
+                    quantities are arrays (nconstit, nstation),
+                    see harmonic_utils.harmonic_analysis
+          - table = one row per station and constituent, pandas DataFrame
+                    with 'station', 'constituent' and 'A', 'g' for elevation
+                    or 'Lsmaj', 'Lsmin', 'theta', 'g' for velocity
+
         Keywords:
         --------
           - time_ind = time indices to work in, list of integers
@@ -431,6 +481,10 @@ class FunctionsStation:
         For more detailed information about ut_solv, please see
         https://github.com/wesleybowman/UTide
 
+        For many stations, the design matrix is factorized once for all of
+        them, i.e. least squares only (method='ols'),
+        and velocity=True takes precedence over elevation
+
         '''
         debug = (debug or self._debug)
 
@@ -447,6 +501,35 @@ class FunctionsStation:
                                         debug=debug)
             else:
                 argtime = arange(t_start, t_end)
+
+        #Many stations: all of them in one least squares solve
+        if np.ndim(index)>0:
+            if type(argtime)==list and argtime==[]:
+                argtime = slice(None)
+            lat = self._grid.lat[:][index]
+            if velocity:
+                harmo = harmonic_analysis(self._var.matlabTime, lat,
+                                          self._var.ua, v=self._var.va,
+                                          time_index=argtime, space_index=index,
+                                          debug=debug, **kwarg)
+                columns = ['Lsmaj', 'Lsmin', 'theta', 'g']
+            elif elevation:
+                harmo = harmonic_analysis(self._var.matlabTime, lat,
+                                          self._var.el,
+                                          time_index=argtime, space_index=index,
+                                          debug=debug, **kwarg)
+                columns = ['A', 'g']
+
+            #One row per station and constituent
+            nc = len(harmo['name'])
+            data = {'station': np.repeat(self._station_names(index), nc),
+                    'constituent': np.tile(harmo['name'], len(index))}
+            for key in columns:
+                data[key] = harmo[key].T.ravel()
+            table = pd.DataFrame(data=data,
+                                 columns=['station', 'constituent'] + columns)
+
+            return harmo, table
         
         if velocity:
             time = self._var.matlabTime[:]
@@ -475,8 +558,93 @@ class FunctionsStation:
 
             return harmo
 
+    def Harmonic_analysis_at_stations(self, stations,
+                                      time_ind=[], t_start=[], t_end=[],
+                                      elevation=True, velocity=False,
+                                      processes=2, checkpoint=None,
+                                      debug=False, **kwarg):
+        '''
+        Description:
+        ----------
+        This function performs a harmonic analysis on the sea surface elevation
+        time series or the velocity components timeseries of many stations,
+        ut_solv being run on a pool of processes.
+
+        Inputs:
+        ------
+          - stations = list of station indexes (interger) or names (string),
+                       or 'all'
+
+        Outputs:
+        -------
+          - harmos = harmonic coefficients, list of dictionaries
+
+        Keywords:
+        --------
+          - time_ind = time indices to work in, list of integers
+          - t_start = start time, as a string ('yyyy-mm-ddThh:mm:ss'),
+                     or time index as an integer
+          - t_end = end time, as a string ('yyyy-mm-ddThh:mm:ss'),
+                    or time index as an integer
+          - elevation=True means that ut_solv will be done for elevation.
+          - velocity=True means that ut_solv will be done for velocity
+            instead of elevation.
+          - processes = number of worker processes, integer
+          - checkpoint = path of a checkpoint file. Completed stations are
+                         saved in it, so that an interrupted run can be
+                         resumed by calling this function again with the
+                         same time range and options
+
+        Options:
+        -------
+        Options are the same as for ut_solv (see Harmonic_analysis_at_point)
+
+        Notes:
+        -----
+          - only the time series of the stations are sent to the workers
+        '''
+        debug = (debug or self._debug)
+
+        #Search for the stations
+        index = np.atleast_1d(self.search_index(stations))
+
+        argtime = slice(None)
+        if not time_ind==[]:
+            argtime = time_ind
+        elif not t_start==[]:
+            if type(t_start)==str:
+                argtime = time_to_index(t_start, t_end,
+                                        self._var.matlabTime,
+                                        debug=debug)
+            else:
+                argtime = np.arange(t_start, t_end)
+        time = self._var.matlabTime[:][argtime]
+
+        if velocity:
+            u = self._var.ua[argtime]
+            v = self._var.va[argtime]
+            series = [((self._grid.lon[ind], self._grid.lat[ind], 'uv'),
+                       u[:,ind], v[:,ind], self._grid.lat[ind])
+                      for ind in index]
+
+        elif elevation:
+            el = self._var.el[argtime]
+            series = [((self._grid.lon[ind], self._grid.lat[ind], 'el'),
+                       el[:,ind], [], self._grid.lat[ind])
+                      for ind in index]
+
+        else:
+            print "---elevation or velocity has to be True---"
+            sys.exit()
+
+        harmos = harmonic_pool(time, series, processes=processes,
+                               checkpoint=checkpoint, debug=debug, **kwarg)
+
+        return harmos
+
     def Harmonic_reconstruction(self, harmo, elevation=True, velocity=False,
-                                time_ind=slice(None), debug=False, **kwarg):
+                                time_ind=slice(None), mattime=[],
+                                filename=None, debug=False, **kwarg):
         '''
         Description:
         ----------
@@ -487,14 +655,21 @@ class FunctionsStation:
 
         Inputs:
         ------
-          - Harmo = harmonic coefficient from harmo_analysis
+          - Harmo = harmonic coefficient from harmo_analysis, or
+                    coefficients of many locations, i.e. list of them
+                    or output of Harmonic_analysis
           - elevation =True means that ut_reconstr will be done for elevation.
           - velocity =True means that ut_reconst will be done for velocity.
           - time_ind = time indices to process, list of integers
+          - mattime = matlab times to reconstruct at, 1D array.
+                      Overrides time_ind, i.e. for predictions
+          - filename = path of the *.npy file the reconstruction of many
+                       locations is written to, None to keep it in memory
         
         Output:
         ------         
-          - Reconstruct = reconstructed signal, dictionary
+          - Reconstruct = reconstructed signal, dictionary. For many
+                          locations, arrays (ntime, nlocation)
 
         Options:
         -------
@@ -506,17 +681,34 @@ class FunctionsStation:
         -----
         For more detailed information about ut_reconstr, please see
         https://github.com/wesleybowman/UTide
+        Many locations are reconstructed at once by matrix products over
+        time blocks, see harmonic_utils.harmonic_reconstruction. In that
+        case, only the cnstit option applies and velocity=True takes
+        precedence over elevation.
 
         '''
         debug = (debug or self._debug)
-        time = self._var.matlabTime[time_ind]
+        if not len(mattime)==0:
+            time = np.asarray(mattime)
+        else:
+            time = self._var.matlabTime[time_ind]
         #TR_comments: Add debug flag in Utide: debug=self._debug
         Reconstruct = {}
+        if type(harmo)==list or np.ndim(harmo['g'])>1:
+            #Many locations at once
+            recon = harmonic_reconstruction(time, harmo,
+                                            cnstit=kwarg.get('cnstit', []),
+                                            filename=filename, debug=debug)
+            if velocity:
+                Reconstruct['U'], Reconstruct['V'] = recon
+            elif elevation:
+                Reconstruct['el'] = recon
+            return Reconstruct
         if velocity:
-            U_recon, V_recon = ut_reconstr(time,harmo)
+            U_recon, V_recon = ut_reconstr(time,harmo,**kwarg)
             Reconstruct['U'] = U_recon
             Reconstruct['V'] = V_recon
         if elevation:
-            elev_recon, _ = ut_reconstr(time,harmo)
+            elev_recon, _ = ut_reconstr(time,harmo,**kwarg)
             Reconstruct['el'] = elev_recon
         return Reconstruct  
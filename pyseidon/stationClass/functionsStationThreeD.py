@@ -9,6 +9,7 @@ from datetime import datetime
 from datetime import timedelta
 from miscellaneous import *
 from BP_tools import *
+from station_utils import search_station
 import time
 
 class FunctionsStationThreeD:
@@ -32,22 +33,23 @@ class FunctionsStationThreeD:
         History = self._History
 
     def search_index(self, station):
-        """Search for the station index"""
-        if type(station)==int:
-            index = station
-        elif type(station).__name__ in ['str', 'ndarray']:
-            station = "".join(station).strip().upper()
-            for i in range(self._grid.nele):
-                if station=="".join(self._grid.name[1,:]).strip().upper():
-                   index=i
-        else:
-            print "---Wrong station input---"
-            sys.exit() 
-        if not 'index' in locals():
-            print "---Wrong station input---"
-            sys.exit()
+        """
+        Search for the station index
+
+        Inputs:
+        ------
+          - station = either station index (interger) or name (string),
+                      or list of them, or 'all'
 
-        return index
+        Outputs:
+        -------
+          - index = station index, integer, or indices, 1D array
+
+        Notes:
+        -----
+          - names are looked up in Grid._name_index, see station_utils
+        """
+        return search_station(self._grid, station)
 
     def depth(self, station, debug=False):
         """
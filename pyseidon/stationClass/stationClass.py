@@ -13,6 +13,8 @@ from scipy.io import loadmat
 from pydap.client import open_url
 import cPickle as pkl
 import copy
+import time
+from multiprocessing import Pool
 # Need to add closest point
 
 #Add local path to utilities
@@ -21,7 +23,10 @@ sys.path.append('../utilities/')
 #Utility import
 from shortest_element_path import shortest_element_path
 from object_from_dict import ObjectFromDict
+from store_utils import save_store, load_store
 from miscellaneous import findFiles, _load_nc
+from loading_utils import check_time_axis, TimeConcat, transfer_rate
+from station_utils import NameIndex
 
 #Local import
 from variablesStation import _load_var, _load_grid
@@ -29,6 +34,17 @@ from functionsStation import *
 from functionsStationThreeD import *
 from plotsStation import *
 
+def _load_station_file(args):
+    """Loads a station file in a worker process, see Station._load_parallel"""
+    k, entry, elements, mem_budget, keys = args
+    data = _load_nc(entry)
+    grid = _load_grid(data, elements, [])
+    var = _load_var(data, elements, grid, [], mem_budget=mem_budget)
+    grid = {'x': np.array(grid.x[:]), 'y': np.array(grid.y[:])}
+    var = dict((key, np.array(getattr(var, key)[:])) for key in keys)
+    if hasattr(data, 'close'): data.close()
+    return k, grid, var
+
 class Station:
     '''
 Description:
@@ -53,12 +69,17 @@ Inputs:
 
     Note that if the path point to a folder all the similar netCDF station files
     will be stack together.
-    Note that the file can be a pickle file (i.e. *.p) or a netcdf file 
-    (i.e. *.nc).           
+    Note that the file can be a pickle file (i.e. *.p), a store saved
+    with Save_as (i.e. *.store) or a netcdf file (i.e. *.nc).           
 
 Options:
 -------
   - elements = indices to extract, list of integers
+  - mem_budget = maximum size in bytes of a single read when loading local
+                 files, integer. Default is loading_utils.MEM_BUDGET
+  - processes = number of worker processes loading the files of a folder,
+                integer. Files are then loaded concurrently and assembled
+                in time order into preallocated arrays
    
 
 Notes:
@@ -70,47 +91,24 @@ Notes:
                  +/-180=West, -90=South
   - Depth = 0m is the free surface and depth is negative
     '''
-    def __init__(self, filename, elements=slice(None), debug=False):
+    def __init__(self, filename, elements=slice(None), mem_budget=None,
+                 processes=1, debug=False):
         #Class attributs
         self._debug = debug
+        self._mem_budget = mem_budget
         self._isMulti(filename)
         if not self._multi:
             self._load(filename, elements)
-            self.Plots = PlotsStation(self.Variables,
-                                      self.Grid,
-                                      self._debug)
-            self.Util2D = FunctionsStation(self.Variables,
-                                           self.Grid,
-                                           self.Plots,
-                                           self.History,
-                                           self._debug)
-            if self.Variables._3D:
-                self.Util3D = FunctionsStationThreeD(
-                                       self.Variables,
-                                       self.Grid,
-                                       self.Plots,
-                                       self.History,
-                                       self._debug) 
         else:
             print "---Finding matching files---"
             self._matches = findFiles(filename, 'STATION')
+        if self._multi and processes > 1:
+            self._load_parallel(self._matches, elements, processes,
+                                debug=debug)
+        elif self._multi:
             filename = self._matches.pop(0)
             self._load(filename, elements, debug=debug )
-            self.Plots = PlotsStation(self.Variables,
-                                      self.Grid,
-                                      self._debug)
-            self.Util2D = FunctionsStation(self.Variables,
-                                           self.Grid,
-                                           self.Plots,
-                                           self.History,
-                                           self._debug)
-            if self.Variables._3D:
-                self.Util3D = FunctionsStationThreeD(
-                                       self.Variables,
-                                       self.Grid,
-                                       self.Plots,
-                                       self.History,
-                                       self._debug) 
+            stations = []
             for entry in self._matches:
                 #Define new 
                 text = 'Created from ' + entry
@@ -119,12 +117,113 @@ Notes:
                 tmp['History'] = [text]
                 tmp['Grid'] = _load_grid(tmp['Data'], elements, [], debug=self._debug)
                 tmp['Variables'] = _load_var(tmp['Data'], elements, tmp['Grid'], [],
+                                             mem_budget=self._mem_budget,
                                              debug=self._debug)
-                tmp = ObjectFromDict(tmp)
-                self = self.__add__(tmp)
+                stations.append(ObjectFromDict(tmp))
+            #Stacked all at once, in time order
+            if not stations==[]:
+                stations.sort(key=lambda station: station.Variables.julianTime[0])
+                stacked = self._stack(stations, debug=debug)
+                self.Grid = stacked.Grid
+                self.Variables = stacked.Variables
+                self.History = stacked.History
+        self._set_utilities()
+
+    def _load_parallel(self, matches, elements, processes, debug=False):
+        """
+        Loads station files concurrently on a pool of processes and
+        assembles them in time order into preallocated arrays.
+        """
+        debug = debug or self._debug
+        tic = time.time()
+        #Time axis of every file, from the headers
+        if debug: print "Reading time axes..."
+        times = []
+        for entry in matches:
+            data = _load_nc(entry)
+            times.append(np.array(data.variables['time_JD'][:]))
+            if hasattr(data, 'close'): data.close()
+        order = np.argsort([t[0] for t in times], kind='mergesort')
+        matches = [matches[i] for i in order]
+        times = [times[i] for i in order]
+        problem = check_time_axis(times)
+        if not problem is None:
+            print "---Data not consecutive in time: " + problem + "---"
+            sys.exit()
+        offsets = np.hstack((0, np.cumsum([t.shape[0] for t in times])))
+        ntime = int(offsets[-1])
+
+        #First file defines the grid
+        self._load(matches[0], elements, debug=debug)
+        first = self.Variables
+        kwl=['matlabTime', 'julianTime', 'secondTime',
+             'u', 'v', 'w', 'tke', 'gls', 'ua', 'va', 'el']
+        keys = [key for key in kwl if hasattr(first, key)]
+        for key in keys:
+            var = np.asarray(getattr(first, key))
+            out = np.empty((ntime,) + var.shape[1:], dtype=var.dtype)
+            out[:offsets[1]] = var
+            setattr(first, key, out)
+
+        #Other files, as they complete
+        print "Loading " + str(len(matches)) + " files on " + str(processes)\
+              + " processes..."
+        nbytes = 0
+        args = [(k, matches[k], elements, self._mem_budget, keys)
+                for k in range(1, len(matches))]
+        pool = Pool(processes)
+        try:
+            count = 1
+            for k, grid, var in pool.imap_unordered(_load_station_file, args):
+                if not (np.array_equal(grid['x'], self.Grid.x[:]) and
+                        np.array_equal(grid['y'], self.Grid.y[:])):
+                    print "---Stations of " + matches[k] + " do not match---"
+                    print "Tip: use processes=1 to stack matching stations only"
+                    sys.exit()
+                for key in keys:
+                    getattr(first, key)[offsets[k]:offsets[k+1]] = var[key]
+                    nbytes += var[key].nbytes
+                count += 1
+                if debug:
+                    toc = time.time() - tic
+                    print "Loaded " + str(count) + "/" + str(len(matches))\
+                          + " files, " + str(round(transfer_rate(nbytes, toc), 2))\
+                          + " MB/s"
+        finally:
+            pool.terminate()
+            pool.join()
+
+        self.Grid.ntime = ntime
+        for entry in matches[1:]:
+            text = 'Data from ' + entry.split('/')[-1] + ' has been stacked'
+            self.History.append(text)
+        if debug: print "...processing time: ", (time.time() - tic)
+
+    def _set_utilities(self):
+        """Creates the Plots, Util2D and Util3D subsets"""
+        #Station names lookup table
+        self.Grid._name_index = NameIndex(self.Grid.name[:])
+        self.Plots = PlotsStation(self.Variables,
+                                  self.Grid,
+                                  self._debug)
+        self.Util2D = FunctionsStation(self.Variables,
+                                       self.Grid,
+                                       self.Plots,
+                                       self.History,
+                                       self._debug)
+        if self.Variables._3D:
+            self.Util3D = FunctionsStationThreeD(
+                                   self.Variables,
+                                   self.Grid,
+                                   self.Plots,
+                                   self.History,
+                                   self._debug) 
 
     def _isMulti(self, filename):
         """Tells if filename point to a file or a folder"""
+        if filename.rstrip('/').endswith('.store'):
+            self._multi = False
+            return
         split = filename.split('/')
         if split[-1]:
             self._multi = False
@@ -132,11 +231,15 @@ Notes:
             self._multi = True
 
     def _load(self, filename, elements, debug=False):
-        """Loads data from *.nc, *.p and OpenDap url"""
-        #Loading pickle file
-        if filename.endswith('.p'):
-            f = open(filename, "rb")
-            data = pkl.load(f)
+        """Loads data from *.nc, *.p, *.store and OpenDap url"""
+        #Loading pickle file or npy-store
+        if filename.endswith('.p') or filename.rstrip('/').endswith('.store'):
+            if filename.endswith('.p'):
+                f = open(filename, "rb")
+                data = pkl.load(f)
+            else:
+                if debug: print "Memory-mapping store..."
+                data = load_store(filename.rstrip('/'), debug=debug)
             self._origin_file = data['Origin']
             self.History = data['History']
             if debug: print "Turn keys into attributs"
@@ -190,6 +293,7 @@ Notes:
                                            elements,
                                            self.Grid,
                                            self.History,
+                                           mem_budget=self._mem_budget,
                                            debug=self._debug)
 
             except MemoryError:
@@ -218,89 +322,97 @@ Notes:
             same spatial domain
           - last time step of station1 must be <= to the 
             first time step of station2 
+          - station1 and station2 are left untouched: the stacked variables
+            are TimeConcat views of their variables, i.e. nothing is copied
+        """
+        return self._stack([StationClass], debug=debug)
+
+    def _stack(self, stations, debug=False):
+        """
+        Stacks the variables of several Station objects after the ones of
+        self, in a new Station object. See __add__.
         """
         debug = debug or self._debug
         if debug: print "Find matching elements..."
         #Find matching elements
         origNele = self.Grid.nele
-        origEle = []
-        #origName = self.Grid.name
         origX = self.Grid.x[:]
         origY = self.Grid.y[:]
-        newNele = StationClass.Grid.nele
-        newEle = []
-        #newName = StationClass.Grid.name
-        newX = StationClass.Grid.x[:]
-        newY = StationClass.Grid.y[:]
-        for i in range(origNele):
-            for j in range(newNele):
-                #Match based on names
-                #if (all(origName[i,:]==newName[j,:])):
-                #    origEle.append(i)
-                #    newEle.append(j)
-                #Match based on coordinates
-                if ((origX[i]==newX[j]) and (origY[i]==newY[j])):
-                    origEle.append(i)
-                    newEle.append(j)
+        #Match based on coordinates
+        lookups = []
+        for station in stations:
+            newX = station.Grid.x[:]
+            newY = station.Grid.y[:]
+            lookups.append(dict(((newX[j], newY[j]), j)
+                                for j in range(station.Grid.nele)))
+        origEle = [i for i in range(origNele)
+                   if all((origX[i], origY[i]) in lookup for lookup in lookups)]
+        newEle = [[lookup[(origX[i], origY[i])] for i in origEle]
+                  for lookup in lookups]
                 
         print len(origEle), " points will be stacked..."
 
         if len(origEle)==0:
             print "---No matching element found---"
             sys.exit()
-        elif not (self.Variables._3D == StationClass.Variables._3D):
+        elif not all(self.Variables._3D == station.Variables._3D
+                     for station in stations):
             print "---Data dimensions do not match---"
             sys.exit()
         else:
-            if not (self.Variables.julianTime[-1]<=
-                    StationClass.Variables.julianTime[0]):
-                print "---Data not consecutive in time---"
+            problem = check_time_axis([self.Variables.julianTime] +
+                          [station.Variables.julianTime for station in stations])
+            if not problem is None:
+                print "---Data not consecutive in time: " + problem + "---"
                 sys.exit()
-            #Copy self to newself
+            #Copy self to newself, without sharing the stacked attributs
             newself = copy.copy(self)
-            #TR comment: it still points toward self and modifies it
-            #            so cannot do Station3 = Station1 + Station2
+            newself.Grid = copy.copy(self.Grid)
+            newself.Variables = copy.copy(self.Variables)
+            newself.History = self.History[:]
+            newself.Grid._History = newself.History
+            newself.Variables._History = newself.History
             if debug:
                 print 'Stacking variables...'
             #keyword list for hstack
             kwl=['matlabTime', 'julianTime', 'secondTime']
             for key in kwl:
-                tmpN = getattr(newself.Variables, key)
-                tmpO = getattr(StationClass.Variables, key)
-                setattr(newself.Variables, key,
-                np.hstack((tmpN[:], tmpO[:])))
+                tmp = [getattr(newself.Variables, key)[:]]
+                tmp += [getattr(station.Variables, key)[:]
+                        for station in stations]
+                setattr(newself.Variables, key, np.hstack(tmp))
 
-            #keyword list for vstack
+            #keyword list for time concatenation
             kwl=['u', 'v', 'w', 'tke', 'gls', 'ua', 'va','el']
-            kwl2D=['ua', 'va','el']
             for key in kwl:
                 try:
-                    if key in kwl2D:
-                        tmpN = getattr(newself.Variables, key)\
-                               [:,newEle[:]]
-                        tmpO = getattr(StationClass.Variables, key)\
-                               [:,origEle[:]]                   
-                        setattr(newself.Variables, key,
-                        np.vstack((tmpN[:], tmpO[:])))
-                        if debug: print "Stacking " + key + "..."
-                    else:
-                        tmpN = getattr(newself.Variables, key)\
-                               [:,:,newEle[:]]
-                        tmpO = getattr(StationClass.Variables, key)\
-                               [:,:,origEle[:]]                   
-                        setattr(newself.Variables, key,
-                        np.vstack((tmpN[:], tmpO[:])))  
-                        if debug: print "Stacking " + key + "..."    
+                    tmp = [getattr(newself.Variables, key)]
+                    tmp += [getattr(station.Variables, key)
+                            for station in stations]
                 except AttributeError:
                     continue
+                setattr(newself.Variables, key,
+                        TimeConcat(tmp, space_index=[origEle] + newEle))
+                if debug: print "Stacking " + key + "..."
             #New time dimension
-            newself.Grid.ntime = newself.Grid.ntime + StationClass.Grid.ntime
-            #Keep only matching names
-            newself.Grid.name = self.Grid.name[origEle[:],:]
+            newself.Grid.ntime = newself.Grid.ntime +\
+                                 sum(station.Grid.ntime for station in stations)
+            #Keep only matching elements
+            if len(origEle) < origNele:
+                for key in ['x', 'y', 'lon', 'lat', 'h']:
+                    setattr(newself.Grid, key, getattr(self.Grid, key)[origEle])
+                for key in ['siglay', 'siglev']:
+                    setattr(newself.Grid, key,
+                            getattr(self.Grid, key)[:,origEle])
+                newself.Grid.name = self.Grid.name[origEle,:]
+                newself.Grid.nele = len(origEle)
+                newself.Grid.nnode = len(origEle)
             #Append to new object history
-            text = 'Data from ' + StationClass.History[0].split('/')[-1] \
-                 + ' has been stacked'
-            newself.History.append(text)
+            for station in stations:
+                text = 'Data from ' + station.History[0].split('/')[-1] \
+                     + ' has been stacked'
+                newself.History.append(text)
+            newself._set_utilities()
 
         return newself  
    
@@ -310,6 +422,7 @@ Notes:
         Save the current Station structure as:
            - *.p, i.e. python file
            - *.mat, i.e. Matlab file
+           - *.store, i.e. folder of *.npy files and json manifest
 
         Inputs:
         ------
@@ -317,7 +430,14 @@ Notes:
 
         Keywords:
         --------
-          - fileformat = format of the file to be saved, i.e. 'pickle' or 'matlab'
+          - fileformat = format of the file to be saved, i.e. 'pickle', 'matlab'
+                         or 'npy-store'
+
+        Notes:
+        -----
+          - 'npy-store' writes each array in its own *.npy file, so that
+            re-opening the *.store folder memory-maps them instead of
+            reading everything in memory, see store_utils
         """
         debug = debug or self._debug
         if debug:
@@ -342,17 +462,18 @@ Notes:
             #TR: Force caching Variables otherwise error during loading
             #    with 'netcdf4.Variable' type (see above)
             for key in data['Variables']:
-                listkeys=['Variable', 'ArrayProxy', 'BaseType'] 
+                listkeys=['Variable', 'ArrayProxy', 'BaseType', 'TimeConcat'] 
                 if any([type(data['Variables'][key]).__name__==x for x in listkeys]):
                     if debug:
                         print "Force caching for " + key
                     data['Variables'][key] = data['Variables'][key][:]
             #Unpickleable objects
             data['Grid'].pop("triangle", None)
+            data['Grid'].pop("_spatial_index", None)
             #TR: Force caching Variables otherwise error during loading
             #    with 'netcdf4.Variable' type (see above)
             for key in data['Grid']:
-                listkeys=['Variable', 'ArrayProxy', 'BaseType'] 
+                listkeys=['Variable', 'ArrayProxy', 'BaseType', 'TimeConcat'] 
                 if any([type(data['Grid'][key]).__name__==x for x in listkeys]):
                     if debug:
                         print "Force caching for " + key
@@ -369,6 +490,16 @@ Notes:
                 raise
            
             f.close()
+        elif fileformat=='npy-store':
+            filename = filename + ".store"
+            data = {}
+            data['Origin'] = self._origin_file
+            data['History'] = self.History
+            data['Grid'] = self.Grid.__dict__
+            data['Variables'] = self.Variables.__dict__
+            if debug:
+                print 'Writing npy files...'
+            save_store(filename, data, debug=debug)
         elif fileformat=='matlab':
             filename = filename + ".mat"
             #TR comment: based on MitchellO'Flaherty-Sproul's code
@@ -383,7 +514,7 @@ Notes:
             #TR: Force caching Variables otherwise error during loading
             #    with 'netcdf4.Variable' type (see above)
             for key in Var:
-                listkeys=['Variable', 'ArrayProxy', 'BaseType'] 
+                listkeys=['Variable', 'ArrayProxy', 'BaseType', 'TimeConcat'] 
                 if any([type(Var[key]).__name__==x for x in listkeys]):
                     if debug:
                         print "Force caching for " + key
@@ -393,8 +524,9 @@ Notes:
                 data[key] = Var[key]
             #Unpickleable objects
             Grd.pop("triangle", None)
+            Grd.pop("_spatial_index", None)
             for key in Grd:
-                listkeys=['Variable', 'ArrayProxy', 'BaseType'] 
+                listkeys=['Variable', 'ArrayProxy', 'BaseType', 'TimeConcat'] 
                 if any([type(Grd[key]).__name__==x for x in listkeys]):
                     if debug:
                         print "Force caching for " + key
@@ -3,11 +3,11 @@
 
 from __future__ import division
 import numpy as np
-from itertools import groupby
-from operator import itemgetter
 #Local import
 from miscellaneous import time_to_index
 from miscellaneous import mattime_to_datetime
+import loading_utils
+from loading_utils import load_slab, load_ranges, transfer_rate
 
 class _load_grid:
     '''
@@ -92,8 +92,11 @@ Some others shall be generated as methods are being called, ex:
                     |_verti_shear = vertical shear (1/s),
                                   3D array (ntime, nlevel, nele)           
     """
-    def __init__(self, data, elements, grid, History, debug=False):
+    def __init__(self, data, elements, grid, History, mem_budget=None,
+                 debug=False):
         if debug: print 'Loading variables...'
+        #Loading statistics
+        self._load_stats = {'bytes': 0, 'seconds': 0.0}
 
         #Pointer to History
         self._History = History
@@ -119,43 +122,25 @@ Some others shall be generated as methods are being called, ex:
         #Redefine variables in bounding box
         #Check if OpenDap variables or not
         if type(data.variables).__name__=='DatasetType':
+            #Merge nearby runs of indices into concurrent requests
+            remoteStats = {}
             #loading hori data
             keyCount = 0
             for key, aliaS in zip(kwl2D, al2D):
-                #Special loading for zeta
-                H = 0 #local counter
-                if key == 'zeta':
-                    for k, g in groupby(enumerate(region_n), lambda (i,x):i-x):
-                        ID = map(itemgetter(1), g)
-                        if debug: print 'Index bound: ' +\
-                            str(ID[0]) + '-' + str(ID[-1]+1)
-                        if H==0:
-                            setattr(self, aliaS,
-                            data.variables[key].data[:,ID[0]:(ID[-1]+1)])
-                            H=1
-                        else:
-                            setattr(self, aliaS,                            
-                            np.hstack((getattr(self, aliaS),
-                            data.variables[key].data[:,ID[0]:(ID[-1]+1)])))
-                else:
-                    try:                        
-                        for k, g in groupby(enumerate(region_e), lambda (i,x):i-x):
-                            ID = map(itemgetter(1), g)
-                            if debug: print 'Index bound: ' +\
-                                      str(ID[0]) + '-' + str(ID[-1]+1)
-                            if H==0:
-                                setattr(self, aliaS,
-                                        data.variables[key].\
-                                        data[:,ID[0]:(ID[-1]+1)])
-                                H=1
-                            else:
-                                setattr(self, aliaS,
-                                np.hstack((getattr(self, aliaS),
-                                data.variables[key].data[:,ID[0]:(ID[-1]+1)])))
-                            keyCount +=1
-                    except KeyError:
-                        if debug: print key, " is missing !"
-                        continue
+                try:
+                    if key == 'zeta':
+                        region = region_n
+                    else:
+                        region = region_e
+                    setattr(self, aliaS, load_ranges(data.variables[key].data,
+                                                     region,
+                                                     time_index=slice(None),
+                                                     stats=remoteStats,
+                                                     debug=debug))
+                    keyCount +=1
+                except KeyError:
+                    if debug: print key, " is missing !"
+                    continue
             if keyCount==0:
                 print "---Horizontal variables are missing---"
             self._3D = False 
@@ -164,19 +149,11 @@ Some others shall be generated as methods are being called, ex:
             keyCount = 0
             for key, aliaS in zip(kwl3D, al3D):
                 try:
-                    H = 0 #local counter
-                    for k, g in groupby(enumerate(region_e), lambda (i,x):i-x):
-                        ID = map(itemgetter(1), g)
-                        if debug: print 'Index bound: ' +\
-                                  str(ID[0]) + '-' + str(ID[-1]+1)
-                        if H==0:
-                            setattr(self, aliaS,
-                            data.variables[key].data[:,:,ID[0]:(ID[-1]+1)])
-                            H=1
-                        else:
-                            setattr(self, aliaS,
-                            np.dstack((getattr(self, aliaS),
-                            data.variables[key].data[:,:,ID[0]:(ID[-1]+1)])))
+                    setattr(self, aliaS, load_ranges(data.variables[key].data,
+                                                     region_e,
+                                                     time_index=slice(None),
+                                                     stats=remoteStats,
+                                                     debug=debug))
                     keyCount +=1
                 except KeyError:
                     if debug: print key, " is missing !"
@@ -185,30 +162,22 @@ Some others shall be generated as methods are being called, ex:
                 print "---Vertical variables are missing---"
             else:
                 self._3D = True
+            if debug:
+                print remoteStats['requests'], " requests, ",\
+                      remoteStats['overfetch'], " bytes over-fetched"
         #Not OpenDap
         else:
+            if mem_budget is None:
+                mem_budget = loading_utils.MEM_BUDGET
             #loading hori data
             keyCount = 0
             for key, aliaS in zip(kwl2D, al2D):
                 try:
-                    if key=='zeta':
-                        setattr(self, aliaS, np.zeros((grid.ntime, grid.nnode)))
-                        for i in range(grid.ntime):
-                            #TR comment: looping on time indices is a trick from
-                            #            Mitchell to improve loading time
-                            #TR comment: no idea why I have to transpose here but
-                            #            I do !!
-                            getattr(self, aliaS)[i,:] =\
-                            np.transpose(data.variables[key].data[i,region_n])
-                    else:
-                        setattr(self, aliaS, np.zeros((grid.ntime, grid.nele)))
-                        for i in range(grid.ntime):
-                            #TR comment: looping on time indices is a trick from
-                            #            Mitchell to improve loading time
-                            #TR comment: no idea why I have to transpose here but
-                            #            I do !!
-                            getattr(self, aliaS)[i,:] =\
-                            np.transpose(data.variables[key].data[i,region_e])
+                    setattr(self, aliaS, load_slab(data.variables[key].data,
+                                                   slice(None), region_e,
+                                                   mem_budget=mem_budget,
+                                                   stats=self._load_stats,
+                                                   debug=debug))
                     keyCount +=1
                 except KeyError:
                     if debug: print key, " is missing !"
@@ -221,17 +190,11 @@ Some others shall be generated as methods are being called, ex:
             keyCount = 0
             for key, aliaS in zip(kwl3D, al3D):
                 try:
-                    testKey = data.variables[key]
-                    del testKey
-                    setattr(self, aliaS,
-                    np.zeros((grid.ntime,grid.nlevel, grid.nele)))
-                    for i in range(grid.ntime):
-                        #TR comment: looping on time indices is a trick from
-                        #            Mitchell to improve loading time
-                        #TR comment: no idea why I have to transpose here but
-                        #            I do !!
-                        getattr(self, aliaS)[i,:,:] =\
-                                np.transpose(data.variables[key].data[i,:,region_e])
+                    setattr(self, aliaS, load_slab(data.variables[key].data,
+                                                   slice(None), region_e,
+                                                   mem_budget=mem_budget,
+                                                   stats=self._load_stats,
+                                                   debug=debug))
                     keyCount +=1
                 except KeyError:
                     if debug: print key, " is missing !"
@@ -240,6 +203,10 @@ Some others shall be generated as methods are being called, ex:
                 print "---Vertical variables are missing---"
             else:
                 self._3D = True 
+            if debug:
+                print "Loaded " + str(round(self._load_stats['bytes'] / 1024.0**2, 1))\
+                      + " MB at " + str(round(transfer_rate(self._load_stats['bytes'],
+                                             self._load_stats['seconds']), 1)) + " MB/s"
         if debug:
            print '...Passed'
 
@@ -5,6 +5,7 @@ from __future__ import division
 import numpy as np
 from utide import ut_solv, ut_reconstr
 from miscellaneous import mattime_to_datetime 
+from harmonic_utils import harmonic_reconstruction
 
 class FunctionsTidegauge:
     ''''Utils' subset of TideGauge class gathers useful functions""" '''
@@ -53,7 +54,8 @@ class FunctionsTidegauge:
                        self._var.lat, **kwarg)
         return harmo
 
-    def reconstr(self, harmo, time_ind=slice(None), **kwarg):
+    def reconstr(self, harmo, time_ind=slice(None), mattime=[],
+                 filename=None, **kwarg):
         '''
         Description:
         ----------
@@ -73,6 +75,10 @@ class FunctionsTidegauge:
         Keywords:
         ------
           - time_ind = time indices to process, list of integers
+          - mattime = matlab times to reconstruct at, 1D array.
+                      Overrides time_ind, i.e. for predictions
+          - filename = path of the *.npy file the reconstruction of many
+                       coefficient sets is written to
 
         Options:
         -------
@@ -84,9 +90,19 @@ class FunctionsTidegauge:
         -----
         For more detailed information about ut_reconstr, please see
         https://github.com/wesleybowman/UTide
+        A list of coefficient sets is reconstructed at once, see
+        harmonic_utils.harmonic_reconstruction. In that case, only the
+        cnstit option applies.
 
         '''
-        time = self._var.matlabTime[time_ind]
+        if not len(mattime)==0:
+            time = np.asarray(mattime)
+        else:
+            time = self._var.matlabTime[time_ind]
+        if type(harmo)==list or np.ndim(harmo['g'])>1:
+            return harmonic_reconstruction(time, harmo,
+                                           cnstit=kwarg.get('cnstit', []),
+                                           filename=filename)
         ts_recon, _ = ut_reconstr(time, harmo, **kwarg)
         return ts_recon
 
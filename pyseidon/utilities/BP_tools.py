@@ -103,82 +103,161 @@ def get_DirFromN(u,v):
     return theta
 
 def sign_speed(u_all, v_all, s_all, dir_all, flood_heading):
-
-    if type(flood_heading)==int:
-        flood_heading += np.array([-90, 90])
-
-    s_signed_all = np.empty(spd_all.shape)
-    s_signed_all.fill(np.nan)
-
-    PA_all = np.zeros(s_all.shape[-1])
-    for i in xrange(s_all.shape[-1]):
-        u = u_all[:, i]
-        v = v_all[:, i]
-        dir = dir_all[:, i]
-        s = s_all[:, i]
-
-        #determine principal axes - potentially a problem if axes are very kinked
-        #   since this would misclassify part of ebb and flood
-        PA, _ = principal_axis(u, v)
-        PA_all[i] = PA
-
-        # sign speed - eliminating wrap-around
-        dir_PA = dir - PA
-
-        dir_PA[dir_PA < -90] += 360
-        dir_PA[dir_PA > 270] -= 360
-
-        #dir_PA[dir_PA<-90] = dir_PA(dir_PA<-90) + 360;
-        #dir_PA(dir_PA>270) = dir_PA(dir_PA>270) - 360;
-
-        #general direction of flood passed as input argument
-        #if PA >= flood_heading[0] and PA <= flood_heading[1]:
-        if flood_heading[0] <= PA <= flood_heading[1]:
-            #ind_fld = find(dir_PA >= -90 & dir_PA<90)
-            ind_fld = np.where((dir_PA >= -90) & (dir_PA<90))
-            s_signed = -s
-            s_signed[ind_fld] = s[ind_fld]
-        else:
-            ind_ebb = np.where((dir_PA >= -90) & (dir_PA<90))
-            s_signed = s
-            s_signed[ind_ebb] = -s[ind_ebb]
-
-        s_signed_all[:, i] = s_signed
+    '''
+    Signed speeds of many velocity time series, i.e. ADCP bins.
+
+    Inputs:
+    ------
+      - u_all, v_all = velocity components, 2D arrays (ntime, nseries)
+      - s_all = speeds, 2D array (ntime, nseries)
+      - dir_all = directions from North, 2D array (ntime, nseries).
+                  Not used, kept for compatibility
+      - flood_heading = general direction of flood in degrees from North,
+                        float or range [min, max]
+
+    Outputs:
+    -------
+      - s_signed_all = signed speeds, positive on flood, 2D array
+      - PA_all = flood headings in degrees from North, 1D array (nseries)
+
+    Notes:
+    -----
+      - all series are split at once, see flood_ebb_split
+    '''
+    PA_all, _, _, flood = flood_ebb_split(u_all, v_all,
+                                          flood_heading=flood_heading)
+    s_signed_all = np.where(flood, s_all, -1.0 * np.asarray(s_all))
 
     return s_signed_all, PA_all
 
 def principal_axis(u, v):
+    '''
+    Principal axis of a velocity time series, see principal_axes.
+
+    Inputs:
+    ------
+      - u = eastward component, 1D array
+      - v = northward component, 1D array
+
+    Outputs:
+    -------
+      - PA = principal axis heading in degrees from North, clockwise,
+             in [0, 180[, float
+      - varxp_PA = fraction of the variance along the principal axis, float
+    '''
+    return principal_axes(u, v)
+
+def principal_axes(u, v):
+    '''
+    Principal axes of many velocity time series at once.
+
+    Inputs:
+    ------
+      - u = eastward component, 1D array (ntime) or 2D array (ntime, nseries)
+      - v = northward component, array like u
+
+    Outputs:
+    -------
+      - PA = principal axis heading in degrees from North, clockwise,
+             in [0, 180[, float or 1D array (nseries)
+      - varxp_PA = fraction of the variance along the principal axis,
+                   float or 1D array (nseries)
+
+    Notes:
+    -----
+      - the 2x2 covariance matrices of all the series are computed at once
+        and their eigen decompositions are solved in closed form,
+        instead of calling np.linalg.eig for each series
+      - nan samples are ignored
+    '''
+    oneD = (np.ndim(u)==1)
+    u = np.ma.filled(np.ma.asarray(u, dtype=float), np.nan)
+    v = np.ma.filled(np.ma.asarray(v, dtype=float), np.nan)
+    if oneD:
+        u = u[:,None]
+        v = v[:,None]
+
+    #covariance matrices [[suu, suv], [suv, svv]]
+    valid = ~(np.isnan(u) + np.isnan(v))
+    n = valid.sum(axis=0)
+    du = np.where(valid, u, 0.0)
+    dv = np.where(valid, v, 0.0)
+    du = np.where(valid, du - du.sum(axis=0) / n, 0.0)
+    dv = np.where(valid, dv - dv.sum(axis=0) / n, 0.0)
+    suu = (du**2).sum(axis=0) / (n - 1)
+    svv = (dv**2).sum(axis=0) / (n - 1)
+    suv = (du*dv).sum(axis=0) / (n - 1)
+
+    #eigenvalues and angle of the major axis from East
+    radius = np.sqrt(((suu - svv) / 2.0)**2 + suv**2)
+    lamb1 = (suu + svv) / 2.0 + radius
+    lamb2 = (suu + svv) / 2.0 - radius
+    ra = 0.5 * np.arctan2(2.0 * suv, suu - svv)
 
-    #create velocity matrix
-    U = np.vstack((u,v)).T
-    #eliminate NaN values
-    U = U[~np.isnan(U[:, 0]), :]
-    #convert matrix to deviate form
-    rep = np.tile(np.mean(U, axis=0), [len(U), 1])
-    U -= rep
-    #compute covariance matrix
-    R = np.dot(U.T, U) / (len(U) - 1)
-
-    #calculate eigenvalues and eigenvectors for covariance matrix
-    lamb, V = np.linalg.eig(R)
-    #sort eignvalues in descending order so that major axis is given by first eigenvector
-    # sort in descending order with indices
-    ilamb = sorted(range(len(lamb)), key=lambda k: lamb[k], reverse=True)
-    lamb = sorted(lamb, reverse=True)
-    # reconstruct the eigenvalue matrix
-    lamb = np.diag(lamb)
-    #reorder the eigenvectors
-    V = V[:, ilamb]
-
-    #rotation angle of major axis in radians relative to cartesian coordiantes
-    ra = np.arctan2(V[0,1], V[1,1])
     #express principal axis in compass coordinates
-    PA = -ra * 180 / np.pi + 90
-    #variance captured by principal
-    varxp_PA = np.diag(lamb[0]) / np.trace(lamb)
+    PA = np.mod(90.0 - ra * 180.0 / np.pi, 180.0)
+    varxp_PA = lamb1 / (lamb1 + lamb2)
 
+    if oneD:
+        return PA[0], varxp_PA[0]
     return PA, varxp_PA
 
+def flood_ebb_split(u, v, flood_heading=None):
+    '''
+    Principal axes, signed speeds and flood/ebb of many velocity time series
+    in one pass.
+
+    Inputs:
+    ------
+      - u = eastward component, 1D array (ntime) or 2D array (ntime, nseries)
+      - v = northward component, array like u
+
+    Outputs:
+    -------
+      - PA = flood heading in degrees from North, clockwise,
+             float or 1D array (nseries)
+      - varxp_PA = fraction of the variance along the principal axis,
+                   float or 1D array (nseries)
+      - s_signed = signed speed, positive on flood, array like u
+      - flood = flood time steps, array of booleans like u
+
+    Keywords:
+    --------
+      - flood_heading = general direction of flood in degrees from North,
+                        float (+/- 90 degrees) or range [min, max].
+                        Default: the principal axis heading in [0, 180[
+                        is the flood direction
+
+    Notes:
+    -----
+      - assume that flood is aligned with principal direction: flood is
+        a positive velocity component along PA
+      - the principal axes are computed at once, see principal_axes
+      - nan samples are not flood and have a nan signed speed
+    '''
+    PA, varxp_PA = principal_axes(u, v)
+    u = np.ma.filled(np.ma.asarray(u, dtype=float), np.nan)
+    v = np.ma.filled(np.ma.asarray(v, dtype=float), np.nan)
+
+    #principal axis direction within the flood heading range
+    if not flood_heading is None:
+        if np.ndim(flood_heading)==0:
+            flood_heading = flood_heading + np.array([-90.0, 90.0])
+        lo, hi = flood_heading[0], flood_heading[1]
+        inside = np.mod(PA - lo, 360.0) <= np.mod(hi - lo, 360.0)
+        PA = np.where(inside, PA, np.mod(PA + 180.0, 360.0))
+
+    #velocity component along the flood heading
+    heading = np.deg2rad(PA)
+    along = u * np.sin(heading) + v * np.cos(heading)
+    flood = along > 0.0
+    s_signed = np.sqrt(u**2 + v**2)
+    s_signed = np.where(flood, s_signed, -1.0 * s_signed)
+
+    if np.ndim(PA)==0:
+        PA = float(PA)
+    return PA, varxp_PA, s_signed, flood
+
 
 class Struct:
     def __init__(self, **entries):
@@ -0,0 +1,266 @@
+#!/usr/bin/python2.7
+# encoding: utf-8
+
+from __future__ import division
+import numpy as np
+from multiprocessing import Pool
+from loading_utils import MEM_BUDGET
+
+def neighbour_index(triele):
+    """
+    Gathers the element stencil used with a1u and a2u.
+
+    Inputs:
+    ------
+      - triele = FVCOM triele, numpy array, dim=(nele,3),
+                 0-based with -1 standing for no neighbour
+
+    Outputs:
+    -------
+      - index = element itself and its 3 neighbours, dim=(4,nele)
+
+    Notes:
+    -----
+      - missing neighbours point to a ghost column, i.e. nele,
+        which curl fills with zeros
+    """
+    neighbours = np.array(triele[:], dtype=int)
+    neighbours[neighbours<0] = neighbours.shape[0]
+    index = np.vstack((np.arange(neighbours.shape[0]), neighbours.T))
+
+    return index
+
+def curl(u, v, index, a1u, a2u):
+    """
+    Computes dv/dx - du/dy of element variables.
+
+    Inputs:
+    ------
+      - u, v = velocity components, array (..., nele)
+      - index = stencil, see neighbour_index, dim=(4,nele)
+      - a1u, a2u = grid parameters, dim=(4,nele)
+
+    Outputs:
+    -------
+      - vort = vorticity (1/s), array (..., nele)
+    """
+    #Ghost column of the missing neighbours
+    u = np.asarray(u)
+    v = np.asarray(v)
+    ghost = np.zeros(u.shape[:-1] + (1,))
+    u = np.concatenate((u, ghost), axis=-1)
+    v = np.concatenate((v, ghost), axis=-1)
+    dvdx = a1u[0,:] * v[..., index[0]]
+    dudy = a2u[0,:] * u[..., index[0]]
+    for k in range(1, 4):
+        dvdx += a1u[k,:] * v[..., index[k]]
+        dudy += a2u[k,:] * u[..., index[k]]
+
+    return dvdx - dudy
+
+#Stencil shared by the worker processes, see _init_worker
+_stencil = {}
+
+def _init_worker(index, a1u, a2u):
+    _stencil['index'] = index
+    _stencil['a1u'] = a1u
+    _stencil['a2u'] = a2u
+
+def _curl_worker(args):
+    u, v = args
+    return curl(u, v, _stencil['index'], _stencil['a1u'], _stencil['a2u'])
+
+def vorticity_field(u, v, index, a1u, a2u, time_index=None, chunk=None,
+                    processes=1, filename=None, debug=False):
+    """
+    Computes the vorticity over the whole domain by time blocks.
+
+    Inputs:
+    ------
+      - u, v = velocity components, array (ntime, [nlevel,] nele)
+      - index = stencil, see neighbour_index, dim=(4,nele)
+      - a1u, a2u = grid parameters, dim=(4,nele)
+
+    Outputs:
+    -------
+      - vort = vorticity (1/s), array (len(time_index), [nlevel,] nele)
+
+    Keywords:
+    --------
+      - time_index = time indices to work in, 1D array of integers
+      - chunk = number of time steps per block, integer.
+                Default fits loading_utils.MEM_BUDGET
+      - processes = number of worker processes the blocks are spread on
+      - filename = path of the *.npy file the result is written to,
+                   None to keep the result in memory
+    """
+    if time_index is None:
+        time_index = np.arange(u.shape[0])
+    time_index = np.asarray(time_index, dtype=int).ravel()
+    ntime = time_index.shape[0]
+    a1u = np.asarray(a1u[:])
+    a2u = np.asarray(a2u[:])
+    if chunk is None:
+        stepBytes = 6 * 8 * int(np.prod(u.shape[1:]))
+        chunk = max(1, int(MEM_BUDGET // stepBytes))
+    blocks = [(i, min(i + chunk, ntime)) for i in range(0, ntime, chunk)]
+
+    shape = (ntime,) + tuple(u.shape[1:])
+    if filename is None:
+        vort = np.empty(shape)
+    else:
+        vort = np.lib.format.open_memmap(filename, mode='w+',
+                                         dtype=np.float64, shape=shape)
+    read = lambda (t0, t1): (u[time_index[t0:t1]], v[time_index[t0:t1]])
+
+    if processes > 1:
+        pool = Pool(processes, initializer=_init_worker,
+                    initargs=(index, a1u, a2u))
+        try:
+            #one wave of blocks per process at a time to bound memory
+            for w in range(0, len(blocks), processes):
+                wave = blocks[w:w+processes]
+                results = pool.map(_curl_worker, [read(b) for b in wave])
+                for (t0, t1), block in zip(wave, results):
+                    vort[t0:t1] = block
+                if debug: print 'Block: ' + str(wave[0][0]) + '-' + str(wave[-1][1])
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for t0, t1 in blocks:
+            bu, bv = read((t0, t1))
+            vort[t0:t1] = curl(bu, bv, index, a1u, a2u)
+            if debug: print 'Block: ' + str(t0) + '-' + str(t1)
+
+    if not filename is None:
+        vort.flush()
+
+    return vort
+
+def depth_interpolation(var, dep, depths, ind=None):
+    """
+    Interpolates a (time, level, space) variable onto given depths.
+
+    Inputs:
+    ------
+      - var = variable, array (ntime, nlevel, nele or node)
+      - dep = depth of the sigma layers (m), array like var,
+              negative and decreasing along the level axis
+      - depths = target depths (m), float or list of floats
+
+    Outputs:
+    -------
+      - interpVar = interpolated variable, array (ntime, ndepth, nele or node),
+                    nan where the target depth is outside the water column
+      - ind = index of the layer above each target depth, array like
+              interpVar, nan where the target depth is outside the water column
+
+    Keywords:
+    --------
+      - ind = previously returned layer indexes, skips the search
+
+    Notes:
+    -----
+      - the layer above a target depth is found by counting the layers
+        above it, i.e. a search along the level axis
+    """
+    var = np.asarray(var)
+    dep = np.asarray(dep)
+    nt, nlevel, nspace = dep.shape
+    depths = np.atleast_1d(np.asarray(depths, dtype=float))
+    target = depths[None,:,None]
+
+    if ind is None:
+        count = np.empty((nt, depths.shape[0], nspace), dtype=int)
+        for k in range(depths.shape[0]):
+            count[:,k,:] = (dep > depths[k]).sum(axis=1)
+        ind = (count - 1).astype(float)
+        ind[(count==0) | (count==nlevel)] = np.nan
+    nan = np.isnan(ind)
+
+    #Bracketing layers
+    iU = np.where(nan, 0, ind).astype(int)
+    iD = np.minimum(iU + 1, nlevel - 1)
+    t = np.arange(nt)[:,None,None]
+    s = np.arange(nspace)[None,None,:]
+    dU = dep[t, iU, s]
+    dD = dep[t, iD, s]
+
+    #Linear weights
+    with np.errstate(divide='ignore', invalid='ignore'):
+        length = np.abs(dU - dD)
+        wU = np.abs(target - dD) / length
+        wD = np.abs(target - dU) / length
+        interpVar = (wU * var[t, iU, s]) + (wD * var[t, iD, s])
+    interpVar[nan] = np.nan
+
+    return interpVar, ind
+
+def node_to_element(var, trinodes):
+    """
+    Averages a nodal variable onto the element centres.
+
+    Inputs:
+    ------
+      - var = nodal variable, array (..., nnode)
+      - trinodes = FVCOM trinodes, numpy array, dim=(nele,3)
+
+    Outputs:
+    -------
+      - varc = variable at the element centres, array (..., nele)
+    """
+    var = np.asarray(var)
+    trinodes = np.asarray(trinodes[:], dtype=int)
+
+    return (var[..., trinodes[:,0]] + var[..., trinodes[:,1]]
+            + var[..., trinodes[:,2]]) / 3.0
+
+class DepthField(object):
+    """
+    Depth of the sigma layers at the element centres (m), computed from
+    the elevation on access instead of being stored.
+
+    Inputs:
+    ------
+      - el = elevation (m), array (ntime, nnode)
+      - h = bathymetry (m), array (nnode)
+      - siglay = sigma layers, array (nlevel, nnode)
+      - trinodes = FVCOM trinodes, numpy array, dim=(nele,3)
+
+    Notes:
+    -----
+      - behaves as a (ntime, nlevel, nele) array, i.e. depth[t0:t1]
+        only computes the depth of time steps t0 to t1
+      - depth convention: 0 = free surface
+    """
+    def __init__(self, el, h, siglay, trinodes):
+        self._el = el
+        self._trinodes = np.asarray(trinodes[:], dtype=int)
+        self._hc = node_to_element(h[:], self._trinodes)
+        self._siglayc = node_to_element(siglay[:], self._trinodes)
+        self.shape = (el.shape[0],) + self._siglayc.shape
+        self.ndim = 3
+        self.dtype = np.dtype(np.float64)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        if dtype is None:
+            return self[:]
+        return self[:].astype(dtype)
+
+    def __getitem__(self, key):
+        if not type(key)==tuple:
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = [k is Ellipsis for k in key].index(True)
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1)\
+                + key[i+1:]
+        elc = node_to_element(self._el[key[0]], self._trinodes)
+        zeta = elc + self._hc
+        dep = zeta[..., None, :] * self._siglayc
+        if dep.ndim==3:
+            return dep[(slice(None),) + key[1:]]
+        return dep[key[1:]]
@@ -0,0 +1,543 @@
+#!/usr/bin/python2.7
+# encoding: utf-8
+
+from __future__ import division
+import numpy as np
+import copy
+import os
+import sys
+import cPickle as pickle
+from multiprocessing import Pool
+from scipy.linalg import solve_triangular
+from utide import ut_solv, ut_reconstr
+from loading_utils import load_slab, MEM_BUDGET
+
+def harmonic_basis(time, coef):
+    """
+    Builds the harmonic design matrix of a set of constituents.
+
+    Inputs:
+    ------
+      - time = matlab time, 1D array (ntime)
+      - coef = harmonic coefficients from ut_solv, dictionary
+
+    Outputs:
+    -------
+      - C, S = F*cos(U+V) and F*sin(U+V) of every constituent of coef,
+               arrays (ntime, nconstit)
+
+    Notes:
+    -----
+      - built from ut_reconstr of unit amplitude constituents, with
+        phase 0 for C and 90 for S, so that the nodal corrections and
+        astronomical arguments are exactly the ones of UTide
+      - the nodal corrections use the mean latitude of coef
+    """
+    names = list(coef['name'])
+    nc = len(names)
+    #Scalar coefficients at a single latitude
+    unit = dict(coef)
+    unit['aux'] = copy.deepcopy(coef['aux'])
+    unit['aux']['opt']['twodim'] = False
+    unit['aux']['lat'] = float(np.mean(coef['aux']['lat']))
+    unit['mean'] = 0.0
+    unit['slope'] = 0.0
+    C = np.empty((time.shape[0], nc))
+    S = np.empty((time.shape[0], nc))
+    for k in range(nc):
+        for phase, basis in ((0.0, C), (90.0, S)):
+            unit['A'] = np.zeros(nc)
+            unit['g'] = np.zeros(nc)
+            unit['A'][k] = 1.0
+            unit['g'][k] = phase
+            basis[:,k], _ = ut_reconstr(time, unit, cnstit=names)
+
+    return C, S
+
+def cs_to_ellipse(au, bu, av, bv):
+    """
+    Converts cosine and sine coefficients of u and v into tidal ellipses.
+
+    Inputs:
+    ------
+      - au, bu = cosine and sine coefficients of u, arrays
+      - av, bv = cosine and sine coefficients of v, arrays
+
+    Outputs:
+    -------
+      - Lsmaj, Lsmin = semi-major and semi-minor axes, arrays
+      - theta = inclination in degrees, in [0, 180[, arrays
+      - g = phase in degrees, in [0, 360[, arrays
+
+    Notes:
+    -----
+      - same conventions as ut_cs2cep in UTide
+    """
+    ap = ((au + bv) + 1j * (av - bu)) / 2.0
+    am = ((au - bv) + 1j * (av + bu)) / 2.0
+    Lsmaj = np.abs(ap) + np.abs(am)
+    Lsmin = np.abs(ap) - np.abs(am)
+    epsp = np.angle(ap) * 180.0 / np.pi
+    epsm = np.angle(am) * 180.0 / np.pi
+    theta = np.mod((epsp + epsm) / 2.0, 180.0)
+    g = np.mod(-epsp + theta, 360.0)
+
+    return Lsmaj, Lsmin, theta, g
+
+def ellipse_to_cs(Lsmaj, Lsmin, theta, g):
+    """
+    Converts tidal ellipses into cosine and sine coefficients of u and v,
+    inverse of cs_to_ellipse.
+
+    Inputs:
+    ------
+      - Lsmaj, Lsmin = semi-major and semi-minor axes, arrays
+      - theta = inclination in degrees, arrays
+      - g = phase in degrees, arrays
+
+    Outputs:
+    -------
+      - au, bu, av, bv = cosine and sine coefficients of u and v, arrays
+    """
+    rpd = np.pi / 180.0
+    ap = 0.5 * (Lsmaj + Lsmin) * np.exp(1j * (theta - g) * rpd)
+    am = 0.5 * (Lsmaj - Lsmin) * np.exp(1j * (theta + g) * rpd)
+
+    return (ap + am).real, -(ap - am).imag, (ap + am).imag, (ap - am).real
+
+def harmonic_analysis(time, lat, u, v=None, time_index=slice(None),
+                      space_index=slice(None), mem_budget=MEM_BUDGET,
+                      debug=False, **kwarg):
+    """
+    Harmonic analysis of many locations sharing the same time vector.
+
+    Inputs:
+    ------
+      - time = matlab time, 1D array (ntime)
+      - lat = latitude of the locations, float or 1D array
+      - u = elevation or u velocity component, array (ntime, nele or nnode)
+
+    Outputs:
+    -------
+      - harmo = harmonic coefficients, dictionary with the keys of ut_solv
+                where per constituent quantities are arrays
+                (nconstit, nspace) and means and slopes arrays (nspace):
+                'A', 'g', 'mean', 'slope' for a scalar and
+                'Lsmaj', 'Lsmin', 'theta', 'g', 'umean', 'vmean',
+                'uslope', 'vslope' for a velocity
+
+    Keywords:
+    --------
+      - v = v velocity component, array like u
+      - time_index = time indices to work in, slice or 1D array of integers
+      - space_index = element or node indices to work in,
+                      slice or 1D array of integers
+      - mem_budget = maximum size in bytes of the data blocks, integer
+
+    Options:
+    -------
+    Options are the same as for ut_solv. They define the constituents and
+    the corrections of the reference analysis (see Notes).
+
+    Notes:
+    -----
+      - a reference ut_solv at the first location selects the constituents;
+        the design matrix is then built once for all locations and factorized
+        once (QR), every location being a column of the right-hand side
+      - equivalent to ut_solv with method='ols' at every location,
+        the confidence intervals are not computed
+      - the nodal corrections use the mean latitude of the locations
+    """
+    time = np.asarray(time[:], dtype=float)
+    t = time[time_index]
+    if type(time_index)==slice:
+        time_index = np.arange(time.shape[0])[time_index]
+    if type(space_index)==slice:
+        space_index = np.arange(u.shape[-1])[space_index]
+    space_index = np.asarray(space_index, dtype=int).ravel()
+    nspace = space_index.shape[0]
+    twodim = not v is None
+    lat = np.asarray(lat, dtype=float)
+
+    #Reference analysis: constituents selection and corrections
+    if debug: print 'Reference analysis...'
+    opts = dict(kwarg)
+    opts['method'] = 'ols'
+    series = load_slab(u, time_index, space_index[:1])[:,0]
+    ref = ut_solv(t, series.astype(float), [], float(lat.mean()), **opts)
+
+    #Design matrix: mean, trend and constituents
+    if debug: print 'Building design matrix...'
+    C, S = harmonic_basis(t, ref)
+    nc = C.shape[1]
+    trend = not ref['aux']['opt']['notrend']
+    columns = [np.ones((t.shape[0], 1))]
+    if trend:
+        columns.append((t - ref['aux']['reftime'])[:,None])
+    X = np.hstack(columns + [C, S])
+    nx = len(columns)
+    Q, R = np.linalg.qr(X)
+
+    #All locations solved against the same factorization
+    fields = [u, v] if twodim else [u]
+    beta = [np.empty((X.shape[1], nspace)) for var in fields]
+    cols = max(1, int(mem_budget // (8 * t.shape[0] * len(fields))))
+    for c0 in range(0, nspace, cols):
+        c1 = min(c0 + cols, nspace)
+        for var, b in zip(fields, beta):
+            Y = load_slab(var, time_index, space_index[c0:c1],
+                          mem_budget=mem_budget).astype(float)
+            b[:,c0:c1] = solve_triangular(R, np.dot(Q.T, Y))
+        if debug: print 'Locations: ' + str(c0) + '-' + str(c1)
+
+    harmo = {'name': ref['name'], 'aux': copy.deepcopy(ref['aux']),
+             'index': space_index}
+    harmo['aux']['lat'] = lat
+    if twodim:
+        bu, bv = beta
+        harmo['umean'] = bu[0]
+        harmo['vmean'] = bv[0]
+        if trend:
+            harmo['uslope'] = bu[1]
+            harmo['vslope'] = bv[1]
+        Lsmaj, Lsmin, theta, g = cs_to_ellipse(bu[nx:nx+nc], bu[nx+nc:],
+                                               bv[nx:nx+nc], bv[nx+nc:])
+        harmo['Lsmaj'] = Lsmaj
+        harmo['Lsmin'] = Lsmin
+        harmo['theta'] = theta
+        harmo['g'] = g
+    else:
+        b = beta[0]
+        harmo['mean'] = b[0]
+        if trend:
+            harmo['slope'] = b[1]
+        a, s = b[nx:nx+nc], b[nx+nc:]
+        harmo['A'] = np.sqrt(a**2 + s**2)
+        harmo['g'] = np.mod(np.arctan2(s, a) * 180.0 / np.pi, 360.0)
+
+    return harmo
+
+#Time vector and options shared by the worker processes, see _init_worker
+_shared = {}
+
+def _init_worker(time, kwarg):
+    _shared['time'] = time
+    _shared['kwarg'] = kwarg
+
+def _solv_worker(args):
+    key, u, v, lat = args
+    return key, ut_solv(_shared['time'], u, v, lat, **_shared['kwarg'])
+
+def load_checkpoint(filename):
+    """
+    Reads the results saved by iter_harmonics.
+
+    Inputs:
+    ------
+      - filename = path of the checkpoint file
+
+    Outputs:
+    -------
+      - header = time vector and options of the run which wrote the file,
+                 dictionary {'version', 'time', 'kwarg'}, None if no file
+      - done = harmonic coefficients of the completed locations,
+               dictionary {key: harmo}
+
+    Notes:
+    -----
+      - a truncated last record, i.e. interrupted while writing,
+        is dropped from the file
+    """
+    header = None
+    done = {}
+    if filename is None or not os.path.exists(filename):
+        return header, done
+    with open(filename, 'r+b') as f:
+        end = 0
+        while True:
+            try:
+                key, harmo = pickle.load(f)
+            except EOFError:
+                break
+            except Exception:
+                f.truncate(end)
+                break
+            if key==_HEADER:
+                header = harmo
+            else:
+                done[key] = harmo
+            end = f.tell()
+
+    return header, done
+
+#Key of the first record of a checkpoint file, see iter_harmonics
+_HEADER = '__header__'
+_CHECKPOINT_VERSION = 1
+
+def _same_run(header, time, kwarg):
+    """Tells if a checkpoint header matches the time vector and options"""
+    if header is None or header.get('version')!=_CHECKPOINT_VERSION:
+        return False
+    if not np.array_equal(header['time'], time):
+        return False
+    if sorted(header['kwarg'].keys())!=sorted(kwarg.keys()):
+        return False
+    for k in kwarg:
+        try:
+            if not np.array_equal(header['kwarg'][k], kwarg[k]):
+                return False
+        except Exception:
+            if not header['kwarg'][k]==kwarg[k]:
+                return False
+    return True
+
+def iter_harmonics(time, series, processes=2, checkpoint=None,
+                   debug=False, **kwarg):
+    """
+    Runs ut_solv for many locations on a pool of processes and yields the
+    results as they complete.
+
+    Inputs:
+    ------
+      - time = matlab time, 1D array (ntime)
+      - series = list of (key, u, v, lat) with u and v time series,
+                 1D arrays (ntime), v = [] for the elevation.
+                 key identifies the location and the variable,
+                 e.g. (lon, lat, 'el')
+
+    Outputs:
+    -------
+      - (key, harmo) = location key and harmonic coefficients, generator
+
+    Keywords:
+    --------
+      - processes = number of worker processes, integer
+      - checkpoint = path of the checkpoint file. Completed locations are
+                     appended to it and skipped when running again
+      - debug = prints the progress
+
+    Options:
+    -------
+    Options are the same as for ut_solv
+
+    Notes:
+    -----
+      - only the extracted time series are sent to the workers
+      - locations of series already in the checkpoint file are yielded first
+      - the time vector and options are saved in the checkpoint file,
+        resuming with different ones is refused
+    """
+    time = np.asarray(time)
+    header, done = load_checkpoint(checkpoint)
+    if not header is None and not _same_run(header, time, kwarg):
+        print "---Checkpoint " + checkpoint + " was written with another" +\
+              " time vector or other options---"
+        sys.exit()
+    keys = set(s[0] for s in series)
+    done = dict((key, done[key]) for key in done if key in keys)
+    for key in done:
+        yield key, done[key]
+    todo = [s for s in series if not s[0] in done]
+    ntotal = len(done) + len(todo)
+    if debug and done:
+        print 'Resuming from ' + checkpoint + ': ' + str(len(done)) + '/' +\
+              str(ntotal) + ' done'
+    if todo==[]:
+        return
+
+    log = None
+    if not checkpoint is None:
+        log = open(checkpoint, 'ab')
+        if header is None:
+            header = {'version': _CHECKPOINT_VERSION, 'time': time,
+                      'kwarg': kwarg}
+            pickle.dump((_HEADER, header), log, pickle.HIGHEST_PROTOCOL)
+            log.flush()
+    if processes > 1:
+        pool = Pool(processes, initializer=_init_worker, initargs=(time, kwarg))
+        results = pool.imap_unordered(_solv_worker, todo)
+    else:
+        pool = None
+        _init_worker(time, kwarg)
+        results = (_solv_worker(s) for s in todo)
+    try:
+        count = len(done)
+        for key, harmo in results:
+            if not log is None:
+                pickle.dump((key, harmo), log, pickle.HIGHEST_PROTOCOL)
+                log.flush()
+            count += 1
+            if debug: print 'Harmonic analysis: ' + str(count) + '/' + str(ntotal)
+            yield key, harmo
+    finally:
+        if not pool is None:
+            pool.terminate()
+            pool.join()
+        if not log is None:
+            log.close()
+
+def harmonic_pool(time, series, processes=2, checkpoint=None,
+                  debug=False, **kwarg):
+    """
+    Runs ut_solv for many locations on a pool of processes.
+
+    Inputs:
+    ------
+      - time = matlab time, 1D array (ntime)
+      - series = list of (key, u, v, lat), see iter_harmonics
+
+    Outputs:
+    -------
+      - harmos = harmonic coefficients, list of dictionaries
+                 in the order of series
+
+    Keywords:
+    --------
+      - processes = number of worker processes, integer
+      - checkpoint = path of the checkpoint file, see iter_harmonics
+
+    Options:
+    -------
+    Options are the same as for ut_solv
+    """
+    results = dict(iter_harmonics(time, series, processes=processes,
+                                  checkpoint=checkpoint, debug=debug,
+                                  **kwarg))
+
+    return [results[s[0]] for s in series]
+
+def stack_harmonics(harmos):
+    """
+    Gathers harmonic coefficients of several locations.
+
+    Inputs:
+    ------
+      - harmos = harmonic coefficients from ut_solv, list of dictionaries
+
+    Outputs:
+    -------
+      - harmo = harmonic coefficients, dictionary like the output of
+                harmonic_analysis, i.e. arrays (nconstit, nlocation)
+
+    Notes:
+    -----
+      - constituents are matched by name against the ones of harmos[0],
+        a constituent missing at a location has a null amplitude
+    """
+    names = list(harmos[0]['name'])
+    nc = len(names)
+    twodim = 'Lsmaj' in harmos[0]
+    if twodim:
+        constit = ['Lsmaj', 'Lsmin', 'theta', 'g']
+        means = ['umean', 'vmean', 'uslope', 'vslope']
+    else:
+        constit = ['A', 'g']
+        means = ['mean', 'slope']
+
+    harmo = {'name': harmos[0]['name'],
+             'aux': copy.deepcopy(harmos[0]['aux'])}
+    for key in constit:
+        harmo[key] = np.zeros((nc, len(harmos)))
+    for key in means:
+        harmo[key] = np.array([h.get(key, 0.0) for h in harmos], dtype=float)
+    for i, h in enumerate(harmos):
+        own = list(h['name'])
+        rows = [k for k, name in enumerate(names) if name in own]
+        cols = [own.index(names[k]) for k in rows]
+        for key in constit:
+            harmo[key][rows,i] = np.asarray(h[key])[cols]
+    harmo['aux']['lat'] = np.array([h['aux']['lat'] for h in harmos])
+
+    return harmo
+
+def harmonic_reconstruction(time, harmo, cnstit=[], filename=None,
+                            mem_budget=MEM_BUDGET, debug=False):
+    """
+    Reconstructs the signal of many locations from harmonic coefficients.
+
+    Inputs:
+    ------
+      - time = target matlab time, 1D array (ntime)
+      - harmo = harmonic coefficients from harmonic_analysis or
+                stack_harmonics, dictionary, or list of dictionaries
+                from ut_solv
+
+    Outputs:
+    -------
+      - recon = reconstructed elevation, array (ntime, nlocation),
+                or (U, V) reconstructed velocity components
+
+    Keywords:
+    --------
+      - cnstit = names of the constituents to use, list of strings.
+                 Default is all of them
+      - filename = path of the *.npy file the result is written to,
+                   None to keep the result in memory. For the velocity,
+                   U and V are written to *_u.npy and *_v.npy
+      - mem_budget = maximum size in bytes of the time blocks, integer
+
+    Notes:
+    -----
+      - each time block is the matrix product of the cos/sin bases of all
+        constituents, see harmonic_basis, with the coefficients of all
+        locations
+      - constituents are not selected on their SNR, unlike ut_reconstr
+    """
+    if type(harmo)==list:
+        harmo = stack_harmonics(harmo)
+    time = np.asarray(time[:], dtype=float).ravel()
+    ntime = time.shape[0]
+    names = list(harmo['name'])
+    keep = range(len(names))
+    if not cnstit==[]:
+        keep = [k for k, name in enumerate(names) if name in cnstit]
+    twodim = 'Lsmaj' in harmo
+    reftime = harmo['aux']['reftime']
+    trend = not harmo['aux']['opt']['notrend']
+    basisCoef = {'name': harmo['name'], 'aux': harmo['aux']}
+
+    #Cosine and sine coefficients, (nconstit, nlocation)
+    if twodim:
+        au, bu, av, bv = ellipse_to_cs(*[np.asarray(harmo[key])[keep]
+                             for key in ['Lsmaj', 'Lsmin', 'theta', 'g']])
+        coefs = [(au, bu, harmo['umean'], harmo.get('uslope', 0.0)),
+                 (av, bv, harmo['vmean'], harmo.get('vslope', 0.0))]
+    else:
+        A = np.asarray(harmo['A'])[keep]
+        g = np.asarray(harmo['g'])[keep] * np.pi / 180.0
+        coefs = [(A * np.cos(g), A * np.sin(g), harmo['mean'],
+                  harmo.get('slope', 0.0))]
+    nspace = np.asarray(coefs[0][0]).reshape(len(keep), -1).shape[1]
+
+    if filename is None:
+        out = [np.empty((ntime, nspace)) for c in coefs]
+    else:
+        root = os.path.splitext(filename)[0]
+        paths = [root + '.npy'] if not twodim else [root + '_u.npy',
+                                                    root + '_v.npy']
+        out = [np.lib.format.open_memmap(path, mode='w+', dtype=np.float64,
+                                         shape=(ntime, nspace))
+               for path in paths]
+
+    rows = max(1, int(mem_budget // (8 * (nspace * len(coefs) + 2 * len(keep)))))
+    for t0 in range(0, ntime, rows):
+        t1 = min(t0 + rows, ntime)
+        t = time[t0:t1]
+        C, S = harmonic_basis(t, basisCoef)
+        C, S = C[:,keep], S[:,keep]
+        for (a, b, mean, slope), o in zip(coefs, out):
+            block = np.dot(C, np.reshape(a, (len(keep), nspace)))\
+                  + np.dot(S, np.reshape(b, (len(keep), nspace)))
+            block += mean
+            if trend:
+                block += np.outer(t - reftime, slope)
+            o[t0:t1] = block
+        if debug: print 'Block: ' + str(t0) + '-' + str(t1)
+
+    if not filename is None:
+        for o in out:
+            o.flush()
+            if debug: print 'Written to ' + o.filename
+    if twodim:
+        return out[0], out[1]
+    return out[0]
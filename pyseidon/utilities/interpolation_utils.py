@@ -2,12 +2,21 @@
 # encoding: utf-8
 
 import sys
+import os
+import hashlib
+import cPickle as pkl
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.tri as Tri
 import matplotlib.ticker as ticker
 from matplotlib.path import Path
-from scipy.spatial import KDTree
+from scipy.spatial import KDTree, cKDTree
+from scipy import sparse
+from object_from_dict import ObjectFromDict
+
+#Location of the on-disk spatial index cache, None (default) to disable it,
+#e.g. os.path.join(os.path.expanduser('~'), '.pyseidon', 'index')
+INDEX_CACHE_DIR = None
 
 def closest_point( pt_lon, pt_lat, lon, lat, debug=False):
     '''
@@ -21,49 +30,303 @@ def closest_point( pt_lon, pt_lat, lon, lat, debug=False):
       - lat = list of latitudes in degrees to search in
     Outputs:
       - closest_point_indexes = numpy array of grid indexes
+
+    Notes:
+      - kept for external callers, see closest_element and closest_node
+        which reuse the grid spatial index
     '''
     if debug:
         print 'Computing closest_point_indexes...'
+    points = ObjectFromDict({'lon': lon, 'lat': lat})
+    closest_point_indexes = closest_node(points, pt_lon, pt_lat, debug=debug)
+    if debug:
+        print '...Passed'
 
-    lonc=lon[:]
-    latc=lat[:]
-    points = np.array([pt_lon, pt_lat]).T
-    point_list = np.array([lonc, latc]).T
+    return closest_point_indexes
 
-    #closest_dist = (np.square((point_list[:, 0] - points[:, 0, None])) +
-    #                np.square((point_list[:, 1] - points[:, 1, None])))
+def grid_hash(lon, lat):
+    """
+    Return a hash identifying a set of grid coordinates.
 
-    #closest_point_indexes = np.argmin(closest_dist, axis=1)
-    
-    #Wesley's optimized version of this bottleneck
-    point_list0 = point_list[:, 0]
-    points0 = points[:, 0, None]
-    point_list1 = point_list[:, 1]
-    points1 = points[:, 1, None]
-    
-    closest_dist = ((point_list0 - points0) *
-                    (point_list0 - points0) +
-                    (point_list1 - points1) *
-                    (point_list1 - points1)
-                    )
-    closest_point_indexes = np.argmin(closest_dist, axis=1)
-
-    #Thomas' optimized version of this bottleneck    
-    #closest_point_indexes = np.zeros(points.shape[0])
-    #for i in range(points.shape[0]):
-    #    dist=((point_list-points[i,:])**2).sum(axis=1)    
-    #    ndx = d.argsort()
-    #    closest_point_indexes[i] = ndx[0]
+    Inputs:
+      - lon = list of longitudes in degrees
+      - lat = list of latitudes in degrees
+    Outputs:
+      - hash = hexadecimal digest, string
+    """
+    sha = hashlib.sha1()
+    for coord in [lon, lat]:
+        coord = np.ascontiguousarray(coord[:], dtype=np.float64)
+        sha.update(str(coord.shape))
+        sha.update(coord.tostring())
+
+    return sha.hexdigest()
+
+def spatial_index(grid, kind='ele', debug=False):
+    """
+    Return KD-tree spatial index of the grid element centres or nodes.
+    The index is built once and stored in grid._spatial_index. If
+    INDEX_CACHE_DIR is set, it is also cached on disk under the grid hash
+    for the next sessions; unreadable cache files are rebuilt.
+
+    Inputs:
+      - grid = FVCOM or Station grid, i.e. FVCOM.Grid
+    Outputs:
+      - tree = scipy.spatial.cKDTree of (lon, lat) coordinates
+    Keywords:
+      - kind = 'ele' for element centres (lonc, latc) or 'node' for nodes
+    """
+    if not hasattr(grid, '_spatial_index'):
+        grid._spatial_index = {}
+    if kind in grid._spatial_index:
+        return grid._spatial_index[kind]
+
+    if kind=='ele':
+        lon = grid.lonc[:]
+        lat = grid.latc[:]
+    elif kind=='node':
+        lon = grid.lon[:]
+        lat = grid.lat[:]
+    else:
+        print "---Wrong kind of spatial index---"
+        sys.exit()
+
+    tree = None
+    filename = None
+    if not INDEX_CACHE_DIR is None:
+        filename = os.path.join(INDEX_CACHE_DIR, grid_hash(lon, lat) + '.p')
+        if os.path.exists(filename):
+            if debug: print 'Loading spatial index from ' + filename + '...'
+            try:
+                f = open(filename, 'rb')
+                try:
+                    tree = pkl.load(f)
+                finally:
+                    f.close()
+                if not (isinstance(tree, cKDTree) and tree.n==lon.shape[0]):
+                    tree = None
+            except Exception:
+                #Corrupt or incompatible file
+                if debug: print 'Spatial index cache unreadable, rebuilding'
+                tree = None
+    if tree is None:
+        if debug: print 'Building spatial index...'
+        tree = cKDTree(np.vstack((lon, lat)).T)
+        if not filename is None:
+            tmp = filename + '.' + str(os.getpid()) + '.tmp'
+            try:
+                if not os.path.exists(INDEX_CACHE_DIR):
+                    os.makedirs(INDEX_CACHE_DIR)
+                f = open(tmp, 'wb')
+                try:
+                    pkl.dump(tree, f, protocol=pkl.HIGHEST_PROTOCOL)
+                finally:
+                    f.close()
+                os.rename(tmp, filename)
+            except (IOError, OSError, pkl.PicklingError, TypeError):
+                if debug: print 'Spatial index could not be cached'
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+
+    grid._spatial_index[kind] = tree
+    return tree
+
+def closest_element(grid, pt_lon, pt_lat, debug=False):
+    """
+    Finds the closest element centre indexes of a grid to given lon, lat
+    coordinates through the grid spatial index.
+
+    Inputs:
+      - grid = FVCOM grid, i.e. FVCOM.Grid
+      - pt_lon = list of longitudes in degrees to find
+      - pt_lat = list of latitudes in degrees to find
+    Outputs:
+      - closest_point_indexes = numpy array of element indexes
+    """
+    tree = spatial_index(grid, kind='ele', debug=debug)
+    points = np.vstack((np.atleast_1d(pt_lon), np.atleast_1d(pt_lat))).T
+    _, closest_point_indexes = tree.query(points)
     if debug:
-        print 'Closest dist: ', closest_dist
+        print 'closest_point_indexes', closest_point_indexes
 
+    return closest_point_indexes
 
+def closest_node(grid, pt_lon, pt_lat, debug=False):
+    """
+    Finds the closest node indexes of a grid to given lon, lat
+    coordinates through the grid spatial index.
+
+    Inputs:
+      - grid = FVCOM or Station grid, i.e. FVCOM.Grid
+      - pt_lon = list of longitudes in degrees to find
+      - pt_lat = list of latitudes in degrees to find
+    Outputs:
+      - closest_point_indexes = numpy array of node indexes
+    """
+    tree = spatial_index(grid, kind='node', debug=debug)
+    points = np.vstack((np.atleast_1d(pt_lon), np.atleast_1d(pt_lat))).T
+    _, closest_point_indexes = tree.query(points)
     if debug:
         print 'closest_point_indexes', closest_point_indexes
-        print '...Passed'
 
     return closest_point_indexes
 
+class TriangleLocator(object):
+    """
+    Bucket index of the grid triangles for point-in-triangle queries.
+    Each triangle is registered in every cell of a regular (lon, lat)
+    grid its bounding box overlaps; a query only tests the triangles
+    registered in the cell of each point.
+
+    Inputs:
+      - lon = longitudes of the nodes in degrees, 1D array
+      - lat = latitudes of the nodes in degrees, 1D array
+      - trinodes = FVCOM trinodes, numpy array, dim=(nele,3)
+
+    Notes:
+      - triangles overlapping more than max_cells cells, i.e. much larger
+        than the median one, are not registered in the buckets but in a
+        cKDTree of their centroids, searched within their largest radius
+    """
+    def __init__(self, lon, lat, trinodes, max_cells=16, debug=False):
+        if debug: print 'Building triangle locator...'
+        lon = np.asarray(lon[:], dtype=np.float64)
+        lat = np.asarray(lat[:], dtype=np.float64)
+        self.trinodes = np.asarray(trinodes[:], dtype=int)
+        self.tx = lon[self.trinodes]
+        self.ty = lat[self.trinodes]
+        nele = self.trinodes.shape[0]
+
+        #Bucket size: median triangle extent, capped to ~4 cells per element
+        xmin, xmax = self.tx.min(1), self.tx.max(1)
+        ymin, ymax = self.ty.min(1), self.ty.max(1)
+        self.x0, self.y0 = xmin.min(), ymin.min()
+        width = max(xmax.max() - self.x0, 1e-12)
+        height = max(ymax.max() - self.y0, 1e-12)
+        size = np.median(np.maximum(xmax - xmin, ymax - ymin))
+        size = max(size, np.sqrt(width * height / (4.0 * nele)))
+        self.size = size
+        self.ncx = int(width // size) + 1
+        self.ncy = int(height // size) + 1
+
+        #Large triangles: centroid tree instead of buckets
+        ix0, ix1 = self._cell(xmin, self.x0), self._cell(xmax, self.x0)
+        iy0, iy1 = self._cell(ymin, self.y0), self._cell(ymax, self.y0)
+        nx = ix1 - ix0 + 1
+        counts = nx * (iy1 - iy0 + 1)
+        large = counts > max_cells
+        self.large = np.where(large)[0]
+        self.tree = None
+        if not self.large.shape[0]==0:
+            cx = self.tx[self.large].mean(1)
+            cy = self.ty[self.large].mean(1)
+            self.radius = np.hypot(self.tx[self.large] - cx[:,np.newaxis],
+                                   self.ty[self.large] - cy[:,np.newaxis]).max()
+            self.tree = cKDTree(np.vstack((cx, cy)).T)
+            counts[large] = 0
+            if debug: print self.large.shape[0], ' large triangle(s)'
+
+        #Register triangles in every cell overlapped by their bounding box
+        tri = np.repeat(np.arange(nele), counts)
+        local = np.arange(tri.shape[0]) - np.repeat(np.cumsum(counts) - counts,
+                                                    counts)
+        cells = (iy0[tri] + local // nx[tri]) * self.ncx + ix0[tri] + local % nx[tri]
+        order = np.argsort(cells, kind='mergesort')
+        self.cells = cells[order]
+        self.tri = tri[order]
+        if debug: print '...Passed'
+
+    def _cell(self, x, x0):
+        """Bucket coordinate along one axis"""
+        return np.floor((x - x0) / self.size).astype(int)
+
+    def find(self, pt_lon, pt_lat, tol=1e-10):
+        """
+        Return the index of the triangles containing the points,
+        -1 for points outside the mesh.
+
+        Inputs:
+          - pt_lon = list of longitudes in degrees to find
+          - pt_lat = list of latitudes in degrees to find
+        Outputs:
+          - index = element indexes, 1D array of integers
+        """
+        px = np.atleast_1d(np.asarray(pt_lon, dtype=np.float64))
+        py = np.atleast_1d(np.asarray(pt_lat, dtype=np.float64))
+        index = -np.ones(px.shape[0], dtype=int)
+        ix = self._cell(px, self.x0)
+        iy = self._cell(py, self.y0)
+        valid = np.where((ix>=0) & (ix<self.ncx) & (iy>=0) & (iy<self.ncy))[0]
+        if valid.shape[0]==0:
+            return index
+
+        #Candidate (point, triangle) pairs
+        cell = iy[valid] * self.ncx + ix[valid]
+        lo = np.searchsorted(self.cells, cell, side='left')
+        counts = np.searchsorted(self.cells, cell, side='right') - lo
+        pt = np.repeat(valid, counts)
+        local = np.arange(pt.shape[0]) - np.repeat(np.cumsum(counts) - counts,
+                                                   counts)
+        tri = self.tri[np.repeat(lo, counts) + local]
+        if not self.tree is None:
+            near = self.tree.query_ball_point(np.vstack((px[valid],
+                                                         py[valid])).T,
+                                              self.radius * (1.0 + 1e-9))
+            counts = np.array([len(n) for n in near], dtype=int)
+            if counts.sum() > 0:
+                pt = np.hstack((pt, np.repeat(valid, counts)))
+                tri = np.hstack((tri, self.large[np.hstack(near).astype(int)]))
+
+        #Barycentric coordinates
+        ax, ay = self.tx[tri,0], self.ty[tri,0]
+        v0x, v0y = self.tx[tri,2] - ax, self.ty[tri,2] - ay
+        v1x, v1y = self.tx[tri,1] - ax, self.ty[tri,1] - ay
+        v2x, v2y = px[pt] - ax, py[pt] - ay
+        denom = v0x * v1y - v1x * v0y
+        with np.errstate(divide='ignore', invalid='ignore'):
+            u = (v2x * v1y - v1x * v2y) / denom
+            v = (v0x * v2y - v2x * v0y) / denom
+        inside = (u >= -tol) & (v >= -tol) & (u + v <= 1.0 + tol) & (denom != 0.0)
+
+        #First containing triangle of each point
+        ptIn, first = np.unique(pt[inside], return_index=True)
+        index[ptIn] = tri[inside][first]
+
+        return index
+
+def containing_element(grid, pt_lon, pt_lat, debug=False):
+    """
+    Finds the indexes of the elements containing given lon, lat coordinates.
+    Points outside the mesh fall back onto the closest element centre.
+
+    Inputs:
+      - grid = FVCOM grid, i.e. FVCOM.Grid
+      - pt_lon = list of longitudes in degrees to find
+      - pt_lat = list of latitudes in degrees to find
+    Outputs:
+      - index = numpy array of element indexes
+
+    Notes:
+      - the locator is built once and stored in grid._spatial_index
+    """
+    if not hasattr(grid, '_spatial_index'):
+        grid._spatial_index = {}
+    if not 'tri' in grid._spatial_index:
+        grid._spatial_index['tri'] = TriangleLocator(grid.lon, grid.lat,
+                                                     grid.trinodes, debug=debug)
+    index = grid._spatial_index['tri'].find(pt_lon, pt_lat)
+    outside = np.where(index < 0)[0]
+    if not outside.shape[0]==0:
+        if debug: print outside.shape[0], ' point(s) outside the mesh'
+        index[outside] = closest_element(grid,
+                                         np.atleast_1d(pt_lon)[outside],
+                                         np.atleast_1d(pt_lat)[outside],
+                                         debug=debug)
+    if debug:
+        print 'containing element indexes', index
+
+    return index
+
 def interpN_at_pt(var, pt_x, pt_y, xc, yc, index, trinodes,
                   aw0, awx, awy, debug=False):
     """
@@ -140,7 +403,8 @@ def interpE_at_pt(var, pt_x, pt_y, xc, yc, index, triele, trinodes,
       - pt_y = y coordinate in m to find
       - xc = list of x coordinates of var, numpy array, dim= nele
       - yc = list of y coordinates of var, numpy array, dim= nele
-      - triele = FVCOM triele, numpy array, dim=(3,nele)
+      - triele = FVCOM triele, numpy array, dim=(nele,3),
+                 -1 standing for no neighbour
       - trinodes = FVCOM trinodes, numpy array, dim=(3,nele)
       - index = index of the nearest element
       - a1u, a2u = grid parameters
@@ -150,13 +414,21 @@ def interpE_at_pt(var, pt_x, pt_y, xc, yc, index, triele, trinodes,
     if debug:
         print 'Interpolating at element...'
 
+    index = int(index)
     n1 = int(triele[index,0])
     n2 = int(triele[index,1])
     n3 = int(triele[index,2])
-    #TR comment: not quiet sure what this step does
-    if n1==0: n1 = trinodes.shape[1]
-    if n2==0: n2 = trinodes.shape[1]
-    if n3==0: n3 = trinodes.shape[1]
+    #Stencil coefficients, missing neighbours (-1) being masked, i.e.
+    #replaced by the element itself with no weight
+    c1 = np.array(a1u[:,index], dtype=float)
+    c2 = np.array(a2u[:,index], dtype=float)
+    for k, n in enumerate([n1, n2, n3]):
+        if n<0:
+            c1[k+1] = 0.0
+            c2[k+1] = 0.0
+    if n1<0: n1 = index
+    if n2<0: n2 = index
+    if n3<0: n3 = index
 
     #TR quick fix: due to error with pydap.proxy.ArrayProxy
     #              not able to cop with numpy.int
@@ -168,34 +440,34 @@ def interpE_at_pt(var, pt_x, pt_y, xc, yc, index, triele, trinodes,
     y0 = pt_y - yc[index]
 
     if len(var.shape)==1:
-        dvardx = (a1u[0,index] * var[index]) \
-               + (a1u[1,index] * var[n1]) \
-               + (a1u[2,index] * var[n2]) \
-               + (a1u[3,index] * var[n3])
-        dvardy = (a2u[0,index] * var[index]) \
-               + (a2u[1,index] * var[n1]) \
-               + (a2u[2,index] * var[n2]) \
-               + (a2u[3,index] * var[n3])
+        dvardx = (c1[0] * var[index]) \
+               + (c1[1] * var[n1]) \
+               + (c1[2] * var[n2]) \
+               + (c1[3] * var[n3])
+        dvardy = (c2[0] * var[index]) \
+               + (c2[1] * var[n1]) \
+               + (c2[2] * var[n2]) \
+               + (c2[3] * var[n3])
         varPt = var[index] + (dvardx * x0) + (dvardy * y0)
     elif len(var.shape)==2:
-        dvardx = (a1u[0,index] * var[:,index]) \
-               + (a1u[1,index] * var[:,n1]) \
-               + (a1u[2,index] * var[:,n2]) \
-               + (a1u[3,index] * var[:,n3])
-        dvardy = (a2u[0,index] * var[:,index]) \
-               + (a2u[1,index] * var[:,n1]) \
-               + (a2u[2,index] * var[:,n2]) \
-               + (a2u[3,index] * var[:,n3])
+        dvardx = (c1[0] * var[:,index]) \
+               + (c1[1] * var[:,n1]) \
+               + (c1[2] * var[:,n2]) \
+               + (c1[3] * var[:,n3])
+        dvardy = (c2[0] * var[:,index]) \
+               + (c2[1] * var[:,n1]) \
+               + (c2[2] * var[:,n2]) \
+               + (c2[3] * var[:,n3])
         varPt = var[:,index] + (dvardx * x0) + (dvardy * y0)
     else:
-        dvardx = (a1u[0,index] * var[:,:,index]) \
-               + (a1u[1,index] * var[:,:,n1]) \
-               + (a1u[2,index] * var[:,:,n2]) \
-               + (a1u[3,index] * var[:,:,n3])
-        dvardy = (a2u[0,index] * var[:,:,index]) \
-               + (a2u[1,index] * var[:,:,n1]) \
-               + (a2u[2,index] * var[:,:,n2]) \
-               + (a2u[3,index] * var[:,:,n3])
+        dvardx = (c1[0] * var[:,:,index]) \
+               + (c1[1] * var[:,:,n1]) \
+               + (c1[2] * var[:,:,n2]) \
+               + (c1[3] * var[:,:,n3])
+        dvardy = (c2[0] * var[:,:,index]) \
+               + (c2[1] * var[:,:,n1]) \
+               + (c2[2] * var[:,:,n2]) \
+               + (c2[3] * var[:,:,n3])
         varPt = var[:,:,index] + (dvardx * x0) + (dvardy * y0)
 
     if debug:
@@ -206,6 +478,256 @@ def interpE_at_pt(var, pt_x, pt_y, xc, yc, index, triele, trinodes,
     #TR comment: squeeze seems to resolve my problem with pydap
     return varPt.squeeze()
 
+def barycentric_weights(pt_lon, pt_lat, lon, lat, trinodes, index):
+    """
+    Barycentric weights of points within given triangles.
+
+    Inputs:
+      - pt_lon = longitudes in degrees of the points, 1D array
+      - pt_lat = latitudes in degrees of the points, 1D array
+      - lon = longitudes of the nodes, numpy array, dim=(node)
+      - lat = latitudes of the nodes, numpy array, dim=(node)
+      - trinodes = FVCOM trinodes, numpy array, dim=(nele,3)
+      - index = element index of each point, 1D array of integers
+    Outputs:
+      - weights = weights of the 3 nodes of each element, dim=(npoints,3)
+    """
+    triIndex = trinodes[index]
+    x = lon[triIndex]
+    y = lat[triIndex]
+    px = np.asarray(pt_lon, dtype=np.float64)
+    py = np.asarray(pt_lat, dtype=np.float64)
+    denom = (y[...,1] - y[...,2]) * (x[...,0] - x[...,2]) \
+          + (x[...,2] - x[...,1]) * (y[...,0] - y[...,2])
+    w1 = ((y[...,1] - y[...,2]) * (px - x[...,2]) \
+       + (x[...,2] - x[...,1]) * (py - y[...,2])) / denom
+    w2 = ((y[...,2] - y[...,0]) * (px - x[...,2]) \
+       + (x[...,0] - x[...,2]) * (py - y[...,2])) / denom
+
+    return np.array([w1, w2, 1.0 - w1 - w2]).T
+
+def _gather_columns(var, cols, weights):
+    """
+    Weighted sum of var columns, loading each column only once.
+
+    Inputs:
+      - var = variable, numpy array, dim=(space) or (time, [level,] space)
+      - cols = column indices, 2D array of integers, dim=(npoints, k)
+      - weights = column weights, numpy array, dim=(k, npoints)
+    Outputs:
+      - varPts = weighted sums, numpy array, dim=([time, [level,]] npoints)
+    """
+    uniq, inv = np.unique(cols, return_inverse=True)
+    inv = inv.reshape(cols.shape)
+    data = var[..., uniq]
+    varPts = weights[0] * data[..., inv[:,0]]
+    for k in range(1, cols.shape[1]):
+        varPts = varPts + weights[k] * data[..., inv[:,k]]
+
+    return varPts
+
+def node_stencil(pt_x, pt_y, xc, yc, index, trinodes, aw0, awx, awy):
+    """
+    Node columns and weights of the node interpolation at several points.
+    Inputs: see interpN_at_pts
+    Outputs:
+      - cols = node indices, 2D array of integers, dim=(npoints,3)
+      - weights = associated weights, numpy array, dim=(3,npoints)
+    """
+    index = np.asarray(index, dtype=int)
+    x0 = np.asarray(pt_x) - xc[index]
+    y0 = np.asarray(pt_y) - yc[index]
+    weights = aw0[:,index] + (awx[:,index] * x0) + (awy[:,index] * y0)
+
+    return np.asarray(trinodes[index], dtype=int), weights
+
+def element_stencil(pt_x, pt_y, xc, yc, index, triele, trinodes, a1u, a2u):
+    """
+    Element columns and weights of the element interpolation at several points.
+    Inputs: see interpE_at_pts
+    Outputs:
+      - cols = element indices, 2D array of integers, dim=(npoints,4)
+      - weights = associated weights, numpy array, dim=(4,npoints)
+    """
+    index = np.asarray(index, dtype=int)
+    neighbours = np.array(triele[index], dtype=int)
+    cols = np.hstack((index[:,np.newaxis], neighbours))
+    x0 = np.asarray(pt_x) - xc[index]
+    y0 = np.asarray(pt_y) - yc[index]
+    weights = (a1u[:,index] * x0) + (a2u[:,index] * y0)
+    #Missing neighbours (-1) are masked: the element itself with no weight
+    weights[cols.T < 0] = 0.0
+    cols = np.where(cols < 0, index[:,np.newaxis], cols)
+    weights[0,:] += 1.0
+
+    return cols, weights
+
+def points_to_xy(grid, pt_lon, pt_lat, index):
+    """
+    Converts (lon, lat) points into the (x, y) grid coordinates
+    by linear interpolation within their elements.
+
+    Inputs:
+      - grid = FVCOM grid, i.e. FVCOM.Grid
+      - pt_lon = longitudes in degrees, 1D array
+      - pt_lat = latitudes in degrees, 1D array
+      - index = element index of each point, 1D array of integers
+    Outputs:
+      - pt_x, pt_y = x and y coordinates in m, 1D arrays
+    """
+    trinodes = grid.trinodes[:]
+    weights = barycentric_weights(pt_lon, pt_lat, grid.lon[:], grid.lat[:],
+                                  trinodes, index)
+    pt_x = np.sum(weights * grid.x[:][trinodes[index]], axis=1)
+    pt_y = np.sum(weights * grid.y[:][trinodes[index]], axis=1)
+
+    return pt_x, pt_y
+
+class PointInterpolator(object):
+    """
+    Interpolation operator from the grid onto a fixed set of points.
+    Node and element interpolations are stored as sparse weight matrices,
+    so any variable is interpolated with a single sparse product.
+
+    Inputs:
+      - grid = FVCOM grid, i.e. FVCOM.Grid
+      - pt_lon = longitudes in degrees to interpolate at, list or 1D array
+      - pt_lat = latitudes in degrees to interpolate at, list or 1D array
+
+    Notes:
+      - the operator only depends on the grid and the points, it can be
+        saved once and reused for any variable and time window
+      - usage: interp = PointInterpolator(fvcom.Grid, lons, lats)
+               el = interp(fvcom.Variables.el)
+    """
+    def __init__(self, grid, pt_lon, pt_lat, debug=False):
+        if debug: print 'Building point interpolator...'
+        self.lon = np.atleast_1d(np.asarray(pt_lon, dtype=np.float64))
+        self.lat = np.atleast_1d(np.asarray(pt_lat, dtype=np.float64))
+        self.nnode = grid.lon.shape[0]
+        self.nele = grid.trinodes.shape[0]
+        self.gridHash = grid_hash(grid.lon, grid.lat)
+        self.index = containing_element(grid, self.lon, self.lat, debug=debug)
+        pt_x, pt_y = points_to_xy(grid, self.lon, self.lat, self.index)
+        xc = grid.xc[:]
+        yc = grid.yc[:]
+        self.nodeWeights = self._matrix(*node_stencil(pt_x, pt_y, xc, yc,
+                                        self.index, grid.trinodes[:],
+                                        grid.aw0, grid.awx, grid.awy))
+        self.eleWeights = self._matrix(*element_stencil(pt_x, pt_y, xc, yc,
+                                       self.index, grid.triele[:],
+                                       grid.trinodes[:], grid.a1u, grid.a2u))
+        if debug: print '...Passed'
+
+    def _matrix(self, cols, weights):
+        """
+        Compressed weight matrix: (npoints, ncols) with the used columns
+        """
+        npts = cols.shape[0]
+        used, inv = np.unique(cols, return_inverse=True)
+        rows = np.repeat(np.arange(npts), cols.shape[1])
+        W = sparse.csr_matrix((weights.T.ravel(), (rows, inv)),
+                              shape=(npts, used.shape[0]))
+        return (used, W)
+
+    def __call__(self, var, debug=False):
+        """
+        Interpolate var at the points.
+
+        Inputs:
+          - var = variable, dim=(space) or (time, [level,] space),
+                  space being either node or nele
+        Outputs:
+          - varInterp = var at the points, dim=([time, [level,]] npoints)
+        """
+        if var.shape[-1]==self.nnode:
+            used, W = self.nodeWeights
+        elif var.shape[-1]==self.nele:
+            used, W = self.eleWeights
+        else:
+            print "---Last dimension of var must be either node or nele---"
+            sys.exit()
+        if debug: print 'Interpolating with weight matrix...'
+        data = np.asarray(var[..., used])
+        lead = data.shape[:-1]
+        flat = data.reshape(-1, used.shape[0])
+        varInterp = W.dot(flat.T).T.reshape(lead + (W.shape[0],))
+        if debug: print '...Passed'
+
+        return varInterp
+
+    def check(self, grid):
+        """Tell if the interpolator was built for this grid"""
+        return self.gridHash==grid_hash(grid.lon, grid.lat)
+
+    def save(self, filename):
+        """Save interpolator as a pickle file"""
+        f = open(filename, 'wb')
+        pkl.dump(self, f, protocol=pkl.HIGHEST_PROTOCOL)
+        f.close()
+
+    @staticmethod
+    def load(filename):
+        """Load interpolator from a pickle file"""
+        f = open(filename, 'rb')
+        interp = pkl.load(f)
+        f.close()
+        return interp
+
+def interpN_at_pts(var, pt_x, pt_y, xc, yc, index, trinodes,
+                   aw0, awx, awy, debug=False):
+    """
+    Interpol node variable at several locations at once.
+    Inputs:
+      - var = variable, numpy array, dim=(node) or (time, node) or (time, level, node)
+      - pt_x = x coordinates in m to find, 1D array
+      - pt_y = y coordinates in m to find, 1D array
+      - xc = list of x coordinates of var, numpy array, dim= ele
+      - yc = list of y coordinates of var, numpy array, dim= ele
+      - trinodes = FVCOM trinodes, numpy array, dim=(nele,3)
+      - index = index of the element of each point, 1D array of integers
+      - aw0, awx, awy = grid parameters
+    Outputs:
+      - varInterp = var interpolated at (pt_x, pt_y),
+                    dim=(npoints) or (time, npoints) or (time, level, npoints)
+    """
+    if debug:
+        print 'Interpolating at nodes...'
+    cols, weights = node_stencil(pt_x, pt_y, xc, yc, index, trinodes,
+                                 aw0, awx, awy)
+    varPts = _gather_columns(var, cols, weights)
+    if debug: print '...Passed'
+
+    return varPts
+
+def interpE_at_pts(var, pt_x, pt_y, xc, yc, index, triele, trinodes,
+                   a1u, a2u, debug=False):
+    """
+    Interpol element variable at several locations at once.
+    Inputs:
+      - var = variable, numpy array, dim=(nele) or (time, nele) or (time, level, nele)
+      - pt_x = x coordinates in m to find, 1D array
+      - pt_y = y coordinates in m to find, 1D array
+      - xc = list of x coordinates of var, numpy array, dim= nele
+      - yc = list of y coordinates of var, numpy array, dim= nele
+      - triele = FVCOM triele, numpy array, dim=(nele,3),
+                 -1 standing for no neighbour
+      - trinodes = FVCOM trinodes, numpy array, dim=(nele,3)
+      - index = index of the element of each point, 1D array of integers
+      - a1u, a2u = grid parameters
+    Outputs:
+      - varInterp = var interpolated at (pt_x, pt_y),
+                    dim=(npoints) or (time, npoints) or (time, level, npoints)
+    """
+    if debug:
+        print 'Interpolating at elements...'
+    cols, weights = element_stencil(pt_x, pt_y, xc, yc, index, triele,
+                                    trinodes, a1u, a2u)
+    varPts = _gather_columns(var, cols, weights)
+    if debug: print '...Passed'
+
+    return varPts
+
 def interp_at_point(var, pt_lon, pt_lat, lon, lat,
                     index=[], trinodes=[], tri=[], debug=False):
     """
@@ -225,47 +747,31 @@ def interp_at_point(var, pt_lon, pt_lat, lon, lat,
     if debug:
         print 'Interpolating at point...'
     #Finding the right indexes
-
-    #Triangulation
-    #if debug:
-    #    print triIndex, lon[triIndex], lat[triIndex]
     triIndex = trinodes[index]
     if tri==[]:
-        tri = Tri.Triangulation(lon[triIndex], lat[triIndex], np.array([[0,1,2]]))
+        triLon = lon[triIndex]
+        triLat = lat[triIndex]
+    else:
+        triLon = tri.x[tri.triangles[0]]
+        triLat = tri.y[tri.triangles[0]]
 
-    trif = tri.get_trifinder()
-    trif.__call__(pt_lon, pt_lat)
+    #Barycentric weights, computed once for all time steps and levels
+    weights = barycentric_weights(pt_lon, pt_lat, triLon, triLat,
+                                  np.array([[0,1,2]]), 0)
+    outside = (weights < -1e-12).any()
     if debug:
-        if len(var.shape)==1:
-            averEl = var[triIndex]
-            print 'Var', averEl
-            inter = Tri.LinearTriInterpolator(tri, averEl)
-            zi = inter(pt_lon, pt_lat)
-            print 'zi', zi
+        print 'Weights', weights
 
-    #Choose the right interpolation depending on the variable
+    #Same as matplotlib.tri.LinearTriInterpolator applied to each (time, level)
+    triVar = var[..., triIndex]
+    varInterp = np.dot(triVar, weights)
     if len(var.shape)==1:
-        triVar = np.zeros(triIndex.shape)
-        triVar = var[triIndex]
-        inter = Tri.LinearTriInterpolator(tri, triVar[:])
-        varInterp = inter(pt_lon, pt_lat)      
-    elif len(var.shape)==2:
-        triVar = np.zeros((var.shape[0], triIndex.shape[0]))
-        triVar = var[:, triIndex]
-        varInterp = np.ones(triVar.shape[0])
-        for i in range(triVar.shape[0]):
-            inter = Tri.LinearTriInterpolator(tri, triVar[i,:])
-            varInterp[i] = inter(pt_lon, pt_lat)       
-    else:
-        triVar = np.zeros((var.shape[0], var.shape[1], triIndex.shape[0]))
-        triVar = var[:, :, triIndex]
-        varInterp = np.ones(triVar.shape[:-1])
-        for i in range(triVar.shape[0]):
-           for j in range(triVar.shape[1]):
-               inter = Tri.LinearTriInterpolator(tri, triVar[i,j,:])
-               varInterp[i,j] = inter(pt_lon, pt_lat)
-
+        varInterp = np.ma.masked_array(varInterp, mask=outside)
+    elif outside:
+        varInterp = varInterp * np.nan
     if debug:
+        if len(var.shape)==1:
+            print 'zi', varInterp
         print '...Passed'
 
     #TR comment: squeeze seems to resolve my problem with pydap
@@ -0,0 +1,732 @@
+#!/usr/bin/python2.7
+# encoding: utf-8
+
+from __future__ import division
+import numpy as np
+import time
+import os
+import tempfile
+import hashlib
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+#Default memory budget of a single slab read, in bytes
+MEM_BUDGET = 256 * 1024 * 1024
+#Default budget of the lazy variables cache, in bytes
+CACHE_BUDGET = 1024 * 1024 * 1024
+#Largest gap, in elements or nodes, merged into a single remote request
+REMOTE_GAP = 64
+#Number of concurrent remote requests
+REMOTE_WORKERS = 4
+#Location of the on-disk sub-domain cache, None to disable it
+SUBDOMAIN_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.pyseidon',
+                                   'subdomain')
+#Format of the sub-domain cache entries, to be increased whenever the
+#cached arrays change meaning (2: 0-based triele, -1 for no neighbour)
+SUBDOMAIN_CACHE_VERSION = 2
+
+def consecutive_runs(index):
+    """
+    Split integer indices into runs of consecutive values.
+
+    Inputs:
+    ------
+      - index = indices, 1D array of integers
+
+    Outputs:
+    -------
+      - runs = list of (position start, position end, index start, index end),
+               end bounds being exclusive
+    """
+    index = np.asarray(index, dtype=int).ravel()
+    if index.shape[0]==0:
+        return []
+    breaks = np.where(np.diff(index) != 1)[0] + 1
+    starts = np.hstack((0, breaks))
+    ends = np.hstack((breaks, index.shape[0]))
+
+    return [(s, e, index[s], index[e-1] + 1) for s, e in zip(starts, ends)]
+
+def load_slab(var, time_index=slice(None), space_index=slice(None),
+              level_index=None, mem_budget=MEM_BUDGET, stats=None,
+              debug=False):
+    """
+    Load a (time, [level,] space) variable in large contiguous time slabs.
+
+    Inputs:
+    ------
+      - var = netcdf variable data, array like (ntime, [nlevel,] nele or nnode)
+
+    Outputs:
+    -------
+      - out = loaded data in the source dtype, array
+              (len(time_index), [nlevel,] len(space_index))
+
+    Keywords:
+    --------
+      - time_index = time indices to load, slice or 1D array of integers
+      - space_index = element or node indices to load,
+                      slice or 1D array of integers
+      - level_index = indices to load along each level axis, tuple of
+                      slices or 1D arrays of integers, None for all
+      - mem_budget = maximum size in bytes of a single read, integer
+      - stats = dictionary in which 'bytes' and 'seconds' are accumulated
+
+    Notes:
+    -----
+      - each slab covers as many time steps as mem_budget allows
+        and is written straight into the preallocated output
+      - scattered space indices are read as spans of the source,
+        mem_budget bounding the size of the spans actually read
+      - only the levels between the smallest and largest level indices
+        are read
+    """
+    if debug:
+        print 'Loading slabs...'
+        start = time.time()
+    tic = time.time()
+
+    #Time indices
+    if type(time_index)==slice:
+        time_index = np.arange(var.shape[0])[time_index]
+    time_index = np.asarray(time_index, dtype=int).ravel()
+    #Space indices
+    if type(space_index)==slice:
+        space_index = np.arange(var.shape[-1])[space_index]
+    space_index = np.asarray(space_index, dtype=int).ravel()
+    nspace = space_index.shape[0]
+    #Level indices, read as the span [lo:hi] of each level axis
+    if level_index is None:
+        level_index = (slice(None),) * (len(var.shape) - 2)
+    levelRead = []
+    levelLocal = []
+    for n, index in zip(var.shape[1:-1], level_index):
+        index = np.atleast_1d(np.arange(n)[index])
+        if index.shape[0]==0:
+            levelRead.append(slice(0, 0))
+            levelLocal.append(None)
+            continue
+        lo, hi = index.min(), index.max() + 1
+        levelRead.append(slice(lo, hi))
+        if np.array_equal(index, np.arange(lo, hi)):
+            levelLocal.append(None)
+        else:
+            levelLocal.append(index - lo)
+    levelRead = tuple(levelRead)
+
+    #Preallocate in the native byte order of the source dtype
+    dtype = var.dtype.newbyteorder('=')
+    levelShape = tuple(l.stop - l.start for l in levelRead)
+    shape = (time_index.shape[0],) +\
+            tuple(n if l is None else l.shape[0]
+                  for n, l in zip(levelShape, levelLocal)) + (nspace,)
+    out = np.empty(shape, dtype=dtype)
+    columnBytes = dtype.itemsize * int(np.prod(levelShape))
+
+    #Spans [lo:hi] read at once, each one narrow enough for a single
+    #time step to fit mem_budget, with the output positions and the
+    #local indices within the span (None when the span is read as is)
+    spans = []
+    width = max(1, int(mem_budget // max(columnBytes, 1)))
+    if not nspace==0:
+        if (np.diff(space_index)==1).all():
+            for g0 in range(0, nspace, width):
+                g1 = min(g0 + width, nspace)
+                spans.append((space_index[g0], space_index[g1-1] + 1,
+                              slice(g0, g1), None))
+        else:
+            order = np.argsort(space_index, kind='mergesort')
+            sortd = space_index[order]
+            g0 = 0
+            while g0 < nspace:
+                g1 = np.searchsorted(sortd, sortd[g0] + width, side='left')
+                lo, hi = sortd[g0], sortd[g1-1] + 1
+                spans.append((lo, hi, order[g0:g1], sortd[g0:g1] - lo))
+                g0 = g1
+
+    for lo, hi, pos, local in spans:
+        #Number of time steps per slab, sized on the span actually read
+        stepBytes = columnBytes * (hi - lo)
+        rows = max(1, int(mem_budget // max(stepBytes, 1)))
+        for p0, p1, t0, t1 in consecutive_runs(time_index):
+            for i in range(0, p1 - p0, rows):
+                n = min(rows, p1 - p0 - i)
+                slab = var[(slice(t0+i, t0+i+n),) + levelRead +
+                           (slice(lo, hi),)]
+                for axis, l in enumerate(levelLocal):
+                    if not l is None:
+                        slab = np.take(slab, l, axis=axis+1)
+                if local is None:
+                    out[p0+i:p0+i+n, ..., pos] = slab
+                else:
+                    out[p0+i:p0+i+n, ..., pos] = slab[..., local]
+                if debug:
+                    print 'Slab: ' + str(t0+i) + '-' + str(t0+i+n)
+
+    toc = time.time()
+    if not stats is None:
+        stats['bytes'] = stats.get('bytes', 0) + out.nbytes
+        stats['seconds'] = stats.get('seconds', 0.0) + (toc - tic)
+    if debug:
+        print "Read ", out.nbytes, " bytes at ",\
+              transfer_rate(out.nbytes, toc - tic), " MB/s"
+        print "...processing time: ", (time.time() - start)
+
+    return out
+
+def transfer_rate(nbytes, seconds):
+    """Return transfer rate in MB/s"""
+    if seconds<=0.0:
+        return np.inf
+    return (nbytes / (1024.0 * 1024.0)) / seconds
+
+def chunked_apply(func, inputs, filename=None, mem_budget=MEM_BUDGET,
+                  debug=False):
+    """
+    Apply an element-wise function over time blocks of its inputs.
+
+    Inputs:
+    ------
+      - func = function of the input blocks returning the output block,
+               i.e. lambda u, v: np.sqrt(u**2 + v**2)
+      - inputs = arrays sharing the time dimension along their first axis,
+                 i.e. memory-mapped netcdf variables or LazyVariable
+
+    Outputs:
+    -------
+      - out = result, array (ntime, ...), memory-mapped if filename is given
+
+    Keywords:
+    --------
+      - filename = path of the *.npy file the result is written to,
+                   None to keep the result in memory
+      - mem_budget = maximum size in bytes of the input blocks, integer
+
+    Notes:
+    -----
+      - only one block of the inputs and temporaries is in memory at a time
+      - the *.npy file can be reopened with np.load(filename, mmap_mode='r')
+      - without time steps, the result is an empty array, also saved to
+        filename if given
+    """
+    ntime = inputs[0].shape[0]
+    stepBytes = sum(8 * int(np.prod(var.shape[1:])) for var in inputs)
+    rows = max(1, int(mem_budget // max(stepBytes, 1)))
+
+    if ntime==0:
+        #Empty files cannot be memory-mapped
+        out = func(*[np.asarray(var[0:0]) for var in inputs])
+        if not filename is None:
+            np.save(filename, out)
+            if debug: print 'Written to ' + filename
+        return out
+
+    out = None
+    for t0 in range(0, ntime, rows):
+        t1 = min(t0 + rows, ntime)
+        block = func(*[np.asarray(var[t0:t1]) for var in inputs])
+        if out is None:
+            shape = (ntime,) + block.shape[1:]
+            if filename is None:
+                out = np.empty(shape, dtype=block.dtype)
+            else:
+                out = np.lib.format.open_memmap(filename, mode='w+',
+                                                dtype=block.dtype, shape=shape)
+        out[t0:t1] = block
+        if debug: print 'Block: ' + str(t0) + '-' + str(t1)
+    if not filename is None:
+        out.flush()
+        if debug: print 'Written to ' + filename
+
+    return out
+
+def out_file(variables, name):
+    """
+    Return the *.npy path of a derived field when FVCOM.Variables works
+    out-of-core, i.e. has an _out_dir, None otherwise.
+
+    Notes:
+    -----
+      - file names are made unique, i.e. name_XXXXXX.npy, so that several
+        objects, or several calls, can share the same directory
+    """
+    outDir = getattr(variables, '_out_dir', None)
+    if outDir is None:
+        return None
+    if not os.path.exists(outDir):
+        os.makedirs(outDir)
+    fd, filename = tempfile.mkstemp(suffix='.npy', prefix=name + '_',
+                                    dir=outDir)
+    os.close(fd)
+    return filename
+
+def plan_ranges(index, gap=REMOTE_GAP):
+    """
+    Merge consecutive runs of indices separated by at most gap indices.
+
+    Inputs:
+    ------
+      - index = sorted indices, 1D array of integers
+
+    Outputs:
+    -------
+      - ranges = list of (position start, position end, index start, index end),
+                 end bounds being exclusive. Indices of a range lie
+                 within [index start, index end) but not all of them are used
+
+    Keywords:
+    --------
+      - gap = largest number of unused indices merged into a range, integer
+    """
+    index = np.asarray(index, dtype=int).ravel()
+    if index.shape[0]==0:
+        return []
+    breaks = np.where(np.diff(index) > gap + 1)[0] + 1
+    starts = np.hstack((0, breaks))
+    ends = np.hstack((breaks, index.shape[0]))
+
+    return [(s, e, index[s], index[e-1] + 1) for s, e in zip(starts, ends)]
+
+def load_ranges(var, space_index, time_index=None, gap=REMOTE_GAP,
+                workers=REMOTE_WORKERS, stats=None, debug=False):
+    """
+    Load a ([time,] [level,] space) remote variable with one request per
+    merged range of space indices, requests being issued concurrently.
+
+    Inputs:
+    ------
+      - var = remote variable, array like supporting slicing,
+              i.e. pydap.model.BaseType
+      - space_index = element or node indices to load,
+                      slice or 1D array of integers
+
+    Outputs:
+    -------
+      - out = loaded data, array (..., len(space_index))
+
+    Keywords:
+    --------
+      - time_index = time slice applied on the first axis, None for
+                     variables without time axis
+      - gap = largest number of unused indices fetched to save a request
+      - workers = number of concurrent requests, integer
+      - stats = dictionary in which 'requests', 'bytes', 'overfetch' (bytes)
+                and 'seconds' are accumulated
+
+    Notes:
+    -----
+      - any object supporting var[slice, ..., lo:hi] can stand in for
+        the remote variable, i.e. a numpy array or a local pydap server
+    """
+    tic = time.time()
+    if type(space_index)==slice:
+        space_index = np.arange(var.shape[-1])[space_index]
+    space_index = np.asarray(space_index, dtype=int).ravel()
+    #Requests are planned over sorted indices
+    order = np.argsort(space_index, kind='mergesort')
+    unsorted = not (order==np.arange(space_index.shape[0])).all()
+    if unsorted:
+        space_index = space_index[order]
+    ranges = plan_ranges(space_index, gap=gap)
+    if time_index is None:
+        key = (Ellipsis,)
+        lead = tuple(var.shape[:-1])
+    else:
+        key = (time_index, Ellipsis)
+        lead = (len(xrange(*time_index.indices(var.shape[0]))),)\
+             + tuple(var.shape[1:-1])
+    if debug:
+        print 'Loading ', space_index.shape[0], ' indices in ',\
+              len(ranges), ' requests...'
+
+    def fetch(r):
+        p0, p1, lo, hi = r
+        return r, np.asarray(var[key + (slice(lo, hi),)])
+
+    out = None
+    fetched = 0
+    pool = ThreadPool(max(1, min(workers, len(ranges))))
+    try:
+        for (p0, p1, lo, hi), block in pool.imap_unordered(fetch, ranges):
+            if out is None:
+                out = np.empty(lead + (space_index.shape[0],),
+                               dtype=block.dtype.newbyteorder('='))
+            out[..., p0:p1] = block[..., space_index[p0:p1] - lo]
+            fetched += block.nbytes
+            if debug: print 'Index bound: ' + str(lo) + '-' + str(hi)
+    finally:
+        pool.close()
+        pool.join()
+    if out is None:
+        out = np.empty(lead + (0,))
+    if unsorted:
+        out = out[..., np.argsort(order)]
+
+    toc = time.time()
+    if not stats is None:
+        stats['requests'] = stats.get('requests', 0) + len(ranges)
+        stats['bytes'] = stats.get('bytes', 0) + out.nbytes
+        stats['overfetch'] = stats.get('overfetch', 0) + (fetched - out.nbytes)
+        stats['seconds'] = stats.get('seconds', 0.0) + (toc - tic)
+    if debug:
+        print "...processing time: ", (toc - tic)
+
+    return out
+
+def file_identity(filename):
+    """Return (absolute path, size, modification time) of a file"""
+    stat = os.stat(filename)
+    return (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+
+def subdomain_key(filename, *args):
+    """
+    Return the sub-domain cache key of a file and extraction parameters.
+
+    Inputs:
+    ------
+      - filename = path to the source file, string
+      - args = extraction parameters, i.e. ax, inside and tx
+
+    Outputs:
+    -------
+      - key = hexadecimal digest, string, or None if the file is not local
+              or the cache is disabled
+    """
+    if SUBDOMAIN_CACHE_DIR is None or not os.path.isfile(filename):
+        return None
+    sha = hashlib.sha1()
+    sha.update(repr(SUBDOMAIN_CACHE_VERSION))
+    sha.update(repr(file_identity(filename)))
+    #Arrays are listed in full, their repr being truncated
+    sha.update(repr([a.tolist() if isinstance(a, np.ndarray) else a
+                     for a in args]))
+
+    return sha.hexdigest()
+
+def load_subdomain(key, debug=False):
+    """
+    Return the arrays cached under key as a dictionary, None if missing.
+    """
+    if key is None:
+        return None
+    filename = os.path.join(SUBDOMAIN_CACHE_DIR, key + '.npz')
+    if not os.path.exists(filename):
+        return None
+    if debug: print 'Loading sub-domain from ' + filename + '...'
+    try:
+        npz = np.load(filename)
+        data = dict((name, npz[name]) for name in npz.files)
+        npz.close()
+    except (IOError, ValueError):
+        return None
+
+    return data
+
+def save_subdomain(key, data, debug=False):
+    """
+    Cache a dictionary of arrays under key in SUBDOMAIN_CACHE_DIR.
+    """
+    if key is None:
+        return
+    filename = os.path.join(SUBDOMAIN_CACHE_DIR, key + '.npz')
+    tmp = os.path.join(SUBDOMAIN_CACHE_DIR, key + '.tmp.npz')
+    try:
+        if not os.path.exists(SUBDOMAIN_CACHE_DIR):
+            os.makedirs(SUBDOMAIN_CACHE_DIR)
+        np.savez(tmp, **data)
+        os.rename(tmp, filename)
+        if debug: print 'Sub-domain cached in ' + filename
+    except (IOError, OSError):
+        if debug: print 'Sub-domain could not be cached'
+
+class LRUCache(object):
+    """
+    Least recently used cache of numpy arrays bounded by a byte budget.
+
+    Inputs:
+    ------
+      - max_bytes = cache budget in bytes, integer
+    """
+    def __init__(self, max_bytes=CACHE_BUDGET):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._data = OrderedDict()
+
+    def get(self, key):
+        """Return cached array or None, and mark it as recently used"""
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return None
+        self._data[key] = value
+        return value
+
+    def put(self, key, value):
+        """Cache array, evicting the least recently used ones if necessary"""
+        if key in self._data:
+            self.nbytes -= self._data.pop(key).nbytes
+        if value.nbytes > self.max_bytes:
+            return
+        while self._data and (self.nbytes + value.nbytes > self.max_bytes):
+            _, old = self._data.popitem(last=False)
+            self.nbytes -= old.nbytes
+        self._data[key] = value
+        self.nbytes += value.nbytes
+
+    def clear(self):
+        """Empty cache"""
+        self._data.clear()
+        self.nbytes = 0
+
+    #Cache content is neither pickled nor copied
+    def __getstate__(self):
+        return {'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state['max_bytes'])
+
+class LazyVariable(object):
+    """
+    Read-only proxy of a (time, [level,] space) netcdf variable.
+    Data are only read when indexed and kept in a shared LRUCache.
+
+    Inputs:
+    ------
+      - var = netcdf variable data, memory-mapped array
+      - name = variable name, string
+
+    Keywords:
+    --------
+      - time_index = source time indices, slice or 1D array of integers
+      - space_index = source element or node indices,
+                      slice or 1D array of integers
+      - cache = shared LRUCache, a private one is created if None
+      - mem_budget = maximum size in bytes of a single read, integer
+
+    Notes:
+    -----
+      - indices are relative to the time period and bounding box,
+        i.e. var[:, 0] is the first element of the bounding box
+      - array indices on several axes are applied independently,
+        i.e. var[[0,1], [2,3]] is a (2, 2) array
+    """
+    def __init__(self, var, name, time_index=slice(None), space_index=slice(None),
+                 cache=None, mem_budget=None):
+        self._source = var
+        self.name = name
+        self._time_index = np.arange(var.shape[0])[time_index]
+        self._space_index = np.arange(var.shape[-1])[space_index]
+        if cache is None:
+            cache = LRUCache()
+        self._cache = cache
+        self._mem_budget = mem_budget
+        self.dtype = var.dtype.newbyteorder('=')
+        self.shape = (self._time_index.shape[0],) + tuple(var.shape[1:-1])\
+                   + (self._space_index.shape[0],)
+        self.ndim = len(self.shape)
+        self.size = int(np.prod(self.shape))
+        self.nbytes = self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return 'LazyVariable(' + self.name + ', shape=' + str(self.shape) + ')'
+
+    def __array__(self, dtype=None):
+        if dtype is None:
+            return self[:]
+        return self[:].astype(dtype)
+
+    def __getitem__(self, key):
+        if not type(key)==tuple:
+            key = (key,)
+        #Expand ellipsis and missing trailing axes
+        if any(k is Ellipsis for k in key):
+            i = [k is Ellipsis for k in key].index(True)
+            fill = (slice(None),) * (self.ndim - len(key) + 1)
+            key = key[:i] + fill + key[i+1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        if len(key) > self.ndim:
+            raise IndexError('too many indices')
+
+        #Map time and space keys onto source indices
+        tKey, sKey = key[0], key[-1]
+        drop = [_is_integer(k) for k in key]
+        tSrc = np.atleast_1d(self._time_index[tKey])
+        sSrc = np.atleast_1d(self._space_index[sKey])
+        #Integer level keys keep their axis until the end
+        levelKey = tuple([k] if d else k for k, d in zip(key[1:-1], drop[1:-1]))
+
+        lSrc = tuple(np.atleast_1d(np.arange(n)[k])
+                     for n, k in zip(self.shape[1:-1], levelKey))
+
+        cacheKey = (self.name, _index_key(tSrc), _index_key(sSrc)) +\
+                   tuple(_index_key(l) for l in lSrc)
+        out = self._cache.get(cacheKey)
+        if out is None:
+            out = load_slab(self._source, tSrc, sSrc, level_index=lSrc,
+                            mem_budget=self._mem_budget or MEM_BUDGET)
+            #Cached data are shared, hence read-only
+            out.flags.writeable = False
+            self._cache.put(cacheKey, out)
+
+        #Drop integer indexed axes
+        if any(drop):
+            out = out[tuple(0 if d else slice(None) for d in drop)]
+        return out
+
+def _is_integer(key):
+    """Tell if key is a scalar integer index"""
+    return isinstance(key, (int, long, np.integer))
+
+def _index_key(index):
+    """Hashable digest of an index array"""
+    index = np.ascontiguousarray(index, dtype=np.int64)
+    return (index.shape[0], hashlib.sha1(index.tostring()).hexdigest())
+
+def check_time_axis(times):
+    """
+    Tell if successive time vectors form a single time axis.
+
+    Inputs:
+    ------
+      - times = time vectors, list of 1D arrays
+
+    Outputs:
+    -------
+      - message = None if the time axis is valid, the problem otherwise
+
+    Notes:
+    -----
+      - each time vector must be increasing and start at or after the end
+        of the previous one
+    """
+    for i, time in enumerate(times):
+        time = np.asarray(time[:])
+        if (np.diff(time) < 0.0).any():
+            return 'time of part ' + str(i) + ' is not increasing'
+        if i > 0 and time.shape[0] > 0 and\
+           np.asarray(times[i-1][-1:]).max() > time[0]:
+            return 'parts ' + str(i-1) + ' and ' + str(i) + ' overlap in time'
+
+    return None
+
+class TimeConcat(object):
+    """
+    Read-only view of several (time, [level,] space) arrays concatenated
+    along the time axis, i.e. the same variable of successive files.
+
+    Inputs:
+    ------
+      - parts = arrays or array-likes (i.e. memory maps or LazyVariable)
+                of identical shape but for the time axis, list
+
+    Keywords:
+    --------
+      - space_index = columns of each part to expose, list of
+                      1D arrays of integers (one per part) or None for all
+
+    Notes:
+    -----
+      - parts are never copied: indexing reads the time steps from the
+        parts they belong to and only joins those
+      - TimeConcat parts are flattened, so that stacking N files one after
+        another does not nest N views
+      - same indexing rules as LazyVariable
+    """
+    def __init__(self, parts, space_index=None):
+        if space_index is None:
+            space_index = [None] * len(parts)
+        self._parts = []
+        self._space_index = []
+        for part, index in zip(parts, space_index):
+            if isinstance(part, TimeConcat):
+                #Flatten, composing the column selections
+                for sub, subIndex in zip(part._parts, part._space_index):
+                    if index is None:
+                        composed = subIndex
+                    elif subIndex is None:
+                        composed = np.asarray(index, dtype=int)
+                    else:
+                        composed = subIndex[index]
+                    self._parts.append(sub)
+                    self._space_index.append(composed)
+            else:
+                self._parts.append(part)
+                if not index is None:
+                    index = np.asarray(index, dtype=int)
+                self._space_index.append(index)
+        lengths = [part.shape[0] for part in self._parts]
+        self._offsets = np.hstack((0, np.cumsum(lengths))).astype(int)
+        first, firstIndex = self._parts[0], self._space_index[0]
+        nspace = first.shape[-1] if firstIndex is None else firstIndex.shape[0]
+        self.dtype = np.dtype(first.dtype).newbyteorder('=')
+        self.shape = (int(self._offsets[-1]),) + tuple(first.shape[1:-1])\
+                   + (nspace,)
+        self.ndim = len(self.shape)
+        self.size = int(np.prod(self.shape))
+        self.nbytes = self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return 'TimeConcat(' + str(len(self._parts)) + ' parts, shape='\
+               + str(self.shape) + ')'
+
+    def __array__(self, dtype=None):
+        if dtype is None:
+            return self[:]
+        return self[:].astype(dtype)
+
+    def __getitem__(self, key):
+        if not type(key)==tuple:
+            key = (key,)
+        #Expand ellipsis and missing trailing axes
+        if any(k is Ellipsis for k in key):
+            i = [k is Ellipsis for k in key].index(True)
+            fill = (slice(None),) * (self.ndim - len(key) + 1)
+            key = key[:i] + fill + key[i+1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        if len(key) > self.ndim:
+            raise IndexError('too many indices')
+        tKey, mid, sKey = key[0], key[1:-1], key[-1]
+
+        #Global time indices and the part each one belongs to
+        tIdx = np.atleast_1d(np.arange(self.shape[0])[tKey])
+        owner = np.searchsorted(self._offsets, tIdx, side='right') - 1
+        #Runs of time steps read from the same part
+        breaks = np.where(np.diff(owner) != 0)[0] + 1
+        starts = np.hstack((0, breaks)).astype(int)
+        ends = np.hstack((breaks, owner.shape[0])).astype(int)
+        if tIdx.shape[0]==0:
+            owner, starts, ends = np.zeros(1, dtype=int), [0], [0]
+            tIdx = np.zeros(0, dtype=int)
+        blocks = []
+        for p0, p1 in zip(starts, ends):
+            k = owner[p0]
+            part, index = self._parts[k], self._space_index[k]
+            local = tIdx[p0:p1] - self._offsets[k]
+            #Contiguous time steps are read as a single slice
+            if local.shape[0]==0:
+                rows = slice(0, 0)
+            elif (np.diff(local)==1).all():
+                rows = slice(local[0], local[-1] + 1)
+            else:
+                rows = local
+            cols = sKey if index is None else index[sKey]
+            if type(rows)==slice and not any(type(m)!=slice for m in mid):
+                block = part[(rows,) + mid + (cols,)]
+            else:
+                block = part[(rows,) + mid + (slice(None),)]
+                block = block[..., cols]
+            blocks.append(np.asarray(block))
+
+        if len(blocks)==1:
+            out = blocks[0]
+        else:
+            out = np.concatenate(blocks, axis=0)
+        if _is_integer(tKey):
+            out = out[0]
+        return out
@@ -0,0 +1,74 @@
+#!/usr/bin/python2.7
+# encoding: utf-8
+
+from __future__ import division
+import numpy as np
+from loading_utils import chunked_apply
+
+#Sea water density (kg/m3)
+RHO = 1025.0
+
+def power_assessment(u, power_mat, cut_in=1.0, cut_out=4.5, pd=None,
+                     filename=None, debug=False):
+    """
+    Tidal turbine power assessment (W/m2) for one or several turbines.
+
+    Inputs:
+    ------
+      - u = flow speed (m/s), array (ntime, ...)
+      - power_mat = power matrix (u,Ct(u)), 2D array (2,n),
+                    u being power_mat[0,:] and Ct(u) being power_mat[1,:],
+                    or list of power matrices
+
+    Outputs:
+    -------
+      - pa = power assessment (W/m2), array (ntime, ...) or,
+             for a list of power matrices, (ntime, npower_mat, ...)
+
+    Keywords:
+    --------
+      - cut_in = cut-in speed in m/s, float number or list (one per matrix)
+      - cut_out = cut-out speed in m/s, float number or list (one per matrix)
+      - pd = power density (W/m2), array like u. Default is 0.5*1025*(u**3)
+      - filename = path of the *.npy file the result is written to,
+                   None to keep the result in memory
+
+    Notes:
+    -----
+      - pa = Cp(u)*pd between cut-in and cut-out, 0 below cut-in and
+        the rated power Cp(cut_out)*0.5*1025*(cut_out**3) above cut-out
+      - computed by time blocks, see loading_utils.chunked_apply
+    """
+    single = np.asarray(power_mat[0]).ndim==1
+    if single:
+        power_mat = [power_mat]
+    nmat = len(power_mat)
+    cut_in = np.broadcast_to(np.asarray(cut_in, dtype=float), (nmat,))
+    cut_out = np.broadcast_to(np.asarray(cut_out, dtype=float), (nmat,))
+    curves = [(np.asarray(m[0], dtype=float), np.asarray(m[1], dtype=float))
+              for m in power_mat]
+    #Rated power
+    paout = [np.interp(co, c[0], c[1]) * 0.5 * RHO * (co**3.0)
+             for c, co in zip(curves, cut_out)]
+
+    def block(u, pd=None):
+        if pd is None:
+            pd = 0.5 * RHO * np.power(u, 3.0)
+        pa = np.empty((u.shape[0], nmat) + u.shape[1:])
+        for k, (speed, Cp) in enumerate(curves):
+            #Power curve is only evaluated between cut-in and cut-out
+            run = (u >= cut_in[k]) & (u <= cut_out[k])
+            pak = np.zeros(u.shape)
+            pak[run] = np.interp(u[run], speed, Cp) * pd[run]
+            pak[u > cut_out[k]] = paout[k]
+            pa[:, k] = pak
+        if single:
+            return pa[:, 0]
+        return pa
+
+    inputs = [u]
+    if not pd is None:
+        inputs.append(pd)
+    if debug: print "Applying power curves..."
+
+    return chunked_apply(block, inputs, filename=filename, debug=debug)
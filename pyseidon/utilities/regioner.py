@@ -1,25 +1,42 @@
 from __future__ import division
 import numpy as np
+import sys
 from bisect import bisect_left, bisect_right
 import matplotlib.pyplot as plt
 import matplotlib.tri as Tri
+from matplotlib.path import Path
+import time
 #quick fix
 #import netCDF4 as nc
 import scipy.io.netcdf as nc
 
 def node_region(ax, lon, lat):
 
-    region_n = np.argwhere((lon >= ax[0]) &
-                            (lon <= ax[1]) &
-                            (lat >= ax[2]) &
-                            (lat <= ax[3]))
+    region_n = np.argwhere(node_mask(ax, lon, lat))
 
     region_n = region_n.flatten()
 
     return region_n
 
+def node_mask(ax, lon, lat):
+    """
+    Boolean mask of the nodes lying within a region.
+
+    :Parameters:
+    **ax** -- either a bounding box [lon1, lon2, lat1, lat2] or a polygon
+    given as a sequence of (lon, lat) vertices
+
+    **lon, lat** -- node coordinates
+    """
+    ax = np.asarray(ax, dtype=float)
+    if ax.ndim==1:
+        return (lon >= ax[0]) & (lon <= ax[1]) & \
+               (lat >= ax[2]) & (lat <= ax[3])
+    poly = Path(ax)
+    return poly.contains_points(np.vstack((lon, lat)).T)
+
 
-def regioner(gridVar, ax, debug=False):
+def regioner(gridVar, ax, inside=False, debug=False):
     """
 Takes as input a region (given by a four elemenTakes as input a region
 (given by a four element NumPy array),
@@ -45,6 +62,15 @@ none, i.e. the data will not be saved, only returned.
 
 **dim = {'2D', '3D'}** the dimension of the data to use regioner
 on. Default is 2D.
+
+**ax** -- polygons are also accepted, as a sequence of (lon, lat) vertices
+
+**inside** -- if False, every element touching the region is kept,
+if True only the elements whose three nodes are in the region.
+Default is False.
+
+The returned 'nbe' follows the Grid.triele convention, i.e. 0-based
+element indices with -1 for neighbours outside the region.
 """
     if debug:
         print 'Reindexing...'
@@ -64,6 +90,85 @@ on. Default is 2D.
     lonc = gridVar.lonc[:]
     latc = gridVar.latc[:]
 
+    l = nv.shape[0]
+    nnode = lon.shape[0]
+
+    #mask nodes -> mask elements
+    if debug:
+        print 'Extracting values from box...'
+    nodeIn = node_mask(ax, lon, lat)
+    if inside:
+        element_index = np.where(nodeIn[nv].all(axis=1))[0]
+    else:
+        element_index = np.where(nodeIn[nv].any(axis=1))[0]
+    if element_index.shape[0]==0:
+        print "---No element in the selected region---"
+        sys.exit()
+    nv_tmp = nv[element_index,:]
+    node_index = np.unique(nv_tmp)
+
+    #re-label nodes and elements through inverse-index arrays
+    if debug:
+        print 'Re-labelling elements and nodes...'
+    node_inv = -np.ones(nnode, int)
+    node_inv[node_index] = np.arange(node_index.shape[0])
+    nv_new = node_inv[nv_tmp]
+    #nbe holds 0-based element indices, -1 standing for no neighbour,
+    #so that neighbours outside the region map onto the trailing -1
+    ele_inv = -np.ones(l + 1, int)
+    ele_inv[element_index] = np.arange(element_index.shape[0])
+    nbe_new = ele_inv[nbe[element_index,:]]
+
+    #create new variables for the region
+
+    data = {}
+    data['node_index'] = node_index
+    data['element_index'] = element_index
+    data['nbe'] = nbe_new.astype(int)
+    data['nv'] = nv_new.astype(int)
+
+    data['a1u'] = a1u[:, element_index]
+    data['a2u'] = a2u[:, element_index]
+    data['aw0'] = aw0[:, element_index]
+    data['awx'] = awx[:, element_index]
+    data['awy'] = awy[:, element_index]
+
+    data['x'] = x[node_index]
+    data['y'] = y[node_index]
+    data['xc'] = xc[element_index]
+    data['yc'] = yc[element_index]
+
+    data['lon'] = lon[node_index]
+    data['lat'] = lat[node_index]
+    data['lonc'] = lonc[element_index]
+    data['latc'] = latc[element_index]
+
+    data['triangle'] = Tri.Triangulation(data['lon'], data['lat'], \
+                                        data['nv'])
+
+    return data
+
+def _legacy_regioner(gridVar, ax, debug=False):
+    """
+    Former loop based implementation of regioner, kept as a reference
+    for regioner_benchmark.
+    """
+    lon = gridVar.lon[:]
+    lat = gridVar.lat[:]
+    nbe = gridVar.triele[:]
+    nv = gridVar.trinodes[:]
+    a1u = gridVar.a1u[:]
+    a2u = gridVar.a2u[:]
+    aw0 = gridVar.aw0[:]
+    awx = gridVar.awx[:]
+    awy = gridVar.awy[:]
+    x = gridVar.x[:]
+    xc = gridVar.xc[:]
+    y = gridVar.y[:]
+    yc = gridVar.yc[:]
+    lonc = gridVar.lonc[:]
+    latc = gridVar.latc[:]
+
     l = nv.shape[0]
 
     idx = node_region(ax, lon, lat)
@@ -155,3 +260,31 @@ on. Default is 2D.
 
     return data
 
+
+def regioner_benchmark(gridVar, ax, debug=False):
+    """
+    Times regioner against its former loop based implementation
+    and checks that both select and re-label the same nodes and elements.
+
+    :Parameters:
+    **gridVar** -- full domain grid, i.e. FVCOM.Grid
+
+    **ax** -- bounding box [lon1, lon2, lat1, lat2]
+
+    Returns (old time, new time) in seconds
+    """
+    tic = time.time()
+    old = _legacy_regioner(gridVar, ax, debug=debug)
+    tOld = time.time() - tic
+    tic = time.time()
+    new = regioner(gridVar, ax, debug=debug)
+    tNew = time.time() - tic
+
+    for key in ['node_index', 'element_index', 'nv', 'a1u', 'lon', 'latc']:
+        if not np.array_equal(old[key], new[key]):
+            print "---" + key + " differs from former implementation---"
+    print "Former regioner: " + str(round(tOld, 3)) + " s"
+    print "Vectorized regioner: " + str(round(tNew, 3)) + " s"
+    print "Speed-up: " + str(round(tOld / max(tNew, 1e-9), 1))
+
+    return tOld, tNew
@@ -0,0 +1,124 @@
+#!/usr/bin/python2.7
+# encoding: utf-8
+
+from __future__ import division
+import numpy as np
+import sys
+from bisect import bisect_left
+from difflib import get_close_matches
+
+def normalize_name(name):
+    """Station name as an upper case string, from a string or a char array"""
+    if isinstance(name, np.ndarray):
+        name = "".join(np.asarray(name).astype(str).ravel())
+    return name.strip().upper()
+
+class NameIndex(object):
+    """
+    Lookup table of the station names.
+
+    Inputs:
+    ------
+      - names = station names, 2D char array (nele, namelen)
+                or list of strings
+
+    Notes:
+    -----
+      - names are normalized with normalize_name, i.e. 'st01 ' = 'ST01'
+      - for duplicated names, the first station is returned
+    """
+    def __init__(self, names):
+        self.names = [normalize_name(name) for name in names]
+        self._lookup = {}
+        for i, name in enumerate(self.names):
+            self._lookup.setdefault(name, i)
+        self._sorted = sorted((name, i) for i, name in enumerate(self.names))
+        self._keys = [name for name, i in self._sorted]
+
+    def __len__(self):
+        return len(self.names)
+
+    def find(self, name):
+        """Index of name, -1 if not found"""
+        return self._lookup.get(normalize_name(name), -1)
+
+    def prefix(self, prefix):
+        """Indices of the stations whose name starts with prefix"""
+        prefix = normalize_name(prefix)
+        start = bisect_left(self._keys, prefix)
+        found = []
+        for name, i in self._sorted[start:]:
+            if not name.startswith(prefix):
+                break
+            found.append(i)
+        return sorted(found)
+
+    def closest(self, name, n=5, cutoff=0.6):
+        """Closest station names to name, list of strings"""
+        return get_close_matches(normalize_name(name), self._keys,
+                                 n=n, cutoff=cutoff)
+
+    def search(self, station):
+        """
+        Search for station indices.
+
+        Inputs:
+        ------
+          - station = station index (interger) or name (string), list of them,
+                      1D array of indices, 2D char array of names or 'all'
+
+        Outputs:
+        -------
+          - index = station index, integer, or indices, 1D array of integers.
+                    -1 for stations which are not found
+
+        Notes:
+        -----
+          - a name which is not found but is the prefix of a single
+            station name returns this station
+        """
+        if isinstance(station, (int, long, np.integer)):
+            if -len(self) <= station < len(self):
+                return int(station) % len(self)
+            return -1
+        if type(station)==str and station.lower()=='all':
+            return np.arange(len(self))
+        if isinstance(station, (str, unicode)) or (isinstance(station,
+           np.ndarray) and station.dtype.kind in 'SU' and station.ndim<=1
+           and not station.dtype.itemsize > 1):
+            index = self.find(station)
+            if index==-1:
+                found = self.prefix(station)
+                if len(found)==1:
+                    index = found[0]
+            return index
+        if isinstance(station, np.ndarray) and station.dtype.kind in 'SU'\
+           and station.ndim==2:
+            station = list(station)
+        return np.array([self.search(s) for s in station], dtype=int)
+
+def name_index(grid):
+    """NameIndex of a Station grid, built on first use"""
+    if getattr(grid, '_name_index', None) is None:
+        grid._name_index = NameIndex(grid.name[:])
+    return grid._name_index
+
+def search_station(grid, station):
+    """
+    Search for station indices in a Station grid, see NameIndex.search.
+    Exits on stations which are not found.
+    """
+    nameIndex = name_index(grid)
+    index = nameIndex.search(station)
+    if np.any(np.asarray(index)==-1):
+        print "---Wrong station input---"
+        missing = [station] if np.ndim(index)==0 else \
+                  [s for s, i in zip(station, index) if i==-1]
+        for s in missing:
+            if isinstance(s, (str, unicode, np.ndarray)):
+                close = nameIndex.closest(s)
+                if not close==[]:
+                    print "Did you mean: " + ", ".join(close) + " ?"
+        sys.exit()
+
+    return index
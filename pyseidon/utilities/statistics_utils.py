@@ -0,0 +1,153 @@
+#!/usr/bin/python2.7
+# encoding: utf-8
+
+from __future__ import division
+import numpy as np
+from loading_utils import MEM_BUDGET
+
+def _time_blocks(ntime, nspace, mem_budget):
+    """Time blocks of a (ntime, nspace) variable fitting mem_budget"""
+    #signal, bin indexes and weights, 8 bytes each
+    rows = max(1, int(mem_budget // (3 * 8 * max(nspace, 1))))
+    return [(t0, min(t0 + rows, ntime)) for t0 in range(0, ntime, rows)]
+
+def exceedance_curve(signal, time, ranges=None, nbins=30,
+                     mem_budget=MEM_BUDGET, debug=False):
+    """
+    Exceedance curve(s) of a time series or of a whole field at once.
+
+    Inputs:
+    ------
+      - signal = given quantity, 1 or 2D array, i.e (time) or (time,ele)
+      - time = time of the samples, 1D array (ntime), or time step, float
+
+    Outputs:
+    -------
+      - Exceedance = % of time the signal is above each range,
+                     array (nrange) or (nrange,ele)
+      - Ranges = list of signal amplitude bins, 1D array
+
+    Keywords:
+    --------
+      - ranges = amplitude thresholds, float or list of floats.
+                 Default is nbins+1 bins from 0 to the signal maximum
+      - nbins = number of bins of the default ranges, integer
+      - mem_budget = maximum size in bytes of the blocks, integer
+
+    Notes:
+    -----
+      - each sample lasts until the next one, i.e. time[j+1]-time[j],
+        so that irregular time steps are accounted for
+      - the period is ntime times the mean time step
+      - samples are binned against the sorted ranges and the time spent
+        in each bin is summed from the top bin down, i.e. a reverse
+        cumulative histogram, instead of comparing every sample to every range
+      - nan samples are never counted as exceeding
+    """
+    oneD = (len(signal.shape)==1)
+    ntime = signal.shape[0]
+    nspace = 1 if oneD else int(np.prod(signal.shape[1:]))
+    blocks = _time_blocks(ntime, nspace, mem_budget)
+
+    #Sample durations
+    if np.ndim(time)==0:
+        time = time * np.arange(ntime, dtype=float)
+    time = np.asarray(time[:], dtype=float)
+    weight = np.zeros(ntime)
+    weight[:-1] = np.diff(time)
+    Period = ntime * (time[-1] - time[0]) / max(ntime - 1, 1)
+
+    if ranges is None:
+        Max = -np.inf
+        for t0, t1 in blocks:
+            Max = max(Max, np.nanmax(np.ma.filled(signal[t0:t1], np.nan)))
+        dy = (Max/float(nbins))
+        Ranges = np.arange(0,(Max + dy), dy)
+    else:
+        Ranges = np.sort(np.atleast_1d(np.asarray(ranges, dtype=float)))
+    M = Ranges.shape[0]
+
+    #Time spent in each bin, bin k being ]Ranges[k-1], Ranges[k]]
+    hist = np.zeros((M + 1, nspace))
+    col = np.arange(nspace)
+    for t0, t1 in blocks:
+        block = np.ma.filled(np.ma.asarray(signal[t0:t1], dtype=float)
+                             .reshape(t1 - t0, nspace), np.nan)
+        w = np.repeat(weight[t0:t1], nspace).reshape(t1 - t0, nspace)
+        w[np.isnan(block)] = 0.0
+        bins = np.searchsorted(Ranges, block.ravel(), side='left')
+        flat = bins * nspace + np.tile(col, t1 - t0)
+        hist += np.bincount(flat, weights=w.ravel(),
+                            minlength=(M + 1) * nspace).reshape(M + 1, nspace)
+        if debug: print 'Block: ' + str(t0) + '-' + str(t1)
+
+    #Time spent above each range
+    Exceedance = np.cumsum(hist[::-1], axis=0)[::-1][1:]
+    Exceedance = (Exceedance * 100) / Period
+
+    if oneD:
+        return Exceedance[:,0], Ranges
+    return Exceedance.reshape((M,) + tuple(signal.shape[1:])), Ranges
+
+def occurrence_histogram(signal, bins=50, mem_budget=MEM_BUDGET, debug=False):
+    """
+    Histogram(s) of occurrences of a time series or of many at once.
+
+    Inputs:
+    ------
+      - signal = given quantity, 1 or 2D array, i.e (time) or (time,ele)
+
+    Outputs:
+    -------
+      - Occurrences = % of the samples in each bin,
+                      array (nbin) or (nbin,ele)
+      - Edges = edges of the bins, 1D array (nbin+1)
+
+    Keywords:
+    --------
+      - bins = number of bins from the signal minimum to its maximum,
+               integer, or edges of the bins, list of floats
+      - mem_budget = maximum size in bytes of the blocks, integer
+
+    Notes:
+    -----
+      - the bins are shared by all the series so that they can be compared
+      - nan samples are not counted
+    """
+    oneD = (len(signal.shape)==1)
+    ntime = signal.shape[0]
+    nspace = 1 if oneD else int(np.prod(signal.shape[1:]))
+    blocks = _time_blocks(ntime, nspace, mem_budget)
+
+    if np.ndim(bins)==0:
+        Min, Max = np.inf, -np.inf
+        for t0, t1 in blocks:
+            block = np.ma.filled(signal[t0:t1], np.nan)
+            Min = min(Min, np.nanmin(block))
+            Max = max(Max, np.nanmax(block))
+        Edges = np.linspace(Min, Max, int(bins) + 1)
+    else:
+        Edges = np.sort(np.asarray(bins, dtype=float))
+    M = Edges.shape[0] - 1
+
+    #Samples in each bin, the last bin including its upper edge
+    hist = np.zeros((M, nspace))
+    total = np.zeros(nspace)
+    col = np.arange(nspace)
+    for t0, t1 in blocks:
+        block = np.ma.filled(np.ma.asarray(signal[t0:t1], dtype=float)
+                             .reshape(t1 - t0, nspace), np.nan).ravel()
+        cols = np.tile(col, t1 - t0)
+        bins = np.searchsorted(Edges, block, side='right') - 1
+        bins[block==Edges[-1]] = M - 1
+        keep = (bins>=0) * (bins<M)
+        hist += np.bincount(bins[keep] * nspace + cols[keep],
+                            minlength=M * nspace).reshape(M, nspace)
+        total += np.bincount(cols[~np.isnan(block)], minlength=nspace)
+        if debug: print 'Block: ' + str(t0) + '-' + str(t1)
+
+    Occurrences = (hist * 100) / np.maximum(total, 1)
+
+    if oneD:
+        return Occurrences[:,0], Edges
+    return Occurrences.reshape((M,) + tuple(signal.shape[1:])), Edges
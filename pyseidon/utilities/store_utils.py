@@ -0,0 +1,201 @@
+#!/usr/bin/python2.7
+# encoding: utf-8
+
+from __future__ import division
+import numpy as np
+import os
+import sys
+import json
+import cPickle as pkl
+from loading_utils import MEM_BUDGET
+
+#Name of the manifest of a *.store directory
+MANIFEST = 'manifest.json'
+#Attributes which are rebuilt on demand and not saved
+SKIPPED = ['triangle', '_spatial_index', '_cache', '_name_index']
+#Array-like types read from the source files
+ARRAY_LIKE = ['Variable', 'ArrayProxy', 'BaseType', 'LazyVariable',
+              'DepthField', 'TimeConcat', 'netcdf_variable']
+
+def _is_array_like(value):
+    return type(value).__name__ in ARRAY_LIKE
+
+def _write_array(path, maskPath, value, mem_budget=MEM_BUDGET):
+    """
+    Writes an array or array-like by blocks along its first axis,
+    and its mask to maskPath if it is masked. Returns True if so.
+    """
+    #np.shape, unlike np.ndim, does not read array-likes
+    shape = tuple(np.shape(value))
+    if not isinstance(value, np.ndarray) and len(shape)>0 and\
+       int(np.prod(shape))==0:
+        #Empty files cannot be memory-mapped
+        value = value[:]
+    if isinstance(value, np.ndarray) or len(shape)==0:
+        np.save(path, np.ma.getdata(value))
+        if np.ma.isMaskedArray(value):
+            np.save(maskPath, np.ma.getmaskarray(value))
+            return True
+        return False
+    first = np.ma.getdata(value[0:1])
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=first.dtype,
+                                    shape=shape)
+    mask = None
+    stepBytes = first.dtype.itemsize * int(np.prod(shape[1:]))
+    rows = max(1, int(mem_budget // max(stepBytes, 1)))
+    for t0 in range(0, shape[0], rows):
+        t1 = min(t0 + rows, shape[0])
+        block = value[t0:t1]
+        out[t0:t1] = np.ma.getdata(block)
+        #Blocks may be masked or not, i.e. netcdf fill values
+        if np.ma.isMaskedArray(block):
+            if mask is None:
+                mask = np.lib.format.open_memmap(maskPath, mode='w+',
+                                                 dtype=bool, shape=shape)
+                mask[:t0] = False
+            mask[t0:t1] = np.ma.getmaskarray(block)
+        elif not mask is None:
+            mask[t0:t1] = False
+    out.flush()
+    del out
+    if mask is None:
+        return False
+    mask.flush()
+    del mask
+    return True
+
+def save_store(dirname, data, mem_budget=MEM_BUDGET, debug=False):
+    """
+    Saves a structure as a directory of *.npy files plus a json manifest.
+
+    Inputs:
+    ------
+      - dirname = path of the store directory, string
+      - data = structure, dictionary with 'Origin', 'History' and
+               sections, i.e. 'Grid' and 'Variables', as dictionaries
+
+    Keywords:
+    --------
+      - mem_budget = maximum size in bytes of the blocks written at once
+                     for array-likes read from the source files, integer
+
+    Notes:
+    -----
+      - each array is a *.npy file, masked arrays and array-likes
+        returning masked blocks having an extra *.mask.npy file,
+        so that load_store can memory-map them
+      - numbers, strings, lists and dictionaries are kept in the manifest,
+        any other object is pickled in its own file
+      - the manifest is written last, a store without it is incomplete
+    """
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    manifest = {'format': 'npy-store', 'version': 1, 'sections': {}}
+    for key in data:
+        if not type(data[key])==dict:
+            manifest[key] = data[key]
+            continue
+        section = {}
+        folder = os.path.join(dirname, key)
+        if not os.path.exists(folder):
+            os.mkdir(folder)
+        for name, value in data[key].items():
+            if name in SKIPPED:
+                continue
+            path = os.path.join(key, name)
+            if _is_array_like(value) or (isinstance(value, np.ndarray)
+                                          and not value.dtype==object):
+                if debug: print "Writing " + path
+                if _write_array(os.path.join(dirname, path + '.npy'),
+                                os.path.join(dirname, path + '.mask.npy'),
+                                value, mem_budget=mem_budget):
+                    section[name] = {'kind': 'masked', 'file': path + '.npy',
+                                     'mask': path + '.mask.npy'}
+                else:
+                    section[name] = {'kind': 'array', 'file': path + '.npy'}
+                continue
+            if isinstance(value, np.generic):
+                value = value.item()
+            try:
+                json.dumps(value)
+                section[name] = {'kind': 'value', 'value': value}
+            except (TypeError, ValueError):
+                with open(os.path.join(dirname, path + '.p'), 'wb') as f:
+                    pkl.dump(value, f, protocol=pkl.HIGHEST_PROTOCOL)
+                section[name] = {'kind': 'pickle', 'file': path + '.p'}
+        manifest['sections'][key] = section
+
+    with open(os.path.join(dirname, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    if debug: print "Store written to " + dirname
+
+def _str(value):
+    """Turns json unicode strings back into str"""
+    if type(value)==unicode:
+        return value.encode('utf-8')
+    if type(value)==list:
+        return [_str(v) for v in value]
+    if type(value)==dict:
+        return dict((_str(k), _str(v)) for k, v in value.items())
+    return value
+
+def _load_array(filename, mmap_mode):
+    try:
+        return np.load(filename, mmap_mode=mmap_mode)
+    except ValueError:
+        #empty arrays cannot be memory-mapped
+        return np.load(filename)
+
+def load_store(dirname, mmap_mode='r', debug=False):
+    """
+    Opens a structure saved by save_store.
+
+    Inputs:
+    ------
+      - dirname = path of the store directory, string
+
+    Outputs:
+    -------
+      - data = structure, dictionary with 'Origin', 'History' and
+               sections as dictionaries
+
+    Keywords:
+    --------
+      - mmap_mode = np.load memory-map mode of the arrays, i.e. 'r', 'c'
+                    (copy-on-write) or None to read them in memory
+
+    Notes:
+    -----
+      - arrays are memory-mapped, so that only the accessed parts are read
+    """
+    path = os.path.join(dirname, MANIFEST)
+    if not os.path.exists(path):
+        print "---Incomplete or missing store: " + dirname + "---"
+        sys.exit()
+    with open(path, 'r') as f:
+        manifest = _str(json.load(f))
+
+    data = {}
+    for key in manifest:
+        if not key in ['format', 'version', 'sections']:
+            data[key] = manifest[key]
+    for key, section in manifest['sections'].items():
+        data[key] = {}
+        for name, entry in section.items():
+            if entry['kind']=='value':
+                data[key][name] = entry['value']
+                continue
+            filename = os.path.join(dirname, entry['file'])
+            if entry['kind']=='pickle':
+                with open(filename, 'rb') as f:
+                    data[key][name] = pkl.load(f)
+            elif entry['kind']=='masked':
+                mask = _load_array(os.path.join(dirname, entry['mask']),
+                                   mmap_mode)
+                data[key][name] = np.ma.array(_load_array(filename, mmap_mode),
+                                              mask=mask, copy=False)
+            else:
+                data[key][name] = _load_array(filename, mmap_mode)
+            if debug: print "Mapped " + entry['file']
+
+    return data
@@ -67,9 +67,7 @@ class _load_validation:
         if simulated.__module__=='pyseidon.stationClass.stationClass':
             self._simtype = 'station'
             #Find closest point to ADCP
-            ind = closest_point([self.obs.lon], [self.obs.lat],
-                                simulated.Grid.lon[:],
-                                simulated.Grid.lat[:])
+            ind = closest_node(simulated.Grid, [self.obs.lon], [self.obs.lat])
             nameSite = ''.join(simulated.Grid.name[ind,:][0,:])
             print "Station site: " + nameSite
             self.sim.lat = simulated.Grid.lat[ind]
@@ -0,0 +1,119 @@
+#!/usr/bin/python2.7
+# encoding: utf-8
+"""
+Tests of the OpenDap loading of FVCOM variables, aka _load_var._load_remote,
+against a local pydap server: the dataset is served by a pydap handler
+called in-process by the pydap client, so that no network is needed.
+
+Run with: python -m unittest discover tests
+"""
+
+from __future__ import division
+import os
+import sys
+import unittest
+import numpy as np
+
+local = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                     'pyseidon')
+sys.path.append(os.path.join(local, 'fvcomClass'))
+sys.path.append(os.path.join(local, 'utilities'))
+
+try:
+    from pydap.model import DatasetType, BaseType
+    from pydap.handlers.lib import BaseHandler
+    from pydap.client import open_url
+    PYDAP = True
+except ImportError:
+    PYDAP = False
+
+NTIME, NLEVEL, NELE, NNODE = 12, 3, 400, 250
+
+def local_server(missing=[]):
+    """Return a synthetic FVCOM dataset opened through a local pydap server"""
+    rs = np.random.RandomState(0)
+    dataset = DatasetType('fvcom')
+    dataset['time'] = BaseType('time', 56000.0 + np.arange(NTIME) / 24.0,
+                               dimensions=('time',))
+    for key in ['ua', 'va']:
+        dataset[key] = BaseType(key, rs.rand(NTIME, NELE),
+                                dimensions=('time', 'nele'))
+    dataset['zeta'] = BaseType('zeta', rs.rand(NTIME, NNODE),
+                               dimensions=('time', 'node'))
+    for key in ['u', 'v', 'ww']:
+        if key in missing:
+            continue
+        dataset[key] = BaseType(key, rs.rand(NTIME, NLEVEL, NELE),
+                                dimensions=('time', 'siglay', 'nele'))
+    data = open_url('http://localhost:8001/', application=BaseHandler(dataset))
+    #Same fake attribute as in FVCOM.__init__
+    data.variables = data
+
+    return dataset, data
+
+class _Grid:
+    """Bounding box indices of a re-indexed grid, see regioner"""
+    def __init__(self, element_index, node_index):
+        self._ax = [-66.0, -65.0, 44.0, 45.0]
+        self._element_index = element_index
+        self._node_index = node_index
+
+@unittest.skipIf(not PYDAP, 'pydap is not installed')
+class TestLoadRemote(unittest.TestCase):
+
+    def setUp(self):
+        from variablesFvcom import _load_var
+        self._load_var = _load_var
+        self.dataset, self.data = local_server()
+        #Two clusters of elements plus a scattered one, unsorted
+        self.region_e = np.hstack((np.arange(300, 320), np.arange(10, 40),
+                                   [150]))
+        self.region_n = np.arange(5, 60, 3)
+
+    def source(self, key):
+        return np.asarray(self.dataset[key].data)
+
+    def test_variables(self):
+        var = self._load_var(self.data, _Grid(self.region_e, self.region_n),
+                             [], [])
+        np.testing.assert_array_equal(var.ua, self.source('ua')[:, self.region_e])
+        np.testing.assert_array_equal(var.va, self.source('va')[:, self.region_e])
+        np.testing.assert_array_equal(var.el,
+                                      self.source('zeta')[:, self.region_n])
+        np.testing.assert_array_equal(var.v,
+                                      self.source('v')[:, :, self.region_e])
+        np.testing.assert_array_equal(var.matlabTime,
+                                      self.source('time') + 678942.0)
+        self.assertTrue(var._3D)
+
+    def test_requests(self):
+        var = self._load_var(self.data, _Grid(self.region_e, self.region_n),
+                             [], [])
+        #Element clusters are merged, the scattered one is fetched alone:
+        #3 requests per element variable, 1 for zeta
+        self.assertEqual(var._remote_stats['requests'], 5 * 3 + 1)
+        self.assertTrue(var._remote_stats['overfetch'] >= 0)
+
+    def test_time_slice(self):
+        var = self._load_var(self.data, _Grid(self.region_e, self.region_n),
+                             [], [])
+        var._load_remote(self.data, slice(2, 7), self.region_e,
+                         self.region_n, ['ua', 'va', 'zeta'],
+                         ['ua', 'va', 'el'], ['u'], ['u'])
+        np.testing.assert_array_equal(var.ua,
+                                      self.source('ua')[2:7, self.region_e])
+        np.testing.assert_array_equal(var.el,
+                                      self.source('zeta')[2:7, self.region_n])
+        np.testing.assert_array_equal(var.u,
+                                      self.source('u')[2:7, :, self.region_e])
+
+    def test_missing_variable(self):
+        self.dataset, self.data = local_server(missing=['ww'])
+        var = self._load_var(self.data, _Grid(self.region_e, self.region_n),
+                             [], [])
+        self.assertFalse(hasattr(var, 'ww'))
+        np.testing.assert_array_equal(var.u,
+                                      self.source('u')[:, :, self.region_e])
+
+if __name__ == '__main__':
+    unittest.main()